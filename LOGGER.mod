@@ -0,0 +1,127 @@
+MODULE LOGGER
+!
+!  Released under MIT License
+!
+!  David Pollard
+!  Bristol Robotics Laboratory
+!
+!  Original author
+!  Michael Dawson-Haggerty
+!
+!  Runs as a separate (non-motion) task alongside SERVER.
+!  Streams the current pose and joint angles to the PC, one record each
+!  per sample:
+!    "0 <time> <x> <y> <z> <q1> <q2> <q3> <q4> #"
+!    "1 <time> <j1> <j2> <j3> <j4> <j5> <j6> #"
+!  <time> is seconds since the logger started. Records end in "#", the
+!  same as replies from SERVER, so the PC can frame them.
+!
+
+!////////////////
+!GLOBAL VARIABLES
+!////////////////
+
+! Robot configuration, shared with SERVER
+PERS tooldata currentTool;
+PERS wobjdata currentWobj;
+
+! Mutex between logger and changing the tool and work objects
+PERS bool frameMutex;
+
+! PC communication
+VAR socketdev clientSocket;
+VAR socketdev serverSocket;
+PERS string ipController;
+PERS num loggerPort:= 5001;
+
+! Logger sampling period (seconds)
+PERS num loggerWaitTime:= 0.01;
+
+
+!////////////////
+!LOCAL METHODS
+!////////////////
+
+! Handshake between server and client:
+!  - Creates socket.
+!  - Waits for incoming TCP connection.
+PROC ServerCreateAndConnect(string ip, num port)
+    VAR string clientIP;
+
+    SocketCreate serverSocket;
+    SocketBind serverSocket, ip, port;
+    SocketListen serverSocket;
+    TPWrite "LOGGER: Logger waiting for incoming connections ...";
+    WHILE SocketGetStatus(clientSocket) <> SOCKET_CONNECTED DO
+        SocketAccept serverSocket,clientSocket \ClientAddress:=clientIP \Time:=WAIT_MAX;
+        IF SocketGetStatus(clientSocket) <> SOCKET_CONNECTED THEN
+            TPWrite "LOGGER: Problem serving an incoming connection.";
+            TPWrite "LOGGER: Try reconnecting.";
+        ENDIF
+        ! Wait 0.5 seconds for the next reconnection
+        WaitTime 0.5;
+    ENDWHILE
+    TPWrite "LOGGER: Connected to IP " + clientIP;
+ENDPROC
+
+
+!////////////////////////
+!//LOGGER: Main procedure
+!////////////////////////
+PROC main()
+    VAR string data;
+    VAR robtarget position;
+    VAR jointtarget joints;
+    VAR clock timer;
+
+    ClkReset timer;
+    ClkStart timer;
+    ServerCreateAndConnect ipController,loggerPort;
+
+    WHILE TRUE DO
+        ! Cartesian coordinates, with the tool and work object SERVER is using
+        WHILE (frameMutex) DO
+            WaitTime .001; ! If the frame is being changed by SERVER, wait here
+        ENDWHILE
+        frameMutex := TRUE;
+        position := CRobT(\Tool:=currentTool \WObj:=currentWobj);
+        frameMutex := FALSE;
+
+        data := "0 " + NumToStr(ClkRead(timer),3) + " ";
+        data := data + NumToStr(position.trans.x,2) + " ";
+        data := data + NumToStr(position.trans.y,2) + " ";
+        data := data + NumToStr(position.trans.z,2) + " ";
+        data := data + NumToStr(position.rot.q1,4) + " ";
+        data := data + NumToStr(position.rot.q2,4) + " ";
+        data := data + NumToStr(position.rot.q3,4) + " ";
+        data := data + NumToStr(position.rot.q4,4) + " #";
+        SocketSend clientSocket \Str:=data;
+
+        ! Joint coordinates
+        joints := CJointT();
+        data := "1 " + NumToStr(ClkRead(timer),3) + " ";
+        data := data + NumToStr(joints.robax.rax_1,2) + " ";
+        data := data + NumToStr(joints.robax.rax_2,2) + " ";
+        data := data + NumToStr(joints.robax.rax_3,2) + " ";
+        data := data + NumToStr(joints.robax.rax_4,2) + " ";
+        data := data + NumToStr(joints.robax.rax_5,2) + " ";
+        data := data + NumToStr(joints.robax.rax_6,2) + " #";
+        SocketSend clientSocket \Str:=data;
+
+        WaitTime loggerWaitTime;
+    ENDWHILE
+
+ERROR
+    IF ERRNO=ERR_SOCK_CLOSED THEN
+        TPWrite "LOGGER: Client has closed connection.";
+    ELSE
+        TPWrite "LOGGER: Connection lost: Unknown problem.";
+    ENDIF
+    frameMutex := FALSE;
+    SocketClose clientSocket;
+    SocketClose serverSocket;
+    ServerCreateAndConnect ipController,loggerPort;
+    RETRY;
+ENDPROC
+
+ENDMODULE
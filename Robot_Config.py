@@ -58,8 +58,13 @@ class robot_config:
             
     @classmethod
     def get_wobj(robot_config,z_offset = 0, WObjNumber = 0):
+        # Moved z_offset along the work object's own Z axis (abb_frames.workobject)
         if WObjNumber < len(robot_config.WObjData):
-            return robot_config.WObjData[WObjNumber]
+            if z_offset != 0:
+                # abb_frames imports robot_config
+                import abb_frames
+                return abb_frames.as_pose(abb_frames.workobject(WObjNumber, z_offset))
+            return copy.deepcopy(robot_config.WObjData[WObjNumber])
         else:
             raise Exception("Unrecognised WObj Number")
 
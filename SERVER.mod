@@ -31,8 +31,12 @@ PERS bool frameMutex:=FALSE;
 VAR socketdev clientSocket;
 VAR socketdev serverSocket;
 VAR num instructionCode;
-VAR num params{10};
+CONST num MAX_PARAMS := 24;
+VAR num params{MAX_PARAMS};
 VAR num nParams;
+VAR rawbytes rxRaw;       !Bytes received from the PC, several messages when pipelined
+VAR num rxIndex := 1;     !Next unread byte in rxRaw
+VAR bool binaryMode := FALSE; !Messages from the PC are binary frames (42), not text
 
 VAR num qOrientation{4};  !store Q value for orientation
 VAR num tempNum;          !For use whenever needed. Don't rely on it to stay the same
@@ -52,13 +56,33 @@ CONST num MAX_SAVED_BUFFERS := 20;
 VAR num BUFFER_POS := 0;
 VAR robtarget bufferTargets{MAX_BUFFER};
 VAR speeddata bufferSpeeds{MAX_BUFFER};
+VAR num bufferGO{MAX_BUFFER};     !GO_Signal value for the move to each pose, -1 leaves it
 VAR bool extrudeDuringBufferMove;
+VAR triggdata goTrigger;
+! Unreachable indices in one reply to 41, so the reply fits in a string
+CONST num MAX_UNREACHABLE := 15;
 
 ! Spare buffers for saving paths
 VAR robtarget savedBufferTargets{MAX_SAVED_BUFFERS, MAX_BUFFER};
 VAR speeddata savedBufferSpeeds{MAX_SAVED_BUFFERS, MAX_BUFFER};
+VAR num savedBufferGO{MAX_SAVED_BUFFERS, MAX_BUFFER};
 VAR num savedBufferPos{MAX_SAVED_BUFFERS};
 
+! Ring of poses filled by the STREAM task, executed by instruction 60.
+! Their initial values are in STREAM.mod.
+CONST num STREAM_RING := 1024;
+PERS robtarget streamTargets{STREAM_RING};
+PERS speeddata streamSpeeds{STREAM_RING};
+PERS bool streamExtrude{STREAM_RING};
+PERS num streamAdded;
+PERS num streamDone;
+PERS num streamEndAt;
+PERS bool streamHold;
+PERS bool streamTaking;
+! Switch DO10_2 at the start of each streamed move
+VAR triggdata extrudeStart;
+VAR triggdata extrudeStop;
+
 ! External axis position variables
 VAR extjoint externalAxis;
 
@@ -107,11 +131,15 @@ PROC ParseMsg(string msg)
             nParams := -1;
         ELSE
             ind := newInd;
-            ! Read all instruction parameters (maximum of 8)
+            ! Read all instruction parameters (maximum of MAX_PARAMS)
             WHILE end = FALSE DO
                 newInd := StrMatch(msg,ind," ") + 1;
                 IF newInd > length THEN
                     end := TRUE;
+                ELSEIF indParam > MAX_PARAMS THEN
+                    ! Too many parameters, corrupt message
+                    indParam := 0;
+                    end := TRUE;
                 ELSE
                     subString := StrPart(msg,ind,newInd - ind - 1);
                     auxOk := StrToVal(subString, params{indParam});
@@ -145,6 +173,98 @@ PROC ServerCreateAndConnect(string ip, num port)
         WaitTime 0.5;
     ENDWHILE
     TPWrite "SERVER: Connected to IP " + clientIP;
+    ! Discard anything left over from the previous client
+    ClearRawBytes rxRaw;
+    rxIndex := 1;
+    binaryMode := FALSE;
+ENDPROC
+
+
+! Receives the next message (up to and including "#") from the PC.
+!  The PC may pipeline commands, so one packet can hold several messages
+!  and a message can be split over packets. Unread bytes stay in rxRaw.
+PROC ReceiveMsg(VAR string msg)
+    VAR byte rxByte := 0;
+    VAR num startIndex;
+    VAR string rxPart;
+
+    msg := "";
+    WHILE rxByte <> 35 DO
+        IF rxIndex > RawBytesLen(rxRaw) THEN
+            ClearRawBytes rxRaw;
+            SocketReceive clientSocket \RawData:=rxRaw \Time:=WAIT_MAX;
+            rxIndex := 1;
+        ENDIF
+        ! Scan for the end character "#" (ASCII 35)
+        startIndex := rxIndex;
+        WHILE rxIndex <= RawBytesLen(rxRaw) AND rxByte <> 35 DO
+            UnpackRawBytes rxRaw, rxIndex, rxByte \Hex1;
+            rxIndex := rxIndex + 1;
+        ENDWHILE
+        UnpackRawBytes rxRaw, startIndex, rxPart \ASCII:=rxIndex - startIndex;
+        msg := msg + rxPart;
+    ENDWHILE
+ENDPROC
+
+
+! Makes sure rxRaw holds at least count unread bytes, receiving more from
+!  the PC if it doesn't (a frame can be split over packets). Unread bytes
+!  are moved to the start of rxRaw first, and only the bytes missing are
+!  read, so rxRaw never holds more than one frame's worth.
+PROC ReceiveBytes(num count)
+    VAR rawbytes rxMore;
+    VAR num unread;
+
+    unread := RawBytesLen(rxRaw) - rxIndex + 1;
+    IF unread >= count THEN
+        ! Already here (or nothing to read, e.g. a frame without parameters)
+        RETURN;
+    ENDIF
+    IF unread <= 0 THEN
+        ClearRawBytes rxRaw;
+        SocketReceive clientSocket \RawData:=rxRaw \Time:=WAIT_MAX;
+        rxIndex := 1;
+        unread := RawBytesLen(rxRaw);
+    ENDIF
+    IF unread < count THEN
+        CopyRawBytes rxRaw, rxIndex, rxMore, 1 \NoOfBytes:=unread;
+        ClearRawBytes rxRaw;
+        CopyRawBytes rxMore, 1, rxRaw, 1 \NoOfBytes:=unread;
+        rxIndex := 1;
+        WHILE unread < count DO
+            ClearRawBytes rxMore;
+            SocketReceive clientSocket \RawData:=rxMore \ReadNoOfBytes:=count - unread \Time:=WAIT_MAX;
+            CopyRawBytes rxMore, 1, rxRaw, unread + 1;
+            unread := RawBytesLen(rxRaw);
+        ENDWHILE
+    ENDIF
+ENDPROC
+
+
+! Receives the next binary frame from the PC (after "42 1 #"), and loads
+!  instructionCode, nParams and params{} as ParseMsg does. A frame is:
+!  - instruction code (signed byte)
+!  - number of parameters (unsigned byte)
+!  - each parameter as a little-endian 4 byte float
+PROC ReceiveFrame()
+    VAR num count;
+    VAR num i;
+
+    ReceiveBytes 2;
+    UnpackRawBytes rxRaw, rxIndex, instructionCode \IntX:=SINT;
+    UnpackRawBytes rxRaw, rxIndex + 1, count \IntX:=USINT;
+    rxIndex := rxIndex + 2;
+    ReceiveBytes 4 * count;
+    IF count > MAX_PARAMS THEN
+        ! Too many parameters, corrupt message
+        nParams := -1;
+    ELSE
+        FOR i FROM 1 TO count DO
+            UnpackRawBytes rxRaw, rxIndex + 4 * (i - 1), params{i} \Float4;
+        ENDFOR
+        nParams := count;
+    ENDIF
+    rxIndex := rxIndex + 4 * count;
 ENDPROC
 
 
@@ -179,6 +299,12 @@ PROC ServerMain()
     VAR bool reconnected;        ! Drop and reconnection happened during serving a command
     VAR robtarget cartesianPose;
     VAR jointtarget jointsPose;
+    VAR speeddata streamSpeed;   ! Speed and extrusion of the streamed pose being executed
+    VAR bool streamExtrudeOn;
+    VAR bool joinStart;          ! Buffer continues the previous one (33)
+    VAR bool joinEnd;            ! Buffer is continued by the next one (33)
+    VAR num checkIndex;          ! Next pose checked by 41
+    VAR num unreachable;         ! Unreachable poses found by 41
     			
     ! Motion configuration
     ConfL \Off;
@@ -187,6 +313,8 @@ PROC ServerMain()
 	
     ! Initialization of WorkObject, Tool, Speed and Zone
     Initialize;
+    TriggIO extrudeStart, 0 \Start \DOp:=DO10_2, 1;
+    TriggIO extrudeStop, 0 \Start \DOp:=DO10_2, 0;
 
     ! Socket connection
     connected:=FALSE;
@@ -201,8 +329,12 @@ PROC ServerMain()
         addString := "";            
 
         ! Wait for a command
-        SocketReceive clientSocket \Str:=receivedString \Time:=WAIT_MAX;
-        ParseMsg receivedString;
+        IF binaryMode THEN
+            ReceiveFrame;
+        ELSE
+            ReceiveMsg receivedString;
+            ParseMsg receivedString;
+        ENDIF
 	
         ! Execution of the command
         TEST instructionCode
@@ -434,6 +566,7 @@ PROC ServerMain()
                         BUFFER_POS := BUFFER_POS + 1;
                         bufferTargets{BUFFER_POS} := cartesianTarget;
                         bufferSpeeds{BUFFER_POS} := currentSpeed;
+                        bufferGO{BUFFER_POS} := -1;
                     ENDIF
                     ! Update Q orienatation
                     qOrientation{1} := params{4};
@@ -450,6 +583,7 @@ PROC ServerMain()
                         BUFFER_POS := BUFFER_POS + 1;
                         bufferTargets{BUFFER_POS} := cartesianTarget;
                         bufferSpeeds{BUFFER_POS} := currentSpeed;
+                        bufferGO{BUFFER_POS} := -1;
                     ENDIF
                     ok:=SERVER_OK;
                 ELSE
@@ -473,8 +607,14 @@ PROC ServerMain()
                 ENDIF
 
             CASE 33: !Execute moves in cartesianBuffer as linear moves NB: Circ buffer is 37
-                IF nParams = 0 OR nParams = 1 THEN
-                    IF nParams = 1 THEN
+                ! "33 #" moves, "33 1 #" extrudes. "33 e s n #" is one chunk of a longer path:
+                ! extrudes if e = 1, carries on from the previous chunk if s = 1 (no approach),
+                ! and is carried on by the next chunk if n = 1 (no fine stop or retract)
+                IF nParams = 0 OR nParams = 1 OR nParams = 3 THEN
+                    extrudeDuringBufferMove := nParams = 1 OR (nParams = 3 AND params{1} = 1);
+                    joinStart := nParams = 3 AND params{2} = 1;
+                    joinEnd := nParams = 3 AND params{3} = 1;
+                    IF extrudeDuringBufferMove AND NOT joinStart THEN
                         MoveL bufferTargets{1}, v100, fine, currentTool, \WObj:=currentWobj ;
                         SetDO DO10_2, 1;   
                         ! Ensure signal is synchronised
@@ -482,17 +622,24 @@ PROC ServerMain()
                     ENDIF
                     
                     FOR i FROM 1 TO (BUFFER_POS) DO 
-                        MoveL bufferTargets{i}, bufferSpeeds{i}, currentZone, currentTool, \WObj:=currentWobj ;
+                        IF bufferGO{i} >= 0 THEN
+                            ! Change the extrusion rate as the move starts
+                            TriggIO goTrigger, 0 \Start \GOp:=GO_Signal, bufferGO{i};
+                            TriggL bufferTargets{i}, bufferSpeeds{i}, goTrigger, currentZone, currentTool, \WObj:=currentWobj ;
+                        ELSE
+                            MoveL bufferTargets{i}, bufferSpeeds{i}, currentZone, currentTool, \WObj:=currentWobj ;
+                        ENDIF
                     ENDFOR			
 
-                    MoveL bufferTargets{(BUFFER_POS)}, bufferSpeeds{(BUFFER_POS)}, fine, currentTool, \WObj:=currentWobj ;
+                    IF NOT joinEnd THEN
+                        MoveL bufferTargets{(BUFFER_POS)}, bufferSpeeds{(BUFFER_POS)}, fine, currentTool, \WObj:=currentWobj ;
                     
-                    IF nParams = 1 THEN
-                        SetDO DO10_2, 0;
-                        MoveL RelTool(bufferTargets{(BUFFER_POS)},0,0,-5),v100,z1, currentTool, \WObj:=currentWobj ;
+                        IF extrudeDuringBufferMove THEN
+                            SetDO DO10_2, 0;
+                            MoveL RelTool(bufferTargets{(BUFFER_POS)},0,0,-5),v100,z1, currentTool, \WObj:=currentWobj ;
+                        ENDIF
                     ENDIF
                     
-                    
                     ok := SERVER_OK;
                 ELSE
                     ok:=SERVER_BAD_MSG;
@@ -550,6 +697,46 @@ PROC ServerMain()
                 ENDIF
                 
                 
+            CASE 38: !Add several positions to buffer, using qOrientation
+                ! Replies with the new buffer length, so the PC doesn't need to ask
+                IF nParams >= 3 AND nParams MOD 3 = 0 THEN
+                    jointsTarget := CJointT();
+                    externalAxis := jointsTarget.extax;
+                    ok := SERVER_OK;
+                    FOR i FROM 1 TO nParams STEP 3 DO
+                        cartesianTarget :=[[params{i},params{i+1},params{i+2}],
+                                            [qOrientation{1},qOrientation{2},qOrientation{3},qOrientation{4}],
+                                            [0,0,0,0],
+                                            externalAxis];
+                        IF BUFFER_POS < MAX_BUFFER THEN
+                            BUFFER_POS := BUFFER_POS + 1;
+                            bufferTargets{BUFFER_POS} := cartesianTarget;
+                            bufferSpeeds{BUFFER_POS} := currentSpeed;
+                            bufferGO{BUFFER_POS} := -1;
+                        ELSE
+                            ! Buffer full, position dropped
+                            ok := SERVER_BAD_MSG;
+                        ENDIF
+                    ENDFOR
+                    addString := NumToStr(BUFFER_POS,0);
+                ELSE
+                    ok:=SERVER_BAD_MSG;
+                ENDIF
+
+            CASE 39: !Truncate buffer to its first params{1} positions
+                ! Replies with the new buffer length
+                IF nParams = 1 THEN
+                    IF params{1} >= 0 AND params{1} <= BUFFER_POS THEN
+                        BUFFER_POS := params{1};
+                        ok := SERVER_OK;
+                    ELSE
+                        ok := SERVER_BAD_MSG;
+                    ENDIF
+                    addString := NumToStr(BUFFER_POS,0);
+                ELSE
+                    ok:=SERVER_BAD_MSG;
+                ENDIF
+
             CASE 40:  ! Find if position is reachable
                 ! NB: Not recommended for calling during operation, no error handling.
                 cartesianTarget :=[[params{1},params{2},params{3}],
@@ -565,14 +752,53 @@ PROC ServerMain()
                 
                 
                 
+            CASE 41: ! Find which poses in the buffer are reachable: "41 first last #"
+                ! Replies "<next> <index> <index> ..." with the unreachable indices, from
+                ! first to last, or until MAX_UNREACHABLE are found. The PC asks again
+                ! from <next> if it is not last + 1.
+                IF nParams = 2 THEN
+                    IF params{1} >= 1 AND params{1} <= params{2} + 1 AND params{2} <= BUFFER_POS THEN
+                        ok := SERVER_OK;
+                        checkIndex := params{1};
+                        unreachable := 0;
+                        addString := "";
+                        WHILE checkIndex <= params{2} AND unreachable < MAX_UNREACHABLE DO
+                            IF NOT CheckPositionReachable(bufferTargets{checkIndex}, currentTool, currentWobj) THEN
+                                addString := addString + " " + NumToStr(checkIndex,0);
+                                unreachable := unreachable + 1;
+                            ENDIF
+                            checkIndex := checkIndex + 1;
+                        ENDWHILE
+                        addString := NumToStr(checkIndex,0) + addString;
+                    ELSE
+                        ok := SERVER_BAD_MSG;
+                    ENDIF
+                ELSE
+                    ok := SERVER_BAD_MSG;
+                ENDIF
+
+            CASE 42: ! Protocol of the messages that follow: "42 1 #" binary frames (ReceiveFrame), "42 0 #" text
+                ! The reply is text either way
+                IF nParams = 1 THEN
+                    IF params{1} = 0 OR params{1} = 1 THEN
+                        binaryMode := params{1} = 1;
+                        ok := SERVER_OK;
+                    ELSE
+                        ok := SERVER_BAD_MSG;
+                    ENDIF
+                ELSE
+                    ok := SERVER_BAD_MSG;
+                ENDIF
+
             CASE 50: !Save current buffer into existing buffer
                 IF nParams = 1 THEN
-                    IF params{1} < MAX_SAVED_BUFFERS THEN
+                    IF params{1} >= 1 AND params{1} <= MAX_SAVED_BUFFERS THEN
                         ok := SERVER_OK;
                         TPWrite "Saved: ",\Num:=params{1};
                         FOR i FROM 1 TO BUFFER_POS DO
                             savedBufferTargets{params{1},i} := bufferTargets{i};
                             savedBufferSpeeds{params{1},i} := bufferSpeeds{i};
+                            savedBufferGO{params{1},i} := bufferGO{i};
                         ENDFOR
                         savedBufferPos{params{1}} := BUFFER_POS;
                     ELSE
@@ -585,12 +811,13 @@ PROC ServerMain()
                 
             CASE 51: !Load saved buffer into current buffer. Reset BUFFER_POS
                 IF nParams=1 THEN
-                    IF params{1} < MAX_SAVED_BUFFERS THEN
+                    IF params{1} >= 1 AND params{1} <= MAX_SAVED_BUFFERS THEN
                         ok:=SERVER_OK;
                         BUFFER_POS := savedBufferPos{params{1}};
                         FOR i FROM 1 TO BUFFER_POS DO
                             bufferTargets{i} := savedBufferTargets{params{1},i};
                             bufferSpeeds{i} := savedBufferSpeeds{params{1},i};
+                            bufferGO{i} := savedBufferGO{params{1},i};
                         ENDFOR
                     ELSE
                         ErrWrite "Buffer error", "Requested buffer does not exist";
@@ -638,6 +865,83 @@ PROC ServerMain()
                     ok := SERVER_BAD_MSG;
                 ENDIF
                 
+            CASE 55: ! Overwrite one position in the buffer, at the current speed
+                ! qOrientation is left as it is. Replies with the buffer length
+                IF nParams = 8 THEN
+                    IF params{1} >= 1 AND params{1} <= BUFFER_POS THEN
+                        jointsTarget := CJointT();
+                        externalAxis := jointsTarget.extax;
+                        bufferTargets{params{1}} :=[[params{2},params{3},params{4}],
+                                                    [params{5},params{6},params{7},params{8}],
+                                                    [0,0,0,0],
+                                                    externalAxis];
+                        bufferSpeeds{params{1}} := currentSpeed;
+                        bufferGO{params{1}} := -1;
+                        ok := SERVER_OK;
+                    ELSE
+                        ok := SERVER_BAD_MSG;
+                    ENDIF
+                    addString := NumToStr(BUFFER_POS,0);
+                ELSE
+                    ok := SERVER_BAD_MSG;
+                ENDIF
+                
+            CASE 56: ! Set the TCP speed and GO value of runs of poses: "56 first last v_tcp go ... #"
+                ! A GO value of -1 leaves GO_Signal as it is. Replies with the buffer length
+                IF nParams >= 4 AND nParams MOD 4 = 0 THEN
+                    ok := SERVER_OK;
+                    FOR i FROM 1 TO nParams STEP 4 DO
+                        IF params{i} >= 1 AND params{i} <= params{i+1} AND params{i+1} <= BUFFER_POS THEN
+                            FOR j FROM params{i} TO params{i+1} DO
+                                bufferSpeeds{j}.v_tcp := params{i+2};
+                                bufferGO{j} := params{i+3};
+                            ENDFOR
+                        ELSE
+                            ok := SERVER_BAD_MSG;
+                        ENDIF
+                    ENDFOR
+                    addString := NumToStr(BUFFER_POS,0);
+                ELSE
+                    ok := SERVER_BAD_MSG;
+                ENDIF
+                
+            CASE 60: ! Execute poses from the STREAM ring as they arrive, until the end of the stream
+                ! The PC keeps adding poses through STREAM while these are executed.
+                ! If the ring runs empty the robot waits, and stops at the last pose.
+                IF nParams = 0 THEN
+                    jointsTarget := CJointT();
+                    externalAxis := jointsTarget.extax;
+                    tempNum := 0;
+                    WHILE streamDone < streamAdded OR streamEndAt <> streamDone DO
+                        WaitUntil (streamDone < streamAdded AND streamHold = FALSE) OR streamEndAt = streamDone \PollRate:=0.04;
+                        ! STREAM waits for streamTaking to clear before dropping the ring (75)
+                        streamTaking := TRUE;
+                        IF streamDone < streamAdded AND streamHold = FALSE THEN
+                            tempNum := streamDone MOD STREAM_RING + 1;
+                            cartesianTarget := streamTargets{tempNum};
+                            cartesianTarget.extax := externalAxis;
+                            streamSpeed := streamSpeeds{tempNum};
+                            streamExtrudeOn := streamExtrude{tempNum};
+                            ! Copied, so STREAM may reuse the place while the robot moves
+                            streamDone := streamDone + 1;
+                            streamTaking := FALSE;
+                            IF streamExtrudeOn THEN
+                                TriggL cartesianTarget, streamSpeed, extrudeStart, currentZone, currentTool \WObj:=currentWobj;
+                            ELSE
+                                TriggL cartesianTarget, streamSpeed, extrudeStop, currentZone, currentTool \WObj:=currentWobj;
+                            ENDIF
+                        ENDIF
+                        streamTaking := FALSE;
+                    ENDWHILE
+                    IF tempNum > 0 THEN
+                        MoveL cartesianTarget, v100, fine, currentTool, \WObj:=currentWobj;
+                    ENDIF
+                    SetDO DO10_2, 0;
+                    streamEndAt := -1;
+                    ok := SERVER_OK;
+                ELSE
+                    ok := SERVER_BAD_MSG;
+                ENDIF
                 
             CASE 97: ! Change DO port 2
                 IF nParams = 1 THEN
@@ -698,6 +1002,8 @@ PROC ServerMain()
 				    sendString := NumToStr(instructionCode,0);
                     sendString := sendString + " " + NumToStr(ok,0);
                     sendString := sendString + " " + addString;
+                    ! Terminate the reply so the client can frame it
+                    sendString := sendString + " #";
                     SocketSend clientSocket \Str:=sendString;
 			    ENDIF
             ENDIF
@@ -25,27 +25,143 @@ targets can be passed as [[XYZ], [Quats]] OR [XYZ, Quats]
 '''
 
 import socket
+import struct
 import json 
 import time
-import inspect
-from threading import Thread
-from collections import deque
+import sys
+import itertools
+from collections import deque, namedtuple, OrderedDict
+from contextlib import contextmanager
 import logging
 
+try:
+    import abb_encoder
+except ImportError:                 # NumPy isn't installed
+    abb_encoder = None
+
 log = logging.getLogger(__name__)
 log.addHandler(logging.NullHandler())
+
+# Every reply from ServerMain ends with this character
+REPLY_END = b'#'
+
+# Instructions that only reply once the robot has finished moving,
+# so they are not subject to Robot.timeout
+MOTION_CODES = {'-1', '01', '02', '10', '11', '33', '34', '36', '37', '60'}
+
+# Skipped over when finding which function sent a command (for logging)
+SEND_FUNCTIONS = {'caller_name', 'send', 'send_command', 'send_async'}
+
+# Limits of ServerMain: RAPID strings hold 80 characters, and ParseMsg reads
+# at most MAX_PARAMS parameters. MAX_BUFFER is the size of bufferTargets,
+# saved buffers are numbered 1 to MAX_SAVED_BUFFERS
+MAX_MSG_LEN       = 80
+MAX_PARAMS        = 24
+MAX_BUFFER        = 512
+MAX_SAVED_BUFFERS = 20
+
+# How messages are sent on the motion socket (see Robot.set_protocol):
+#  - binary:  as binary frames (FRAME_HEADER) instead of text
+#  - max_len: longest message, None if only MAX_PARAMS limits it
+#  - *_specs: formats of poses (format_pose), positions (format_pos), 
+#             orientations (format_orient) and bulk positions (buffer_rows)
+Protocol = namedtuple('Protocol', ['binary', 'max_len', 'pose_specs', 
+                                   'position_specs', 'orientation_specs',
+                                   'bulk_specs'])
+
+# Text, read by ParseMsg: positions to 0.1 mm, quaternions to 1e-5
+TEXT   = Protocol(False, MAX_MSG_LEN, ["+08.1f"] * 3 + ["+08.5f"] * 4,
+                  ["08.1f"] * 3, ["08.5f"] * 4, [".1f"] * 3)
+# Binary frames, read by ReceiveFrame: every parameter is a float32 (a
+# RAPID num), so numbers are written to about that precision
+BINARY = Protocol(True, None, ["+.4f"] * 3 + ["+.8f"] * 4,
+                  [".4f"] * 3, [".8f"] * 4, [".4f"] * 3)
+
+# Instruction that switches the protocol, and the header of a binary frame:
+# instruction code (int8) and number of parameters (uint8), followed by 
+# the parameters as little-endian float32
+PROTOCOL_CODE = '42'
+FRAME_HEADER  = struct.Struct('<bB')
+
+# Instructions that change the buffers (or the speed and orientation that
+# are stored with new poses). If one fails, Robot.mirror is invalidated.
+BUFFER_CODES = {'08', '29', '30', '31', '38', '39', '50', '51', '53', '54', '55', '56'}
+
+# Instructions that set what ControllerState holds. If one fails,
+# Robot.state is invalidated.
+STATE_CODES = {'-1', '06', '07', '08', '09', '96', '97'}
+
+# Reachability results kept by Robot.reach_cache before it is emptied
+REACH_CACHE_SIZE = 100000
+
+# Zone data from the RAPID handbook: [pzone_tcp, pzone_ori, zone_ori]
+ZONES = {'z0'  : [.3,.3,.03], 
+         'z1'  : [1,1,.1], 
+         'z5'  : [5,8,.8], 
+         'z10' : [10,15,1.5], 
+         'z15' : [15,23,2.3], 
+         'z20' : [20,30,3], 
+         'z30' : [30,45,4.5], 
+         'z50' : [50,75,7.5], 
+         'z100': [100,150,15], 
+         'z200': [200,300,30]}
     
 class Robot:
     def __init__(self, 
                  ip          = '192.168.125.1', 
                  port_motion = 5000,
-                 port_logger = 5001):
+                 port_logger = 5001,
+                 telemetry   = False,
+                 port_stream = 5002,
+                 skip_redundant = True,
+                 binary      = False,
+                 buffer_cache = False,
+                 journal     = None):
+        '''
+        telemetry: stream pose and joint records from the LOGGER task on 
+                   port_logger in the background (see connect_logger)
+        port_stream: the STREAM task's port, used by streaming()
+        skip_redundant: don't send settings the controller already has
+                   (see ControllerState). Each setter also takes force=True.
+        binary: send binary frames rather than text, if the controller
+                   supports them (see set_protocol)
+        buffer_cache: keep paths uploaded by buffer_set in the saved 
+                   buffers, and load them instead of uploading them again
+                   (see BufferCache). True uses every slot, or give the 
+                   slot numbers it may use, leaving the rest for buffer_save.
+        journal: record every message sent on the motion socket, and every
+                   reply, to this file (or abb_journal.Journal), e.g. to
+                   replay a print against abb_emulator (see abb_journal)
+        '''
 
-        self.delay   = .08
+        self.timeout        = 5.0
+        self.motion_timeout = None
+        self.recv_buffer    = b''
+        self.stale_replies  = deque()   # Codes of commands that timed out, in order
+        self.window         = 1
+        self.in_flight      = deque()
+        self.logger         = None
+        self.stream         = None
+        self.port_stream    = port_stream
+        self.zone           = ZONES['z1']
+        self.speedVsFeedIdx = []
+        self.skip_redundant = skip_redundant
+        self.buffer_cache   = None
+        if buffer_cache is True:
+            self.buffer_cache = BufferCache(range(1, MAX_SAVED_BUFFERS + 1))
+        elif buffer_cache:
+            self.buffer_cache = BufferCache(buffer_cache)
+        self.journal        = journal
+        if journal is not None:
+            import abb_journal
+            if not isinstance(journal, abb_journal.Journal):
+                self.journal = abb_journal.Journal(journal)
 
         self.connect_motion((ip, port_motion))
-        #log_thread = Thread(target = self.get_net, 
-        #                    args   = ((ip, port_logger))).start()
+        if binary:
+            self.set_protocol(binary)
+        if telemetry:
+            self.connect_logger((ip, port_logger))
         
         self.set_units('millimeters', 'degrees')
         self.set_tool()
@@ -63,7 +179,8 @@ class Robot:
                 2   Enable, stay still    
         '''
         msg = '-1 ' + str(int(value)) + ' #'
-        self.send(msg)
+        self.state.invalidate()
+        self.send_command(msg)
 
     def connect_motion(self, remote):        
         log.info('Attempting to connect to robot motion server at %s', str(remote))
@@ -71,23 +188,109 @@ class Robot:
         self.sock.settimeout(2.5)
         self.sock.connect(remote)
         self.sock.settimeout(None)
+        self.remote = remote
+        if getattr(self, 'journal', None) is not None:
+            self.journal.session(remote)
+        # Nothing is known about the controller's buffers or settings yet
+        self.mirror = BufferMirror()
+        self.state  = ControllerState()
+        self.reach_cache = {}
+        if getattr(self, 'buffer_cache', None) is not None:
+            self.buffer_cache.clear()
+        # ServerMain reads text from every new client
+        self.protocol = TEXT
         log.info('Connected to robot motion server at %s', str(remote))
 
-    def connect_logger(self, remote, maxlen=None):
-        self.pose   = deque(maxlen=maxlen)
-        self.joints = deque(maxlen=maxlen)
+    def set_protocol(self, binary):
+        '''
+        Sends the messages that follow as binary frames (binary=True), or as
+        text. A binary frame holds each parameter as a float32, so positions
+        aren't rounded to 0.1 mm, and ServerMain unpacks it without parsing
+        text. Only MAX_PARAMS limits a frame, so bulk uploads ("38") take
+        fewer messages. Replies are text either way.
+        A SERVER.mod without instruction 42 refuses it, and text is kept.
+        Returns True if the protocol asked for is in use.
+        '''
+        protocol = BINARY if binary else TEXT
+        if protocol is self.protocol: return True
+        # Commands in flight were sent with the old protocol
+        self.flush()
+        data = self.send(PROTOCOL_CODE + " " + str(int(bool(binary))) + " #")
+        if data.split()[1:2] != [b'1']:
+            log.warn('Controller refused to change protocol, still sending %s: %s',
+                     'binary frames' if self.protocol.binary else 'text', data)
+            return False
+        self.protocol = protocol
+        log.info('Sending %s to robot motion server', 
+                 'binary frames' if binary else 'text')
+        return True
+
+    def connect_logger(self, remote, maxlen=10000):
+        '''
+        Starts streaming the robot's pose and joint angles from the LOGGER
+        task in a background thread, without using the motion socket.
+        The newest 'maxlen' records are kept in self.logger.poses and 
+        self.logger.joints (see abb_logger), e.g.
+            t, pose = R.logger.latest_pose()
+        '''
+        import abb_logger
+        if self.logger is not None: self.logger.stop()
+        self.logger = abb_logger.Logger(remote, maxlen).start()
+        return self.logger
+
+    def connect_stream(self, remote=None, window=8):
+        '''
+        Connects to the STREAM task, which takes poses for stream_execute
+        while the robot is moving (see abb_stream). By default it is on 
+        port_stream of the motion server's address.
+        '''
+        import abb_stream
+        if remote is None: remote = (self.remote[0], self.port_stream)
+        if self.stream is not None: self.stream.close()
+        self.stream = abb_stream.Streamer(remote, window, self.scale_linear).connect()
+        return self.stream
+
+    def stream_execute(self):
+        '''
+        Starts executing poses pushed to the STREAM task, and returns a 
+        PendingReply straight away. The robot keeps going, waiting whenever
+        it catches up with the PC, until the end of the stream is pushed.
+        ServerMain is busy until then, so don't send other commands (they 
+        would wait for the stream to end, and so would the PC).
+        '''
+        # DO10_2 follows the stream, and is off at the end
+        self.state.dio = (0.0,)
+        return self.send_async("60 #", caller='stream_execute')
+
+    @contextmanager
+    def streaming(self, remote=None, window=8):
+        '''
+        Executes poses as they are pushed, so the next path is uploaded 
+        while the current one is printed:
+        
+        with R.streaming() as S:
+            for layer in layers:
+                S.push(layer, extrude=True)
         
-        s = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        s.connect(remote)
-        s.setblocking(1)
+        S.push blocks while the controller's ring is full. Leaving the block
+        ends the stream and waits until the robot has finished.
+        '''
+        if self.stream is None or remote is not None:
+            self.connect_stream(remote, window)
+        self.stream.scale_linear = self.scale_linear
+        pending = self.stream_execute()
         try:
-            while True:
-                data = map(float, s.recv(4096).split())
-                if   int(data[1]) == 0: 
-                    self.pose.append([data[2:5], data[5:]])
-                #elif int(data[1]) == 1: self.joints.append([a[2:5], a[5:]])
-        finally:
-            s.shutdown(socket.SHUT_RDWR)
+            yield self.stream
+        except BaseException:
+            # Stop after the pose being executed
+            try:
+                self.stream.clear()
+                self.stream.end()
+                pending.result()
+            except Exception: pass
+            raise
+        self.stream.end()
+        pending.result()
 
     def set_units(self, linear, angular):
         units_l = {'millimeters': 1.0,
@@ -108,7 +311,7 @@ class Robot:
         else:
             msg  = "01 0 " + self.format_pose(pose)
 
-        return self.send(msg)
+        return self.send_command(msg)
 
     def set_joints(self, joints):
         '''
@@ -119,7 +322,7 @@ class Robot:
         msg = "02 "
         for joint in joints: msg += format(joint*self.scale_angle, "+08.2f") + " " 
         msg += "#" 
-        return self.send(msg)
+        return self.send_command(msg)
 
     def get_cartesian(self):
         '''
@@ -155,11 +358,11 @@ class Robot:
         ['24-53243', 'ROBOTWARE_5.12.1021.01', '2400/16 Type B']
         '''
         msg = "98 #"
-        data = str(self.send(msg))[5:].split('*')
+        data = self.send(msg).decode().split(' ', 2)[2].split('*')
         log.debug('get_robotinfo result: %s', str(data))
         return data
 
-    def set_tool(self, tool=[[0,0,0], [1,0,0,0]]):
+    def set_tool(self, tool=[[0,0,0], [1,0,0,0]], force=False):
         '''
         Sets the tool centerpoint (TCP) of the robot. 
         When you command a cartesian move, 
@@ -169,8 +372,8 @@ class Robot:
         tool flange center axis and the flange face.
         '''
         msg       = "06 " + self.format_pose(tool)    
-        self.send(msg)
         self.tool = tool
+        return self.send_setting('tool', msg, force)
 
     def load_json_tool(self, file_obj):
         if file_obj.__class__.__name__ == 'str':
@@ -182,15 +385,15 @@ class Robot:
         log.debug('get_tool returning: %s', str(self.tool))
         return self.tool
 
-    def set_workobject(self, work_obj=[[0,0,0],[1,0,0,0]]):
+    def set_workobject(self, work_obj=[[0,0,0],[1,0,0,0]], force=False):
         '''
         The workobject is a local coordinate frame you can define on the robot,
         then subsequent cartesian moves will be in this coordinate frame. 
         '''
         msg = "07 " + self.format_pose(work_obj)   
-        self.send(msg)
+        return self.send_setting('wobj', msg, force)
 
-    def set_speed(self, speed=[100,50,50,50]):
+    def set_speed(self, speed=[100,50,50,50], force=False):
         '''
         speed: [robot TCP linear speed (mm/s), TCP orientation speed (deg/s),
                 external axis linear, external axis orientation]
@@ -201,7 +404,8 @@ class Robot:
         msg += format(speed[1], "+08.2f") + " "  
         msg += format(speed[2], "+08.1f") + " " 
         msg += format(speed[3], "+08.2f") + " #"     
-        self.send(msg)
+        self.mirror.speed = tuple(message_params(msg))
+        return self.send_setting('speed', msg, force)
         
     def rotate_z(self, value):
         '''
@@ -209,35 +413,26 @@ class Robot:
         '''
         msg = "10 "
         msg += format(value, ".2f") + " #"
-        self.send(msg)
+        self.send_command(msg)
         
     def check_j6(self):
         '''
         Checks joint 6 value, and corrects if windup has occured
         '''
         msg = "11 #"
-        self.send(msg)
+        self.send_command(msg)
 
     def set_zone(self, 
                  zone_key     = 'z1', 
                  point_motion = False, 
-                 manual_zone  = []):
-        zone_dict = {'z0'  : [.3,.3,.03], 
-                    'z1'  : [1,1,.1], 
-                    'z5'  : [5,8,.8], 
-                    'z10' : [10,15,1.5], 
-                    'z15' : [15,23,2.3], 
-                    'z20' : [20,30,3], 
-                    'z30' : [30,45,4.5], 
-                    'z50' : [50,75,7.5], 
-                    'z100': [100,150,15], 
-                    'z200': [200,300,30]}
+                 manual_zone  = [],
+                 force        = False):
         '''
         Sets the motion zone of the robot. This can also be thought of as
         the flyby zone, AKA if the robot is going from point A -> B -> C,
         how close do we have to pass by B to get to C
         
-        zone_key: uses values from RAPID handbook (stored here in zone_dict)
+        zone_key: uses values from RAPID handbook (stored here in ZONES)
         with keys 'z*', you should probably use these
 
         point_motion: go to point exactly, and stop briefly before moving on
@@ -254,8 +449,8 @@ class Robot:
             zone = [0,0,0]
         elif len(manual_zone) == 3: 
             zone = manual_zone
-        elif zone_key in zone_dict.keys(): 
-            zone = zone_dict[zone_key]
+        elif zone_key in ZONES.keys(): 
+            zone = ZONES[zone_key]
         else: return False
         
         msg = "09 " 
@@ -263,15 +458,86 @@ class Robot:
         msg += format(zone[0], "+08.4f") + " " 
         msg += format(zone[1], "+08.4f") + " " 
         msg += format(zone[2], "+08.4f") + " #" 
-        self.send(msg)
+        self.zone = zone
+        return self.send_setting('zone', msg, force)
+
+    def simplify_path(self, pose_list, tolerance=None):
+        '''
+        Removes points from pose_list that are within tolerance (mm) of the
+        path through the others, so fewer poses are uploaded and blended.
+        By default the tolerance is the zone's pzone_tcp (e.g. 1mm for z1),
+        as the robot doesn't pass closer than that anyway.
+        Returns an abb_path.Simplified: the poses kept, which they were, how
+        many were removed and the largest deviation (needs NumPy).
+        '''
+        import abb_path
+        if tolerance is None: tolerance = self.zone[0]
+        result = abb_path.simplify(pose_list, tolerance)
+        log.debug('simplify_path removed %i poses, max deviation %.3f mm',
+                  result.removed, result.max_deviation)
+        return result
         
     def check_position(self, pose):
+        '''
+        Returns True if the robot can reach pose with the current tool and
+        work object (cached, see reach_key)
+        '''
         msg = "40 " + self.format_pose(pose)
-        retVal = self.send(msg)
-        if retVal[3] == 49:
-            return True
+        key = self.reach_key(message_params(msg))
+        if key in self.reach_cache: return self.reach_cache[key]
+        data = self.send(msg)
+        reachable = data.split()[1:2] == [b'1']
+        self.cache_reach(key, reachable)
+        return reachable
+
+    def reach_key(self, target):
+        '''
+        Key of reach_cache for a target (x, y, z, q1, q2, q3, q4) as sent,
+        so rounded as it is formatted: None if anything isn't known
+        '''
+        target = tuple(target)
+        if None in target or self.state.tool is None or self.state.wobj is None:
+            return None
+        return (self.state.tool, self.state.wobj, target)
+
+    def cache_reach(self, key, reachable):
+        if key is None: return
+        if len(self.reach_cache) >= REACH_CACHE_SIZE: self.reach_cache.clear()
+        self.reach_cache[key] = reachable
+
+    def buffer_check(self):
+        '''
+        Returns the indices (from 0) of the poses in the remote buffer that
+        the robot can't reach with the current tool and work object.
+        They are checked on the controller ("41"), many to a message. Poses
+        already checked with this tool and work object (e.g. a repeated
+        layer) are taken from reach_cache, and if every pose is known
+        nothing is sent.
+        '''
+        if self.mirror.known():
+            keys = [self.reach_key(target) for target in self.mirror.targets]
         else:
-            return False
+            keys = [None] * self.buffer_len(remote=True)
+        unknown = [i for i, key in enumerate(keys) if key not in self.reach_cache]
+        failing = [i for i, key in enumerate(keys) if self.reach_cache.get(key) is False]
+        if not unknown: return failing
+
+        first, last = unknown[0] + 1, unknown[-1] + 1
+        found = []
+        while first <= last:
+            data = self.send("41 %i %i #" % (first, last)).split()
+            if data[1:2] != [b'1']:
+                log.warn('buffer_check failed! reply: %s', data)
+                raise NameError('buffer_check failed!')
+            first  = int(float(data[2]))
+            found += [int(float(index)) - 1 for index in data[3:]]
+        checked = range(unknown[0], unknown[-1] + 1)
+        unreachable = set(found)
+        for i in checked:
+            self.cache_reach(keys[i], i not in unreachable)
+        failing = [i for i in failing if i not in checked] + found
+        log.debug('buffer_check: %i of %i poses unreachable', len(failing), len(keys))
+        return sorted(failing)
 
     def buffer_add(self, pose):
         '''
@@ -284,84 +550,352 @@ class Robot:
             msg = "30 " + self.format_pos(pose) 
         else:
             raise Exception("Unexpected pose length")
-        self.send(msg)
+        self.mirror.add(message_params(msg))
+        return self.send_command(msg)
 
     def buffer_set(self, pose_list):
         '''
-        Adds every pose in pose_list to the remote buffer
+        Makes the remote buffer hold every pose in pose_list.
+        Poses are packed several to a message (see pack_buffer). If the 
+        mirror knows what the buffer holds, only the poses that differ are
+        sent (see buffer_delta). The buffer length returned by the last 
+        message is checked at the end.
+        With buffer_cache, a path already in a saved buffer is loaded from
+        it (and offset if it was saved elsewhere) when that is fewer 
+        messages, and every path uploaded is saved (see BufferCache).
         '''
-        self.clear_buffer()
-        for pose in pose_list: 
-            self.buffer_add(pose)
-        if self.buffer_len() == len(pose_list):
-            log.debug('Successfully added %i poses to remote buffer', 
-                      len(pose_list))
+        rows     = self.buffer_rows(pose_list)
+        targets  = self.mirror.targets_for(rows)
+        messages = self.buffer_delta(rows, targets)
+        if not messages:
+            log.debug('Remote buffer already holds these %i poses', len(targets))
+            return True
+        key = None
+        if self.buffer_cache is not None:
+            key = self.buffer_cache.key(targets, self.mirror.speed)
+            if self.buffer_load_cached(key, targets, len(messages)):
+                return True
+        reply = None
+        for msg in messages:
+            if msg.startswith("29 "):
+                self.mirror.orientation = tuple(message_params(msg))
+            reply = self.send_command(msg)
+        if isinstance(reply, PendingReply): 
+            reply = reply.result()
+        if messages[-1] == "31 #": buffer_len = 0
+        else:                      buffer_len = int(float(reply.split()[2]))
+        if buffer_len == len(targets):
+            self.mirror.set(targets)
+            log.debug('Successfully sent %i messages for %i poses to remote buffer', 
+                      len(messages), len(targets))
+            if key is not None:
+                slot = self.buffer_cache.slot_for(key, self.mirror)
+                self.buffer_save(slot)
+                self.buffer_cache.add(key, slot, targets[0])
             return True
         else:
             log.warn('Failed to add poses to remote buffer!')
+            self.mirror.invalidate()
             self.clear_buffer()
             return False
+
+    def buffer_load_cached(self, key, targets, limit):
+        '''
+        Makes the remote buffer hold targets by loading the saved buffer 
+        that holds the same path (BufferCache key), then offsetting it by
+        the difference between their first targets (e.g. the same layer
+        higher up). Only done if it takes fewer than 'limit' messages.
+        Returns True if it was done.
+        '''
+        entry = self.buffer_cache.lookup(key, self.mirror)
+        if entry is None: return False
+        slot, first = entry
+        offset = [round(targets[0][i] - first[i], 4) for i in range(3)]
+        moved  = any(offset)
+        if 1 + moved >= limit: return False
+        self.buffer_load(slot)
+        if moved: self.buffer_offset(offset)
+        self.buffer_cache.hits += 1
+        log.debug('Loaded %i poses from saved buffer %i, offset by %s',
+                  len(targets), slot, str(offset))
+        return True
+
+    def buffer_delta(self, rows, targets):
+        '''
+        Returns the messages that make the remote buffer hold 'targets' 
+        (rows are the same poses, from buffer_rows). Whichever is fewer of:
+         - truncate ("39") to the poses that are already right, and add the rest
+         - overwrite ("55") the poses that differ, then truncate or add the rest
+        If the mirror doesn't know what the buffer holds, it is cleared and
+        everything is added.
+        '''
+        mirror = self.mirror
+        if not mirror.known():
+            return ["31 #"] + list(self.pack_rows(rows))
+        orient_msg = None
+        if None not in mirror.orientation:
+            orient_msg = "29 " + self.format_orient(mirror.orientation)
+        old    = mirror.targets
+        common = min(len(old), len(targets))
+        same   = [old[i] == targets[i] and mirror.speeds[i] == mirror.speed and
+                  mirror.gos[i] == -1 for i in range(common)]
+        first  = same.index(False) if False in same else common
+        if first == len(old) == len(targets): 
+            return []
+
+        resend = []
+        if first < len(old): resend.append("39 %i #" % first)
+        resend += self.pack_rows(rows[first:], orient_msg)
+
+        changed = [i for i in range(first, common) if not same[i]]
+        if any(None in targets[i] for i in changed): 
+            return resend
+        rest = []
+        if len(targets) < len(old): rest.append("39 %i #" % len(targets))
+        rest += self.pack_rows(rows[common:], orient_msg)
+        # Only formatted if it would be fewer messages
+        if len(changed) + len(rest) >= len(resend): 
+            return resend
+        return ["55 %i %s" % (i + 1, self.format_target(targets[i])) 
+                for i in changed] + rest
             
+    def pack_buffer(self, pose_list):
+        '''
+        Yields the messages that add pose_list to the remote buffer.
+        Positions are sent in bulk ("38"), as many as fit in one message.
+        Full poses [[XYZ], [Quats]] set the orientation ("29") first, 
+        whenever it differs from the previous pose.
+        Positions [XYZ] use the orientation already set on the controller.
+        pose_list may also be a NumPy array of shape (N, 7) or (N, 3).
+        With NumPy installed every pose is checked and formatted at once 
+        (abb_encoder), before anything is sent.
+        '''
+        return self.pack_rows(self.buffer_rows(pose_list))
+
+    def pack_rows(self, rows, orient_msg=None, code="38 "):
+        '''
+        Yields the messages that add rows (from buffer_rows) to the remote 
+        buffer, given the orientation message last sent (if known).
+        code is the instruction the positions are sent with.
+        '''
+        max_len = self.protocol.max_len
+        msg     = code
+        nParams = 0
+        for row_orient, fields in rows:
+            if row_orient is not None and row_orient != orient_msg:
+                if nParams > 0: 
+                    yield msg + "#"
+                    msg, nParams = code, 0
+                orient_msg = row_orient
+                yield orient_msg
+            if ((max_len is not None and len(msg) + len(fields) + 1 > max_len) or 
+                nParams + 3 > MAX_PARAMS):
+                yield msg + "#"
+                msg, nParams = code, 0
+            msg     += fields
+            nParams += 3
+        if nParams > 0:
+            yield msg + "#"
+
+    def buffer_rows(self, pose_list):
+        '''
+        Returns [(orientation message or None, "x y z "), ...], one for each
+        pose, formatted as they are sent to the buffer. Positions [XYZ] have
+        no orientation message.
+        '''
+        specs = self.protocol
+        if abb_encoder is not None:
+            return list(abb_encoder.buffer_rows(pose_list, self.scale_linear,
+                                                specs.bulk_specs,
+                                                specs.orientation_specs))
+        rows = []
+        for pose in pose_list:
+            if len(pose) == 2:
+                position   = pose[0]
+                orient_msg = "29 " + self.format_orient(pose[1])
+            elif len(pose) == 3:
+                position   = pose
+                orient_msg = None
+            else:
+                raise Exception("Unexpected pose length")
+            fields = ''
+            for cartesian, spec in zip(position, specs.bulk_specs):
+                fields += format(cartesian * self.scale_linear, spec) + " "
+            rows.append((orient_msg, fields))
+        return rows
+
+    def update_speed_matrix(self, matrix):
+        '''
+        Sets the [[TCP speed (mm/s), GO value], ...] table used to choose
+        the extruder's GO value for each speed (see buffer_set_planned)
+        '''
+        self.speedVsFeedIdx = matrix
+
+    def buffer_set_planned(self, pose_list, speed, accel=None):
+        '''
+        buffer_set, then gives each move its own TCP speed and GO value
+        (see abb_path.plan), so the extrusion rate follows the speed within
+        one buffer_execute, without set_speed or set_go in between.
+         - speed: TCP speed (mm/s), one value or one for each pose
+         - accel: with an acceleration (mm/s^2), corners are slowed to what
+           their blend (the current zone) allows
+        GO values come from the speed matrix (update_speed_matrix), if set.
+        '''
+        import abb_path
+        # Read once, as pose_list may be a generator
+        poses = abb_encoder.check_poses(pose_list)
+        if not self.buffer_set(poses): return False
+        plan = abb_path.plan(poses, speed, self.speedVsFeedIdx or None,
+                             self.zone[0], accel)
+        return self.buffer_set_speeds(plan.speeds, plan.go)
+
+    def buffer_set_speeds(self, speeds, go=None):
+        '''
+        Sets the TCP speed (mm/s) of the move to each pose in the remote 
+        buffer, and the GO value set as it starts (-1 or None leaves GO as
+        it is). Consecutive poses with the same values are sent together.
+        '''
+        values = [(format(v, ".1f"), -1 if g is None or g < 0 else int(round(g)))
+                  for v, g in zip(speeds, go if go is not None else [None] * len(speeds))]
+        runs   = []
+        for i, value in enumerate(values):
+            if runs and runs[-1][2] == value: runs[-1][1] = i + 1
+            else:                             runs.append([i + 1, i + 1, value])
+        reply   = None
+        max_len = self.protocol.max_len
+        msg, nParams = "56 ", 0
+        for first, last, (v, g) in runs:
+            fields = "%i %i %s %i " % (first, last, v, g)
+            if ((max_len is not None and len(msg) + len(fields) + 1 > max_len) or 
+                nParams + 4 > MAX_PARAMS):
+                reply = self.send_speeds(msg + "#")
+                msg, nParams = "56 ", 0
+            msg     += fields
+            nParams += 4
+        if nParams > 0:
+            reply = self.send_speeds(msg + "#")
+        if isinstance(reply, PendingReply):
+            reply = reply.result()
+        return reply is None or reply.split()[1:2] == [b'1']
+
+    def send_speeds(self, msg):
+        params = message_params(msg)
+        self.mirror.set_speeds([params[i:i + 4] for i in range(0, len(params), 4)])
+        return self.send_command(msg)
+
     def buffer_set_orientation(self, orientation):
         msg = "29 " + self.format_orient(orientation)
-        self.send(msg)
+        self.mirror.orientation = tuple(message_params(msg))
+        self.send_command(msg)
 
     def clear_buffer(self):
         msg = "31 #"
         data = self.send(msg)
-        if self.buffer_len() != 0:
-            log.warn('clear_buffer failed! buffer_len: %i', self.buffer_len())
+        if data.split()[1:2] != [b'1']:
+            log.warn('clear_buffer failed! reply: %s', data)
+            self.mirror.invalidate()
             raise NameError('clear_buffer failed!')
+        self.mirror.set([])
         return data
 
-    def buffer_len(self):
+    def buffer_len(self, remote=False):
         '''
-        Returns the length (number of poses stored) of the remote buffer
+        Returns the length (number of poses stored) of the remote buffer.
+        This is read from the mirror when it is known, or with remote=True
+        asked from the controller.
         '''
+        if self.mirror.known() and not remote:
+            return len(self.mirror.targets)
         msg = "32 #"
         data = self.send(msg).split()
         return int(float(data[2]))
 
-    def buffer_execute(self, extrudeOn = False):
+    def buffer_execute(self, extrudeOn = False, join_start = False, join_end = False):
         '''
         Immediately execute linear moves to every pose in the remote buffer.
          - passing True in will set DO_2 to high for length of movement (also moves up slightly afterwards)
+         - join_start: the buffer carries on from the one executed before it,
+           so the robot doesn't stop at its first pose to start extruding
+         - join_end: the buffer is carried on by the next one, so there is
+           no fine stop at its last pose, and extrusion stays on
         '''
-        if extrudeOn:
+        if join_start or join_end:
+            msg = "33 %i %i %i #" % (bool(extrudeOn), bool(join_start), bool(join_end))
+        elif extrudeOn:
             msg = "33 1 #"
         else:
             msg = "33 #"
-        return self.send(msg)
+        # 33 switches DO10_2 on, and off again unless joined to the next 
+        # buffer, and sets GO_Signal if any pose has a GO value
+        if extrudeOn: self.state.dio = (float(bool(join_end)),)
+        if not self.mirror.known() or any(go != -1 for go in self.mirror.gos):
+            self.state.go = None
+        return self.send_command(msg)
+
+    def execute_path(self, poses, extrude = False, chunk = MAX_BUFFER):
+        '''
+        Executes a path of any length, e.g. from a generator, 'chunk' poses
+        at a time (see path_chunks). Chunks are joined (see buffer_execute),
+        so the path is one continuous move: only the first chunk approaches 
+        and starts extruding, and only the last stops and retracts.
+        The robot may still slow down between chunks while the next one is
+        uploaded; streaming() avoids that.
+        Returns False (after stopping the path) if a chunk fails to upload.
+        '''
+        chunks   = path_chunks(poses, chunk)
+        current  = next(chunks, None)
+        joined   = False
+        while current is not None:
+            following = next(chunks, None)
+            if not self.buffer_set(current):
+                if joined: self.set_dio(0, force=True)
+                return False
+            self.buffer_execute(extrude, join_start = joined, 
+                                join_end = following is not None)
+            current, joined = following, True
+        return True
         
     def buffer_execute_circ(self):
         '''
         Execute buffer in circular motion - NB: Only two poses on here
         '''
         msg = "37 #"
-        return self.send(msg)
+        return self.send_command(msg)
         
     # BUFFER SAVE FUNCTIONS
     def buffer_save(self, bufferNum):
         '''
-        Saves buffer for future use
+        Saves buffer for future use, in slot 1 to MAX_SAVED_BUFFERS
         '''
+        if not 1 <= bufferNum <= MAX_SAVED_BUFFERS: return False
         msg = "50 "
         msg += format(bufferNum,"d") + " #"
-        return self.send(msg)
+        self.mirror.save(bufferNum)
+        if self.buffer_cache is not None: 
+            self.buffer_cache.forget(bufferNum)
+        return self.send_command(msg)
         
     def buffer_load(self, bufferNum):
         '''
         Loads saved buffer
         '''
+        if not 1 <= bufferNum <= MAX_SAVED_BUFFERS: return False
         msg = "51 "
         msg += format(bufferNum,"d") + " #"
-        return self.send(msg)
+        self.mirror.load(bufferNum)
+        return self.send_command(msg)
         
-    def buffer_read_value(self, value):
+    def buffer_read_value(self, value, remote=False):
         '''
         Reads specific position (value) from buffer
          - NB: Not zero-indexed, start from 1. Use -1 for final value
+        Read from the mirror when it knows the pose, otherwise (or with 
+        remote=True) from the controller, which rounds the reply.
         '''
+        if not remote:
+            pose = self.mirror.read(value)
+            if pose is not None: return pose
+        if value == -1: value = self.buffer_len(remote)
         msg = "52 "
         msg += format(value,"d") + " #"
         data = self.send(msg).split()
@@ -376,7 +910,8 @@ class Robot:
         msg += format(xyz[0], "+08.4f") + " "
         msg += format(xyz[1], "+08.4f") + " "
         msg += format(xyz[2], "+08.4f") + " #"
-        self.send(msg)
+        self.mirror.offset(message_params(msg))
+        self.send_command(msg)
         
     def buffer_modify_speed(self, value = 1):
         '''
@@ -384,7 +919,8 @@ class Robot:
         '''
         msg = "54 "
         msg += format(value, "+08.4f") + " #"
-        self.send(msg)
+        self.mirror.scale_speed(message_params(msg)[0])
+        self.send_command(msg)
         
 
     def set_external_axis(self, axis_values=[0,0]):
@@ -393,7 +929,7 @@ class Robot:
         for axis in axis_values:
             msg += format(axis, "+08.2f") + " " 
         msg += "#"   
-        return self.send(msg)
+        return self.send_command(msg)
 
     def move_circular(self, pose_onarc, pose_end):
         '''
@@ -408,75 +944,270 @@ class Robot:
         if data[1] != '1': 
             log.warn('move_circular incorrect response, bailing!')
             return False
-        return self.send(msg_1)
+        return self.send_command(msg_1)
 
-    def set_dio(self, value, id=0):
+    def set_dio(self, value, id=0, force=False):
         '''
         A function to set a physical DIO line on the robot.
         For this to work you're going to need to edit the RAPID function
         and fill in the DIO you want this to switch. 
         '''
         msg = '97 ' + str(int(bool(value))) + ' #'
-        self.send(msg)
-        return 
-        #return self.send(msg)
+        return self.send_setting('dio', msg, force)
         
-    def set_go(self, value):
+    def set_go(self, value, force=False):
         '''
         Function sets Group Output value to the one specified.
         Does not check if it is within limits
         '''
         msg = '96 ' + str(int(value)) + ' #'
-        self.send(msg)
-        return
+        return self.send_setting('go', msg, force)
+
+    def send_setting(self, name, msg, force=False):
+        '''
+        Sends a command that sets state.<name> to its parameters, unless
+        the controller is known to have them already (and skip_redundant
+        is on, and not force). Returns None if nothing was sent.
+        '''
+        params = tuple(message_params(msg))
+        if self.skip_redundant and not force and getattr(self.state, name) == params:
+            log.debug('Controller already has %s %s, not sending', name, str(params))
+            return None
+        setattr(self.state, name, params)
+        try:
+            return self.send_command(msg)
+        except Exception:
+            self.state.invalidate()
+            raise
         
     def send(self, message, wait_for_response=True):
         '''
         Send a formatted message to the robot socket.
         if wait_for_response, we wait for the response and return it
         '''
-        caller = inspect.stack()[1][3]
-        log.debug('%-14s sending: %s', caller, message)
-        self.sock.send(str.encode(message))
-        time.sleep(self.delay)
+        caller  = caller_name() if log.isEnabledFor(logging.DEBUG) else None
+        pending = self.send_async(message, wait_for_response, caller)
         if not wait_for_response: return
-        data = self.sock.recv(4096)
-        log.debug('%-14s recieved: %s', caller, data)
-        return data
+        return pending.result()
+
+    def send_command(self, message):
+        '''
+        Sends a command whose reply the caller doesn't need straight away.
+        Outside of pipelined mode this is the same as send. Inside it, the
+        command is queued and a PendingReply is returned without waiting.
+        '''
+        caller  = caller_name() if log.isEnabledFor(logging.DEBUG) else None
+        pending = self.send_async(message, caller=caller)
+        if self.window > 1: return pending
+        return pending.result()
+
+    def send_async(self, message, wait_for_response=True, caller=None):
+        '''
+        Sends a message without waiting for its reply, and returns a 
+        PendingReply. If 'window' commands are already in flight, waits for
+        the oldest reply first, so the server is never overrun.
+        '''
+        while len(self.in_flight) >= self.window:
+            self.resolve_next()
+        if self.protocol.binary: data = encode_frame(message)
+        else:                    data = str.encode(message)
+        pending = PendingReply(self, message.split(' ', 1)[0], caller)
+        if log.isEnabledFor(logging.DEBUG):
+            if caller is None: pending.caller = caller_name()
+            pending.sent_bytes = len(data)
+            pending.sent_time  = time.perf_counter()
+            log.debug('%-14s sending: %s', pending.caller, message)
+        self.sock.sendall(data)
+        if self.journal is not None:
+            self.journal.sent(data, wait_for_response)
+        if wait_for_response:
+            self.in_flight.append(pending)
+        else:
+            pending.done = True
+        return pending
+
+    def resolve_next(self):
+        '''
+        Waits for the reply to the oldest command in flight. Replies arrive
+        in the order the commands were sent, and each echoes its code.
+        Errors are stored on the PendingReply, and raised by its result().
+        '''
+        pending = self.in_flight.popleft()
+        if pending.code in MOTION_CODES: timeout = self.motion_timeout
+        else:                            timeout = self.timeout
+        try:
+            pending.reply = self.recv_reply(int(pending.code), timeout)
+            if self.journal is not None:
+                self.journal.received(pending.reply)
+            if pending.sent_time is not None:
+                log_command(pending)
+            if reply_code(pending.reply) != int(pending.code):
+                raise NameError('Reply out of order: expected %s, got %s' %
+                                (pending.code, pending.reply))
+        except Exception as e:
+            log.warn('No valid reply to %s: %s', pending.code, e)
+            if self.journal is not None and pending.reply is None:
+                self.journal.error(e)
+            pending.error = e
+        if pending.code in BUFFER_CODES and (pending.error is not None or 
+                                             pending.reply.split()[1:2] != [b'1']):
+            self.mirror.invalidate(speed = pending.code == '08')
+        if pending.error is not None or (pending.code in STATE_CODES and 
+                                         pending.reply.split()[1:2] != [b'1']):
+            self.state.invalidate()
+        pending.done = True
+        return pending
+
+    def flush(self):
+        '''
+        Waits for every command in flight, raising the first error found
+        '''
+        error = None
+        while self.in_flight:
+            pending = self.resolve_next()
+            if error is None: error = pending.error
+        if error is not None: raise error
+
+    @contextmanager
+    def pipelined(self, window=16):
+        '''
+        Keeps up to 'window' commands in flight on the motion socket.
+        Commands that don't return data (buffer_add, set_go, set_speed,
+        buffer_execute...) return a PendingReply instead of waiting. 
+        Queries (get_cartesian, buffer_len...) still wait and return data.
+        Every reply is collected before leaving the block.
+        
+        with R.pipelined():
+            for pose in path: R.buffer_add(pose)
+        '''
+        previous    = self.window
+        self.window = max(1, int(window))
+        try:
+            yield self
+        except BaseException:
+            self.window = previous
+            try:    self.flush()
+            except Exception: pass
+            raise
+        self.window = previous
+        self.flush()
+
+    def recv_reply(self, code, timeout=None):
+        '''
+        Reads from the motion socket until the complete reply to 'code' has
+        arrived, and returns it as b"<code> <ok> <payload>".
+        ServerMain terminates every reply with '#', so a reply split over
+        several packets, or several replies in one packet, are both handled.
+        Bytes after the terminator are kept for the next call.
+        timeout is in seconds, None waits forever (used for moves).
+        Replies come in the order commands were sent, so the late replies
+        of commands that timed out come first, and are dropped, even with
+        the same code as this one.
+        '''
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while True:
+            while REPLY_END not in self.recv_buffer:
+                if timeout is None:
+                    self.sock.settimeout(None)
+                else:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        self.stale_replies.append(code)
+                        raise socket.timeout('No reply to %i within %.2fs' % 
+                                             (code, timeout))
+                    self.sock.settimeout(remaining)
+                try:
+                    chunk = self.sock.recv(4096)
+                except socket.timeout:
+                    continue
+                if not chunk:
+                    raise ConnectionError('Robot closed the motion socket')
+                self.recv_buffer += chunk
+            reply, _, self.recv_buffer = self.recv_buffer.partition(REPLY_END)
+            reply = reply.strip()
+            # Late replies to commands that previously timed out are dropped
+            if self.stale_replies:
+                late = reply_code(reply)
+                if late in self.stale_replies:
+                    # Any owed before it never came
+                    while self.stale_replies.popleft() != late: pass
+                    log.warn('Discarding late reply: %s', reply)
+                    continue
+                # A reply to a later command: the rest never will come
+                self.stale_replies.clear()
+            return reply
         
     '''
     format_pose - formats entire pose for format [[x,y,z],[q1,q2,q3,q4]]
     format_pos - formats position [x,y,z]
     format_orient - formats orientation [q1,q2,q3,q4]
+    format_poses - format_pose for many poses at once (needs NumPy)
+    format_target - formats a mirrored buffer target (x, y, z, q1, q2, q3, q4)
+    Numbers are written as self.protocol's specs give
     '''
     def format_pose(self, pose):
-        pose = check_coordinates(pose)
-        msg  = ''
-        for cartesian in pose[0]:
-            msg += format(cartesian * self.scale_linear,  "+08.1f") + " " 
-        for quaternion in pose[1]:
-            msg += format(quaternion, "+08.5f") + " " 
+        pose  = check_coordinates(pose)
+        specs = self.protocol.pose_specs
+        msg   = ''
+        for cartesian, spec in zip(pose[0], specs[0:3]):
+            msg += format(cartesian * self.scale_linear, spec) + " " 
+        for quaternion, spec in zip(pose[1], specs[3:7]):
+            msg += format(quaternion, spec) + " " 
         msg += "#" 
         return msg    
 
     def format_pos(self, pose):
         msg = ''
-        for cartesian in pose:
-            msg += format(cartesian * self.scale_linear, "08.1f") + " "
+        for cartesian, spec in zip(pose, self.protocol.position_specs):
+            msg += format(cartesian * self.scale_linear, spec) + " "
         msg += "#"
         return msg
         
     def format_orient(self, pose):
         msg = ''
-        for quaternion in pose:
-            msg += format(quaternion, "08.5f") + " "
+        for quaternion, spec in zip(pose, self.protocol.orientation_specs):
+            msg += format(quaternion, spec) + " "
         msg += "#"
         return msg
         
+    def format_poses(self, pose_list):
+        '''
+        Formats every pose in pose_list at once, after checking them all.
+        Full poses (a list, or an array of shape (N, 7)) as format_pose,
+        positions (N, 3) as format_pos. A list mixing both is formatted a
+        pose at a time.
+        '''
+        if abb_encoder is not None and not hasattr(pose_list, 'shape'):
+            pose_list = list(pose_list)
+        if abb_encoder is None or abb_encoder.orientation_mask(pose_list) is not None:
+            return [self.format_pose(pose) if len(pose) != 3 else 
+                    self.format_pos(pose) for pose in pose_list]
+        poses = abb_encoder.check_poses(pose_list)
+        if poses.shape[1] == 3:
+            return abb_encoder.encode_positions(poses, self.scale_linear,
+                                                self.protocol.position_specs)
+        return abb_encoder.encode_poses(poses, self.scale_linear,
+                                        self.protocol.pose_specs)
+
+    def format_target(self, target):
+        msg = ''
+        for value, spec in zip(target, self.protocol.pose_specs):
+            msg += format(value, spec) + " "
+        msg += "#"
+        return msg
+
     def close(self):
-        self.send("99 #", False)
-        self.sock.shutdown(socket.SHUT_RDWR)
-        self.sock.close()
+        try:
+            if self.logger is not None: self.logger.stop()
+            if self.stream is not None: self.stream.close()
+            self.flush()
+            self.send("99 #", False)
+            self.sock.shutdown(socket.SHUT_RDWR)
+            self.sock.close()
+        finally:
+            # Even if closing failed, so the journal keeps the end of the session
+            if self.journal is not None: self.journal.close()
         log.info('Disconnected from ABB robot.')
 
     def __enter__(self):
@@ -485,6 +1216,319 @@ class Robot:
     def __exit__(self, type, value, traceback):
         self.close()
 
+class PendingReply:
+    '''
+    Reply to a command sent with Robot.send_async, or inside Robot.pipelined
+    '''
+    def __init__(self, robot, code, caller=None):
+        self.robot  = robot
+        self.code   = code
+        self.caller = caller
+        self.done   = False
+        self.reply  = None
+        self.error  = None
+        # Only filled in when DEBUG logging is on
+        self.sent_bytes = None
+        self.sent_time  = None
+
+    def result(self):
+        '''
+        Waits for the reply (and every reply before it) and returns it
+        '''
+        while not self.done:
+            self.robot.resolve_next()
+        if self.error is not None: raise self.error
+        return self.reply
+
+class ControllerState:
+    '''
+    Robot's copy of the controller's settings, as the parameters last sent
+    for each (floats, as ParseMsg reads them), so settings that wouldn't
+    change anything aren't sent (Robot.send_setting):
+     - tool:  currentTool.tframe (06)
+     - wobj:  currentWobj.oframe (07)
+     - speed: currentSpeed (08)
+     - zone:  currentZone (09)
+     - go:    GO_Signal (96)
+     - dio:   DO10_2 (97), also switched by buffer_execute and streams
+    Whatever isn't known is None: everything after connecting, 
+    reset_position, or any command failing.
+    '''
+    def __init__(self):
+        self.invalidate()
+
+    def invalidate(self):
+        self.tool  = None
+        self.wobj  = None
+        self.speed = None
+        self.zone  = None
+        self.go    = None
+        self.dio   = None
+
+
+class BufferMirror:
+    '''
+    Robot's copy of what the controller's buffers hold, updated as buffer
+    commands are sent, so the buffers can be read without asking and 
+    buffer_set only sends what changed.
+     - targets:     (x, y, z, q1, q2, q3, q4) of each pose in bufferTargets,
+                    in millimeters, as they were sent
+     - speeds:      (v_tcp, v_ori, v_leax, v_reax) of each pose in bufferSpeeds
+     - gos:         GO value of each pose in bufferGO (-1 for none)
+     - saved:       {slot: (targets, speeds, gos)} of the saved buffers
+     - speed:       currentSpeed, stored with each pose added
+     - orientation: qOrientation, used for poses added as positions
+    Whatever isn't known (e.g. anything from before connecting) is None. 
+    Targets and speeds are None until the buffer is cleared or set.
+    '''
+    UNKNOWN = (None, None, None, None)
+
+    def __init__(self):
+        self.targets     = None
+        self.speeds      = None
+        self.gos         = None
+        self.saved       = {}
+        self.speed       = None
+        self.orientation = self.UNKNOWN
+
+    def known(self):
+        return self.targets is not None
+
+    def invalidate(self, speed=False):
+        '''
+        Forgets the buffers, e.g. when a buffer command may or may not have
+        been carried out. currentSpeed is only forgotten if speed is True.
+        '''
+        current = self.speed
+        self.__init__()
+        if not speed: self.speed = current
+
+    def set(self, targets):
+        '''
+        The buffer has been set to 'targets', all at the current speed
+        '''
+        self.targets = list(targets)
+        self.speeds  = [self.speed] * len(self.targets)
+        self.gos     = [-1] * len(self.targets)
+
+    def targets_for(self, rows):
+        '''
+        Returns the targets the buffer will hold once rows (from 
+        Robot.buffer_rows) are added, starting from the current orientation
+        '''
+        orientation = self.orientation
+        parsed      = {}
+        targets     = []
+        for orient_msg, fields in rows:
+            if orient_msg is not None:
+                if orient_msg not in parsed:
+                    parsed[orient_msg] = tuple(message_params(orient_msg))
+                orientation = parsed[orient_msg]
+            targets.append(tuple(float(s) for s in fields.split()) + orientation)
+        return targets
+
+    def add(self, params):
+        '''
+        buffer_add ("30"), with the parameters it sent
+        '''
+        if len(params) == 7: self.orientation = tuple(params[3:7])
+        if not self.known(): return
+        if len(self.targets) < MAX_BUFFER:
+            self.targets.append(tuple(params[0:3]) + self.orientation)
+            self.speeds.append(self.speed)
+            self.gos.append(-1)
+
+    def offset(self, xyz):
+        if not self.known(): return
+        # Rounded as sent, so offset poses compare equal to the same poses
+        # sent again
+        self.targets = [tuple(round(t[i] + xyz[i], 4) for i in range(3)) + t[3:7]
+                        for t in self.targets]
+
+    def scale_speed(self, value):
+        if not self.known(): return
+        self.speeds = [None if s is None else (s[0] * value,) + s[1:4]
+                       for s in self.speeds]
+
+    def set_speeds(self, runs):
+        '''
+        buffer_set_speeds ("56"): [first, last, v_tcp, go] for each run
+        '''
+        if not self.known(): return
+        for first, last, v_tcp, go in runs:
+            for i in range(int(first) - 1, min(int(last), len(self.targets))):
+                speed = self.speeds[i]
+                self.speeds[i] = None if speed is None else (v_tcp,) + speed[1:4]
+                self.gos[i]    = go
+
+    def save(self, slot):
+        if self.known(): self.saved[slot] = (list(self.targets), list(self.speeds),
+                                             list(self.gos))
+        else:            self.saved.pop(slot, None)
+
+    def load(self, slot):
+        if slot in self.saved:
+            self.targets = list(self.saved[slot][0])
+            self.speeds  = list(self.saved[slot][1])
+            self.gos     = list(self.saved[slot][2])
+        else:
+            self.targets = self.speeds = self.gos = None
+
+    def read(self, index):
+        '''
+        Returns [[x,y,z], [q1,q2,q3,q4]] of pose 'index' (from 1, or -1 for
+        the last pose), or None if it isn't known
+        '''
+        if not self.known(): return None
+        if index == -1: index = len(self.targets)
+        if not 1 <= index <= len(self.targets): return None
+        target = self.targets[index - 1]
+        if None in target: return None
+        return [list(target[0:3]), list(target[3:7])]
+
+
+class BufferCache:
+    '''
+    Which paths buffer_set left in the saved buffers, so a path uploaded
+    before (e.g. the same infill or perimeter on another layer) is loaded
+    ("51", plus "53" to move it) instead of uploaded again.
+     - key:     a path's content, the same wherever it is: every target
+                relative to the first (rounded as BufferMirror.offset 
+                rounds), and the speed it is set at
+     - entries: {key: (slot, first target)}, least recently used first
+     - slots:   saved buffer numbers it may use. When they are all in 
+                use, the least recently used path is replaced.
+    Slots are only trusted while Robot.mirror knows what they hold, so 
+    anything that invalidates the mirror empties the cache too.
+    '''
+    def __init__(self, slots):
+        self.slots = [int(slot) for slot in slots]
+        if not all(1 <= slot <= MAX_SAVED_BUFFERS for slot in self.slots):
+            raise Exception("Saved buffers are numbered 1 to %i" % MAX_SAVED_BUFFERS)
+        self.entries = OrderedDict()
+        self.hits    = 0
+        self.misses  = 0
+
+    def clear(self):
+        self.entries.clear()
+
+    def key(self, targets, speed):
+        '''
+        Key of a path (targets as BufferMirror holds them), or None if 
+        anything about it isn't known
+        '''
+        if not targets or speed is None or None in targets[0]: return None
+        x, y, z = targets[0][0:3]
+        return (speed, tuple((round(t[0] - x, 4), round(t[1] - y, 4), 
+                              round(t[2] - z, 4)) + t[3:7] for t in targets))
+
+    def lookup(self, key, mirror):
+        '''
+        Returns (slot, first target) of the saved buffer holding the path
+        'key', or None
+        '''
+        if key is None: return None
+        self.prune(mirror)
+        entry = self.entries.get(key)
+        if entry is None:
+            self.misses += 1
+            return None
+        self.entries.move_to_end(key)
+        return entry
+
+    def slot_for(self, key, mirror):
+        '''
+        Slot to save a new path in: a free one, or the least recently used
+        '''
+        self.prune(mirror)
+        self.entries.pop(key, None)
+        used = set(slot for slot, first in self.entries.values())
+        free = [slot for slot in self.slots if slot not in used]
+        if free: return free[0]
+        return self.entries.popitem(last=False)[1][0]
+
+    def add(self, key, slot, first):
+        self.forget(slot)
+        self.entries[key] = (slot, tuple(first[0:3]))
+
+    def forget(self, slot):
+        '''
+        Drops whatever path 'slot' held, e.g. when buffer_save overwrites it
+        '''
+        for key in [k for k, entry in self.entries.items() if entry[0] == slot]:
+            del self.entries[key]
+
+    def prune(self, mirror):
+        for key in [k for k, entry in self.entries.items() 
+                    if entry[0] not in mirror.saved]:
+            del self.entries[key]
+
+def path_chunks(poses, size = MAX_BUFFER):
+    '''
+    Yields the poses of a path 'size' at a time, as lists. poses can be any
+    iterable (such as a generator), and is only read one chunk ahead. 
+    NumPy arrays are sliced instead.
+    '''
+    if hasattr(poses, 'shape'):
+        for start in range(0, len(poses), size):
+            yield poses[start:start + size]
+        return
+    poses = iter(poses)
+    while True:
+        chunk = list(itertools.islice(poses, size))
+        if not chunk: return
+        yield chunk
+
+def message_params(msg):
+    '''
+    Returns the parameters of a message such as "30 x y z #", as floats
+    '''
+    return [float(s) for s in msg.split()[1:-1]]
+
+def encode_frame(msg):
+    '''
+    Returns the binary frame (see FRAME_HEADER) of a message such as 
+    "30 x y z #", with the same instruction code and parameters
+    '''
+    fields = msg.split()
+    params = [float(s) for s in fields[1:-1]]
+    return (FRAME_HEADER.pack(int(fields[0]), len(params)) + 
+            struct.pack('<%if' % len(params), *params))
+
+def caller_name():
+    '''
+    Name of the first function outside of the send functions on the stack,
+    e.g. 'buffer_add'. Only used when DEBUG logging is on.
+    '''
+    frame = sys._getframe(1)
+    while frame.f_code.co_name in SEND_FUNCTIONS and frame.f_back is not None:
+        frame = frame.f_back
+    return frame.f_code.co_name
+
+def log_command(pending):
+    '''
+    Logs one DEBUG record per completed command. As well as the message,
+    each record carries these attributes, for handlers that want them:
+        opcode, caller, bytes_sent, bytes_received, latency (seconds)
+    '''
+    latency = time.perf_counter() - pending.sent_time
+    log.debug('%-14s recieved: %s (%.2f ms)', pending.caller, pending.reply,
+              latency * 1e3,
+              extra = {'opcode'         : pending.code,
+                       'caller'         : pending.caller,
+                       'bytes_sent'     : pending.sent_bytes,
+                       'bytes_received' : len(pending.reply),
+                       'latency'        : latency})
+
+def reply_code(reply):
+    '''
+    Returns the instruction code echoed at the start of a reply
+    '''
+    try:
+        return int(float(reply.split(None, 1)[0]))
+    except (IndexError, ValueError):
+        return None
+
 def check_coordinates(coordinates):
     if ((len(coordinates) == 2) and
         (len(coordinates[0]) == 3) and 
@@ -0,0 +1,447 @@
+'''
+David Pollard
+
+FARSCOPE CDT
+Bristol Robotics Laboratory
+
+abb_async.py
+ - asyncio version of abb.Robot, for driving the robot from an event loop
+ - Same functions as abb.Robot, but every call is a coroutine
+ - Several tasks can send commands at once: they are pipelined on the
+   motion socket, and replies are matched to commands in order
+ - Per-call timeouts, cancellation and automatic reconnection
+
+Released under the MIT License
+
+Example:
+    async with abb_async.Robot('127.0.0.1') as R:
+        await R.buffer_set(path)
+        await R.buffer_execute(True)
+
+'''
+
+import asyncio
+import logging
+from collections import deque
+
+import abb
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Marker for "use the default timeout for this instruction"
+DEFAULT = object()
+
+
+class Robot:
+    def __init__(self,
+                 ip          = '192.168.125.1',
+                 port_motion = 5000,
+                 window      = 16,
+                 reconnect   = True):
+        '''
+        Nothing is sent until connect() is awaited (or the robot is used in
+        an 'async with' block).
+         - window: maximum number of commands in flight at once
+         - reconnect: if the connection drops, reconnect on the next command.
+           Commands in flight when it dropped fail with ConnectionError,
+           and are not resent.
+        '''
+        self.remote         = (ip, port_motion)
+        self.timeout        = 5.0
+        self.motion_timeout = None
+        self.connect_timeout     = 2.5
+        self.reconnect           = reconnect
+        self.reconnect_attempts  = 10
+        self.reconnect_delay     = 0.5
+
+        self.window      = window
+        self.reader      = None
+        self.writer      = None
+        self.reader_task = None
+        self.in_flight   = deque()
+        self.slots       = None
+        self.order       = None
+        self.connecting  = None
+        self.connected   = False
+        self.tool        = [[0,0,0],[1,0,0,0]]
+
+        self.set_units('millimeters', 'degrees')
+
+    async def connect(self):
+        '''
+        Connects, and sets the same defaults as abb.Robot does
+        '''
+        await self.connect_motion()
+        await self.set_tool()
+        await self.set_workobject()
+        await self.set_speed()
+        await self.set_zone()
+        return self
+
+    async def connect_motion(self):
+        '''
+        Opens the motion socket, retrying while ServerMain restarts its
+        accept loop (it waits 0.5s between attempts after ERR_SOCK_CLOSED)
+        '''
+        if self.connecting is None:
+            self.connecting = asyncio.ensure_future(self._connect())
+        try:
+            await asyncio.shield(self.connecting)
+        finally:
+            if self.connecting is not None and self.connecting.done():
+                self.connecting = None
+
+    async def _connect(self):
+        for attempt in range(self.reconnect_attempts):
+            log.info('Attempting to connect to robot motion server at %s',
+                     str(self.remote))
+            try:
+                self.reader, self.writer = await asyncio.wait_for(
+                    asyncio.open_connection(*self.remote),
+                    self.connect_timeout)
+                break
+            except (OSError, asyncio.TimeoutError) as e:
+                log.warn('Connection attempt %i failed: %s', attempt + 1, e)
+                if attempt + 1 == self.reconnect_attempts: raise
+                await asyncio.sleep(self.reconnect_delay)
+        self.slots       = asyncio.Semaphore(self.window)
+        self.order       = asyncio.Lock()
+        self.connected   = True
+        self.reader_task = asyncio.ensure_future(self._read_replies(
+                                                    self.reader, self.slots))
+        log.info('Connected to robot motion server at %s', str(self.remote))
+
+    async def _read_replies(self, reader, slots):
+        '''
+        Background task: completes each command in flight with its reply.
+        Replies arrive in the order commands were sent, ending in '#'.
+        '''
+        try:
+            while True:
+                data  = await reader.readuntil(abb.REPLY_END)
+                reply = data[:-1].strip()
+                if not self.in_flight:
+                    log.warn('Unexpected reply: %s', reply)
+                    continue
+                code, future = self.in_flight.popleft()
+                slots.release()
+                log.debug('recieved: %s', reply)
+                if future.done():
+                    continue    # Caller was cancelled or timed out
+                if abb.reply_code(reply) != int(code):
+                    future.set_exception(NameError(
+                        'Reply out of order: expected %s, got %s' % (code, reply)))
+                else:
+                    future.set_result(reply)
+        except (asyncio.IncompleteReadError, ConnectionError, OSError) as e:
+            log.warn('Lost connection to robot: %s', e)
+            self._drop_connection(slots, ConnectionError('Lost connection to robot'))
+        except asyncio.CancelledError:
+            self._drop_connection(slots, ConnectionError('Connection closed'))
+            raise
+
+    def _drop_connection(self, slots, error):
+        '''
+        Fails every command in flight. Their slots are released so that
+        commands waiting for a slot wake up and fail too.
+        '''
+        self.connected = False
+        while self.in_flight:
+            code, future = self.in_flight.popleft()
+            slots.release()
+            if not future.done(): future.set_exception(error)
+        if self.writer is not None:
+            self.writer.close()
+        self.writer = None
+
+    async def send(self, message, timeout=DEFAULT):
+        '''
+        Sends a formatted message and waits for its reply.
+        timeout is in seconds (None waits forever); by default moves wait
+        motion_timeout, and everything else waits timeout.
+        Cancelling the call, or timing out, doesn't disturb the replies to
+        other commands: the late reply is read and dropped.
+        Timing out doesn't stop the robot, the command still completes.
+        The timeout includes waiting for a slot in the window.
+        '''
+        return (await self.send_all([message], timeout))[0]
+
+    async def send_all(self, messages, timeout=DEFAULT):
+        '''
+        Sends formatted messages in order, with no other task's commands
+        between them, and returns their replies. Each message waits for its
+        own slot in the window, so they are pipelined as send's are.
+        timeout covers all of them; by default it is motion_timeout if any
+        message is a move, and timeout otherwise.
+        '''
+        if timeout is DEFAULT:
+            if any(message.split(' ', 1)[0] in abb.MOTION_CODES for message in messages):
+                timeout = self.motion_timeout
+            else:
+                timeout = self.timeout
+        return await asyncio.wait_for(self._send_all(messages), timeout)
+
+    async def _send_all(self, messages):
+        if not self.connected:
+            if self.reader_task is not None and not self.reconnect:
+                raise ConnectionError('Not connected to robot')
+            await self.connect_motion()
+        futures = []
+        async with self.order:
+            for message in messages:
+                futures.append(await self._submit(message))
+        return [await future for future in futures]
+
+    async def _submit(self, message):
+        '''
+        Waits for a slot, then writes message. Returns the future of its
+        reply. Only called holding self.order, so messages are written in
+        the order they are submitted.
+        '''
+        slots = self.slots
+        await slots.acquire()
+        if not self.connected or slots is not self.slots:
+            slots.release()
+            raise ConnectionError('Lost connection to robot')
+        future = asyncio.get_running_loop().create_future()
+        # No await between queueing and writing, so order always matches
+        self.in_flight.append((message.split(' ', 1)[0], future))
+        log.debug('sending: %s', message)
+        self.writer.write(str.encode(message))
+        await self.writer.drain()
+        return future
+
+    async def close(self):
+        if self.connected:
+            self.writer.write(b"99 #")
+            await self.writer.drain()
+        if self.reader_task is not None:
+            self.reader_task.cancel()
+            try:    await self.reader_task
+            except asyncio.CancelledError: pass
+        self.reconnect = False
+        log.info('Disconnected from ABB robot.')
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, type, value, traceback):
+        await self.close()
+
+    #
+    # Formatting is shared with abb.Robot
+    #
+    protocol      = abb.TEXT
+    set_units     = abb.Robot.set_units
+    format_pose   = abb.Robot.format_pose
+    format_pos    = abb.Robot.format_pos
+    format_orient = abb.Robot.format_orient
+    pack_buffer   = abb.Robot.pack_buffer
+    buffer_rows   = abb.Robot.buffer_rows
+    pack_rows     = abb.Robot.pack_rows
+    format_poses  = abb.Robot.format_poses
+
+    #
+    # Robot functions, see abb.Robot for details
+    #
+    async def reset_position(self, value = 0):
+        msg = '-1 ' + str(int(value)) + ' #'
+        return await self.send(msg)
+
+    async def set_cartesian(self, pose, fineMotion = False, timeout=DEFAULT):
+        if fineMotion == True:
+            msg  = "01 1 " + self.format_pose(pose)
+        else:
+            msg  = "01 0 " + self.format_pose(pose)
+        return await self.send(msg, timeout)
+
+    async def set_joints(self, joints, timeout=DEFAULT):
+        if len(joints) != 6: return False
+        msg = "02 "
+        for joint in joints: msg += format(joint*self.scale_angle, "+08.2f") + " "
+        msg += "#"
+        return await self.send(msg, timeout)
+
+    async def get_cartesian(self):
+        data = (await self.send("03 #")).split()
+        r = [float(s) for s in data]
+        return [r[2:5], r[5:9]]
+
+    async def get_joints(self):
+        data = (await self.send("04 #")).split()
+        return [float(s) / self.scale_angle for s in data[2:8]]
+
+    async def get_external_axis(self):
+        data = (await self.send("05 #")).split()
+        return [float(s) for s in data[2:8]]
+
+    async def get_robotinfo(self):
+        data = (await self.send("98 #")).decode().split(' ', 2)[2].split('*')
+        return data
+
+    async def set_tool(self, tool=[[0,0,0], [1,0,0,0]]):
+        msg = "06 " + self.format_pose(tool)
+        await self.send(msg)
+        self.tool = tool
+
+    def get_tool(self):
+        return self.tool
+
+    async def set_workobject(self, work_obj=[[0,0,0],[1,0,0,0]]):
+        msg = "07 " + self.format_pose(work_obj)
+        return await self.send(msg)
+
+    async def set_speed(self, speed=[100,50,50,50]):
+        if len(speed) != 4: return False
+        msg = "08 "
+        msg += format(speed[0], "+08.1f") + " "
+        msg += format(speed[1], "+08.2f") + " "
+        msg += format(speed[2], "+08.1f") + " "
+        msg += format(speed[3], "+08.2f") + " #"
+        return await self.send(msg)
+
+    async def rotate_z(self, value, timeout=DEFAULT):
+        msg = "10 " + format(value, ".2f") + " #"
+        return await self.send(msg, timeout)
+
+    async def check_j6(self, timeout=DEFAULT):
+        return await self.send("11 #", timeout)
+
+    async def set_zone(self,
+                       zone_key     = 'z1',
+                       point_motion = False,
+                       manual_zone  = []):
+        if point_motion:
+            zone = [0,0,0]
+        elif len(manual_zone) == 3:
+            zone = manual_zone
+        elif zone_key in abb.ZONES.keys():
+            zone = abb.ZONES[zone_key]
+        else: return False
+        msg = "09 "
+        msg += str(int(point_motion)) + " "
+        msg += format(zone[0], "+08.4f") + " "
+        msg += format(zone[1], "+08.4f") + " "
+        msg += format(zone[2], "+08.4f") + " #"
+        return await self.send(msg)
+
+    async def check_position(self, pose):
+        data = (await self.send("40 " + self.format_pose(pose))).split()
+        return int(data[1]) == 1
+
+    async def buffer_add(self, pose):
+        if len(pose)==2:
+            msg = "30 " + self.format_pose(pose)
+        elif len(pose)==3:
+            msg = "30 " + self.format_pos(pose)
+        else:
+            raise Exception("Unexpected pose length")
+        return await self.send(msg)
+
+    async def buffer_set(self, pose_list):
+        '''
+        Adds every pose in pose_list to the remote buffer.
+        The buffer is cleared and every message sent in order (send_all),
+        before waiting for any reply, with no other task's commands between.
+        pose_list may be any iterable of poses, e.g. a generator.
+        '''
+        rows     = self.buffer_rows(pose_list)
+        messages = list(self.pack_rows(rows))
+        replies  = await self.send_all(["31 #"] + messages)
+        if not messages: return True
+        if int(float(replies[-1].split()[2])) == len(rows):
+            log.debug('Successfully added %i poses to remote buffer',
+                      len(rows))
+            return True
+        log.warn('Failed to add poses to remote buffer!')
+        await self.clear_buffer()
+        return False
+
+    async def buffer_set_orientation(self, orientation):
+        return await self.send("29 " + self.format_orient(orientation))
+
+    async def clear_buffer(self):
+        data = await self.send("31 #")
+        buffer_len = await self.buffer_len()
+        if buffer_len != 0:
+            log.warn('clear_buffer failed! buffer_len: %i', buffer_len)
+            raise NameError('clear_buffer failed!')
+        return data
+
+    async def buffer_len(self):
+        data = (await self.send("32 #")).split()
+        return int(float(data[2]))
+
+    async def buffer_execute(self, extrudeOn = False, join_start = False,
+                             join_end = False, timeout=DEFAULT):
+        if join_start or join_end:
+            msg = "33 %i %i %i #" % (bool(extrudeOn), bool(join_start), bool(join_end))
+        elif extrudeOn:
+            msg = "33 1 #"
+        else:
+            msg = "33 #"
+        return await self.send(msg, timeout)
+
+    async def execute_path(self, poses, extrude = False, chunk = abb.MAX_BUFFER):
+        chunks  = abb.path_chunks(poses, chunk)
+        current = next(chunks, None)
+        joined  = False
+        while current is not None:
+            following = next(chunks, None)
+            if not await self.buffer_set(current):
+                if joined: await self.set_dio(0)
+                return False
+            await self.buffer_execute(extrude, join_start = joined,
+                                      join_end = following is not None)
+            current, joined = following, True
+        return True
+
+    async def buffer_execute_circ(self, timeout=DEFAULT):
+        return await self.send("37 #", timeout)
+
+    async def buffer_save(self, bufferNum):
+        return await self.send("50 " + format(bufferNum,"d") + " #")
+
+    async def buffer_load(self, bufferNum):
+        return await self.send("51 " + format(bufferNum,"d") + " #")
+
+    async def buffer_read_value(self, value):
+        data = (await self.send("52 " + format(value,"d") + " #")).split()
+        r = [float(s) for s in data]
+        return [r[2:5], r[5:9]]
+
+    async def buffer_offset(self, xyz):
+        msg = "53 "
+        msg += format(xyz[0], "+08.4f") + " "
+        msg += format(xyz[1], "+08.4f") + " "
+        msg += format(xyz[2], "+08.4f") + " #"
+        return await self.send(msg)
+
+    async def buffer_modify_speed(self, value = 1):
+        return await self.send("54 " + format(value, "+08.4f") + " #")
+
+    async def set_external_axis(self, axis_values=[0,0], timeout=DEFAULT):
+        if len(axis_values) != 2: return False
+        msg = "34 "
+        for axis in axis_values:
+            msg += format(axis, "+08.2f") + " "
+        msg += "#"
+        return await self.send(msg, timeout)
+
+    async def move_circular(self, pose_onarc, pose_end, timeout=DEFAULT):
+        data = (await self.send("35 " + self.format_pose(pose_onarc))).split()
+        if data[1] != b'1':
+            log.warn('move_circular incorrect response, bailing!')
+            return False
+        return await self.send("36 " + self.format_pose(pose_end), timeout)
+
+    async def set_dio(self, value, id=0):
+        return await self.send('97 ' + str(int(bool(value))) + ' #')
+
+    async def set_go(self, value):
+        return await self.send('96 ' + str(int(value)) + ' #')
+
+
+if __name__ == '__main__':
+    print("abb_async is a library, see the example at the top of the file")
@@ -0,0 +1,466 @@
+'''
+David Pollard
+
+FARSCOPE CDT
+Bristol Robotics Laboratory
+
+abb_benchmark.py
+ - Benchmarks for abb.py and abb_testing.py, run against abb_emulator
+   so no robot is needed. The emulator replies at once, so the times
+   measured are the PC side's own (plus the local socket).
+ - send:          Robot.send commands per second, and latency percentiles
+ - overhead:      per-command cost of send's instrumentation, compared
+                  with the old inspect.stack() version
+ - journal:       per-command cost of Robot(journal=...), the journal's
+                  size, and replaying it as fast as possible
+ - buffer_set:    time to upload 64, 256 and 512 poses, and to change one
+ - buffer_cache:  uploading the same two paths on every layer, with and
+                  without Robot(buffer_cache=True): messages, and time with
+                  no latency and with 1 ms per command
+ - protocol:      uploading 512 poses as text and as binary frames
+                  (time, messages and bytes)
+ - settings:      the same speed, zone, GO and work object before every
+                  buffer, sent each time and skipped (ControllerState)
+ - format_pose:   cost of formatting one pose, alone and in a batch
+                  (format_poses)
+ - stream:        printing layers one buffer_set/buffer_execute at a time,
+                  against streaming them (upload overlapped with motion),
+                  on an emulator with per-command latency and motion time
+ - sim_record:    abb_testing.Robot recording 10k - 1M segment toolpaths (time, MB)
+ - sim_render:    abb_testing.Robot.show_motions drawing the same toolpaths
+ - sim_time:      abb_testing.Robot.print_time estimating the same toolpaths
+ - Results are written as JSON, so runs can be compared across commits
+
+Released under the MIT License
+
+Run with:
+    python abb_benchmark.py                        # Everything, JSON to stdout
+    python abb_benchmark.py -o results.json send buffer_set
+    python abb_benchmark.py --quick                # Smaller sizes
+
+'''
+
+import os
+import sys
+import math
+import time
+import json
+import socket
+import inspect
+import logging
+import platform
+import tempfile
+import argparse
+import subprocess
+import warnings
+import contextlib
+
+import abb
+import abb_emulator
+import abb_journal
+
+
+SEGMENTS       = [10000, 100000, 1000000]
+QUICK_SEGMENTS = [1000, 10000]
+BUFFER_SIZES   = [64, 256, 512]
+
+
+class LegacyRobot(abb.Robot):
+    '''
+    abb.Robot with the instrumentation send used to have: inspect.stack()
+    for the caller's name on every command, even with logging off
+    '''
+    def send(self, message, wait_for_response=True):
+        caller  = inspect.stack()[1][3]
+        pending = self.send_async(message, wait_for_response, caller)
+        if not wait_for_response: return
+        return pending.result()
+
+    def send_command(self, message):
+        return self.send(message)
+
+
+def connect(emulator, cls = abb.Robot):
+    R = cls('127.0.0.1', emulator.port)
+    R.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return R
+
+
+def percentiles(samples, points = (50, 90, 99)):
+    samples = sorted(samples)
+    return {'p%i' % p: samples[min(len(samples) - 1, len(samples) * p // 100)]
+            for p in points}
+
+
+def bench_send(emulator, n = 5000, quick = False):
+    '''
+    Sequential set_go commands: rate, and latency percentiles (us).
+    Also the rate with pipelined(16).
+    '''
+    if quick: n = n // 5
+    R = connect(emulator)
+    latencies = []
+    for i in range(n):
+        start = time.perf_counter()
+        R.set_go(i % 256)
+        latencies.append((time.perf_counter() - start) * 1e6)
+    result = {'commands': n,
+              'commands_per_s': n / (sum(latencies) / 1e6),
+              'latency_us': percentiles(latencies)}
+
+    start = time.perf_counter()
+    with R.pipelined(16):
+        for i in range(n):
+            R.set_go(i % 256)
+    result['pipelined_commands_per_s'] = n / (time.perf_counter() - start)
+    R.close()
+    return result
+
+
+def bench_overhead(emulator, n = 5000, quick = False):
+    '''
+    Mean time per command (us), for the old and current instrumentation
+    '''
+    if quick: n = n // 5
+    abb_log = logging.getLogger('abb')
+    level   = abb_log.level
+    result  = {}
+    for name, cls, debug in [('inspect_stack_old', LegacyRobot, False),
+                             ('logging_off',       abb.Robot,   False),
+                             ('logging_debug',     abb.Robot,   True)]:
+        abb_log.setLevel(logging.DEBUG if debug else logging.WARNING)
+        R = connect(emulator, cls)
+        for i in range(n // 10): R.set_go(0)           # Warm up
+        start = time.perf_counter()
+        for i in range(n):
+            R.set_go(i % 256)
+        result[name + '_us'] = (time.perf_counter() - start) / n * 1e6
+        R.close()
+    abb_log.setLevel(level)
+    return result
+
+
+def bench_journal(emulator, n = 5000, quick = False):
+    '''
+    Mean time per set_go (us) without and with a journal, the journal's
+    bytes per command, and the rate it is replayed at (commands per s)
+    '''
+    if quick: n = n // 5
+    result = {}
+    with tempfile.TemporaryDirectory() as folder:
+        filename = folder + '/bench.journal'
+        for name, journal in [('off', None), ('on', filename)]:
+            R = abb.Robot('127.0.0.1', emulator.port, journal = journal)
+            R.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            start = time.perf_counter()
+            for i in range(n):
+                R.set_go(i % 256)
+            result[name + '_us'] = (time.perf_counter() - start) / n * 1e6
+            R.close()
+        replay = abb_journal.replay(filename, (emulator.host, emulator.port))
+        if replay.divergent: raise Exception("replay diverged")
+        result['bytes_per_command']     = os.path.getsize(filename) / replay.messages
+        result['replay_commands_per_s'] = replay.rate
+    return result
+
+
+def bench_settings(emulator, n = 1000, quick = False):
+    '''
+    Time (ms) for n rounds of set_speed, set_zone, set_go and
+    set_workobject with the values the controller already has
+    '''
+    if quick: n = n // 5
+    result = {}
+    for name, skip in [('sent', False), ('skipped', True)]:
+        R = connect(emulator)
+        R.skip_redundant = skip
+        start = time.perf_counter()
+        for i in range(n):
+            R.set_speed([20, 50, 50, 50])
+            R.set_zone('z1')
+            R.set_go(40)
+            R.set_workobject()
+        result[name + '_ms'] = (time.perf_counter() - start) * 1e3
+        R.close()
+    return result
+
+
+def bench_buffer_set(emulator, repeats = 5, quick = False):
+    '''
+    Time (ms) for buffer_set of 64, 256 and 512 poses, best of 'repeats'.
+    Both a full upload, and changing one pose of what is already there.
+    '''
+    if quick: repeats = 2
+    R = connect(emulator)
+    result = {}
+    for size in BUFFER_SIZES:
+        path  = [[[500 + i * 0.1, -90 + i * 0.2, 300.0], [0, 0, 1, 0]]
+                 for i in range(size)]
+        times = []
+        for i in range(repeats):
+            R.mirror.invalidate()               # Upload everything
+            start = time.perf_counter()
+            if not R.buffer_set(path):
+                raise Exception("buffer_set failed")
+            times.append((time.perf_counter() - start) * 1e3)
+        result['%i_ms' % size] = min(times)
+        times = []
+        for i in range(repeats):
+            path[size // 2] = [[0, 0, i], [0, 0, 1, 0]]
+            start = time.perf_counter()
+            if not R.buffer_set(path):
+                raise Exception("buffer_set failed")
+            times.append((time.perf_counter() - start) * 1e3)
+        result['%i_one_changed_ms' % size] = min(times)
+    R.close()
+    return result
+
+
+def bench_buffer_cache(emulator, layers = 20, quick = False):
+    '''
+    buffer_set of a perimeter (300 poses) and an infill (500 poses) on
+    each of 'layers' layers, 0.2 mm apart: messages and time (ms), with
+    every layer uploaded, and with repeats loaded from the saved buffers.
+    The cache sends far fewer messages, but on the emulator, which replies
+    at once, that saves no time (loading and saving cost PC time of their
+    own), so the times are also measured on one that spends 1 ms on every
+    command (latency_ms), as a controller does.
+    '''
+    if quick: layers = 5
+    perimeter = [[100 + 20 * math.cos(i / 300.0 * 2 * math.pi),
+                  100 + 20 * math.sin(i / 300.0 * 2 * math.pi), 0.0] for i in range(300)]
+    infill    = [[85 + (i // 2) * 0.6, 85 + 30 * ((i + 1) // 2 % 2), 0.0] for i in range(500)]
+    result  = {}
+    slow    = abb_emulator.Emulator(latency = 0.001).start()
+    try:
+        for E, suffix in [(emulator, '_ms'), (slow, '_latency_ms')]:
+            for name, cache in [('uploaded', False), ('cached', True)]:
+                R = connect(E)
+                R.buffer_cache = abb.BufferCache(range(1, abb.MAX_SAVED_BUFFERS + 1)) if cache else None
+                commands = E.commands
+                start    = time.perf_counter()
+                for layer in range(layers):
+                    z = 0.2 * (layer + 1)
+                    for path in (perimeter, infill):
+                        if not R.buffer_set([[[x, y, z], [0, 0, 1, 0]] for x, y, _ in path]):
+                            raise Exception("buffer_set failed")
+                result[name + suffix] = (time.perf_counter() - start) * 1e3
+                if E is emulator: result[name + '_messages'] = E.commands - commands
+                R.close()
+    finally:
+        slow.stop()
+    return result
+
+
+def bench_protocol(emulator, repeats = 5, quick = False):
+    '''
+    buffer_set of 512 poses (full uploads, best of 'repeats') as text and
+    as binary frames: time (ms), messages and bytes sent
+    '''
+    if quick: repeats = 2
+    path   = [[[500 + i * 0.013, -90 + i * 0.217, 300.0], [0, 0, 1, 0]]
+              for i in range(abb.MAX_BUFFER)]
+    result = {}
+    for name, binary in [('text', False), ('binary', True)]:
+        R = connect(emulator)
+        if not R.set_protocol(binary):
+            raise Exception("set_protocol failed")
+        messages = R.buffer_delta(R.buffer_rows(path), [])
+        if binary: sent = sum(len(abb.encode_frame(m)) for m in messages)
+        else:      sent = sum(len(m) for m in messages)
+        times = []
+        for i in range(repeats):
+            R.mirror.invalidate()
+            start = time.perf_counter()
+            if not R.buffer_set(path):
+                raise Exception("buffer_set failed")
+            times.append((time.perf_counter() - start) * 1e3)
+        result[name + '_ms']       = min(times)
+        result[name + '_messages'] = len(messages)
+        result[name + '_bytes']    = sent
+        R.close()
+    return result
+
+
+def bench_format_pose(emulator, n = 100000, quick = False):
+    '''
+    Time (us) to format one pose, with format_pose and format_poses
+    '''
+    if quick: n = n // 10
+    R    = connect(emulator)
+    pose = [[563.1723, -92.69622, 290.004], [0.9235949, -0.38097291, 0.0059971, 0.0131484]]
+    start = time.perf_counter()
+    for i in range(n):
+        R.format_pose(pose)
+    result = {'format_pose_us': (time.perf_counter() - start) / n * 1e6}
+    poses  = [pose] * n
+    start  = time.perf_counter()
+    R.format_poses(poses)
+    result['format_poses_us'] = (time.perf_counter() - start) / n * 1e6
+    R.close()
+    return result
+
+
+def bench_stream(emulator, layers = 6, poses = 512, quick = False):
+    '''
+    Time (s) to print 'layers' layers of 'poses' poses, layer by layer and
+    streamed. Uses its own emulator: 1 ms per command, and moves take a
+    tenth of their real duration. motion_s is the time spent moving.
+    '''
+    if quick: layers = 3
+    E = abb_emulator.Emulator(latency = 0.001, motion_scale = 0.1,
+                              stream_port = 0).start()
+    R = connect(E)
+    R.port_stream = E.stream_port
+    path = [[[500 + (i % 64) * 1.0, -90 + (i // 64) * 1.0, 300.0], [0, 0, 1, 0]]
+            for i in range(poses)]
+    result = {'layers': layers, 'poses': poses}
+    try:
+        R.set_speed([200, 50, 50, 50])
+        start = time.perf_counter()
+        motion_start = E.motion_time
+        for layer in range(layers):
+            R.buffer_set([[[p[0][0], p[0][1], p[0][2] + layer], p[1]] for p in path])
+            R.buffer_execute(True)
+        result['layers_s']        = time.perf_counter() - start
+        result['layers_motion_s'] = (E.motion_time - motion_start) * E.motion_scale
+
+        start = time.perf_counter()
+        motion_start = E.motion_time
+        with R.streaming() as S:
+            for layer in range(layers):
+                S.push([[[p[0][0], p[0][1], p[0][2] + layer], p[1]] for p in path],
+                       speed = [200, 50], extrude = True)
+        result['stream_s']        = time.perf_counter() - start
+        result['stream_motion_s'] = (E.motion_time - motion_start) * E.motion_scale
+    finally:
+        R.close()
+        E.stop()
+    return result
+
+
+def simulated_print(segments):
+    '''
+    Records a toolpath of alternating extrusion and travel segments on a
+    fresh abb_testing.Robot, and returns it
+    '''
+    import abb_testing
+    with contextlib.redirect_stdout(sys.stderr):
+        R = abb_testing.Robot('')
+    q = [0, 0, 1, 0]
+    for i in range(segments):
+        layer = i // 1000
+        R.set_dio(i % 2)
+        R.set_cartesian([[(i % 100) * 2.0, (i % 1000) // 100 * 2.0, layer * 0.2], q])
+    return R
+
+
+def bench_sim_record(emulator, quick = False):
+    '''
+    Time (s) for abb_testing.Robot to record toolpaths of each size
+    '''
+    simulated_print(1)                          # Imports matplotlib
+    result = {}
+    for segments in (QUICK_SEGMENTS if quick else SEGMENTS):
+        start = time.perf_counter()
+        R = simulated_print(segments)
+        result['%i_s' % segments]  = time.perf_counter() - start
+        result['%i_mb' % segments] = R.toolpath.nbytes / 1e6
+    return result
+
+
+def bench_sim_render(emulator, quick = False):
+    '''
+    Time (s) for show_motions to draw toolpaths of each size (Agg backend)
+    '''
+    import matplotlib
+    matplotlib.use('Agg')
+    import matplotlib.pyplot as plt
+    result = {}
+    for segments in (QUICK_SEGMENTS if quick else SEGMENTS):
+        R = simulated_print(segments)
+        start = time.perf_counter()
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore')
+            R.show_motions(animate = False)
+            plt.gcf().canvas.draw()
+        result['%i_s' % segments] = time.perf_counter() - start
+        plt.close('all')
+    return result
+
+
+def bench_sim_time(emulator, quick = False):
+    '''
+    Time (s) for print_time to estimate toolpaths of each size, and the
+    estimate (s)
+    '''
+    result = {}
+    for segments in (QUICK_SEGMENTS if quick else SEGMENTS):
+        R = simulated_print(segments)
+        start = time.perf_counter()
+        estimate = R.print_time()
+        result['%i_s' % segments]          = time.perf_counter() - start
+        result['%i_estimate_s' % segments] = estimate.total
+    return result
+
+
+BENCHMARKS = {'send'        : bench_send,
+              'overhead'    : bench_overhead,
+              'journal'     : bench_journal,
+              'buffer_set'  : bench_buffer_set,
+              'buffer_cache': bench_buffer_cache,
+              'protocol'    : bench_protocol,
+              'settings'    : bench_settings,
+              'format_pose' : bench_format_pose,
+              'stream'      : bench_stream,
+              'sim_record'  : bench_sim_record,
+              'sim_render'  : bench_sim_render,
+              'sim_time'    : bench_sim_time}
+
+
+def git_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', 'HEAD'],
+                                       stderr = subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def run(names = None, quick = False):
+    '''
+    Runs the named benchmarks (all of them by default), and returns the
+    results with enough context to compare runs
+    '''
+    names    = names or list(BENCHMARKS)
+    emulator = abb_emulator.Emulator().start()
+    results  = {'commit'   : git_commit(),
+                'time'     : time.strftime('%Y-%m-%dT%H:%M:%S'),
+                'python'   : platform.python_version(),
+                'platform' : platform.platform(),
+                'quick'    : quick,
+                'results'  : {}}
+    try:
+        for name in names:
+            print("Running %s..." % name, file = sys.stderr)
+            results['results'][name] = BENCHMARKS[name](emulator, quick = quick)
+    finally:
+        emulator.stop()
+    return results
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'Benchmark abb.py and abb_testing.py')
+    parser.add_argument('benchmarks', nargs = '*',
+                        help = 'any of: %s (default: all)' % ', '.join(BENCHMARKS))
+    parser.add_argument('-o', '--output', help = 'write JSON here instead of stdout')
+    parser.add_argument('--quick', action = 'store_true', help = 'smaller sizes')
+    args = parser.parse_args()
+    for name in args.benchmarks:
+        if name not in BENCHMARKS: parser.error('unknown benchmark: %s' % name)
+
+    results = run(args.benchmarks, args.quick)
+    text    = json.dumps(results, indent = 2)
+    if args.output:
+        with open(args.output, 'w') as f: f.write(text + '\n')
+    else:
+        print(text)
@@ -0,0 +1,763 @@
+'''
+David Pollard
+
+FARSCOPE CDT
+Bristol Robotics Laboratory
+
+abb_emulator.py
+ - Stand-in for SERVER.mod, for testing abb.py without a robot or RobotStudio
+ - Speaks the same protocol over TCP: messages are parsed the way ParseMsg
+   parses them, and replies are "<code> <ok> <payload> #"
+ - After "42 1 #", messages are binary frames, read as ReceiveFrame does
+ - Keeps the same state: tool, work object, speed, zone, the buffer
+   (BUFFER_POS, MAX_BUFFER) and saved buffers
+ - Errors that would stop ServerMain (e.g. reading outside bufferTargets)
+   drop the connection and wait for a new one, like its ERROR handler
+ - Optional per-command latency and simulated motion time
+ - Optionally the STREAM task too (stream_port), on a second socket
+
+Released under the MIT License
+
+Example:
+    E = abb_emulator.Emulator(latency = 0.002).start()
+    R = abb.Robot('127.0.0.1', E.port)
+
+Or from the command line:
+    python abb_emulator.py [port]
+
+'''
+
+import sys
+import math
+import time
+import socket
+import struct
+import logging
+from threading import Thread, Condition
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Constants from SERVER.mod
+MAX_PARAMS        = 24
+MAX_BUFFER        = 512
+MAX_SAVED_BUFFERS = 20
+SERVER_BAD_MSG    = 0
+SERVER_OK         = 1
+STREAM_RING       = 1024
+MAX_UNREACHABLE   = 15
+
+# ReceiveFrame: instruction code (int8), number of parameters (uint8), then
+# the parameters as little-endian float32
+FRAME_HEADER = struct.Struct('<bB')
+
+
+class RapidError(Exception):
+    '''
+    An error that sends ServerMain to its ERROR handler
+    '''
+    pass
+
+
+def num_to_str(value, decimals):
+    '''
+    RAPID NumToStr: rounded to 'decimals', without trailing zeros
+    '''
+    text = format(value, '.%if' % decimals)
+    if '.' in text: text = text.rstrip('0').rstrip('.')
+    if text == '-0': text = '0'
+    return text
+
+
+def parse_msg(msg, params):
+    '''
+    ParseMsg from SERVER.mod. Returns (instruction code, nParams); the code
+    is None if it couldn't be read. params is updated in place, and like
+    the RAPID array, keeps its old value where a parameter can't be read.
+    Positions below are 1-based, as in RAPID.
+    '''
+    def str_match(start, char):
+        found = msg.find(char, start - 1)
+        return found + 1 if found >= 0 else len(msg) + 1
+
+    def str_to_val(text):
+        try:    return float(text)
+        except ValueError: return None
+
+    length = str_match(1, '#')
+    if length > len(msg):
+        return None, -1
+    new_ind = str_match(1, ' ') + 1
+    code    = str_to_val(msg[:new_ind - 2])
+    if code is None:
+        return None, -1
+    ind       = new_ind
+    ind_param = 1
+    while True:
+        new_ind = str_match(ind, ' ') + 1
+        if new_ind > length:
+            break
+        if ind_param > MAX_PARAMS:
+            return code, -1
+        value = str_to_val(msg[ind - 1:new_ind - 2])
+        if value is not None: params[ind_param - 1] = value
+        ind_param += 1
+        ind = new_ind
+    return code, ind_param - 1
+
+
+def frame_size(data):
+    '''
+    Length of the binary frame at the start of data, None if even its
+    header hasn't arrived
+    '''
+    if len(data) < FRAME_HEADER.size: return None
+    return FRAME_HEADER.size + 4 * data[1]
+
+
+def parse_frame(frame, params):
+    '''
+    ReceiveFrame from SERVER.mod. Returns (instruction code, nParams) as
+    parse_msg does, and updates params in place.
+    '''
+    code, count = FRAME_HEADER.unpack_from(frame)
+    if count > MAX_PARAMS:
+        return code, -1
+    params[:count] = struct.unpack_from('<%if' % count, frame, FRAME_HEADER.size)
+    return code, count
+
+
+class Emulator:
+    def __init__(self,
+                 host         = '127.0.0.1',
+                 port         = 0,
+                 latency      = 0.0,
+                 motion_scale = 0.0,
+                 stream_port  = None):
+        '''
+         - port: 0 picks a free port, see self.port
+         - stream_port: also emulate the STREAM task on this port (0 picks
+           a free port, see self.stream_port). None doesn't.
+         - latency: seconds spent on every command before replying, or a
+           dict of {instruction code: seconds}
+         - motion_scale: moves sleep for motion_scale times their simulated
+           duration (0 replies at once, 1 is real time)
+        '''
+        self.latency      = latency
+        self.motion_scale = motion_scale
+        # Called with each target checked (40, 41), returns True if reachable
+        self.reachable    = lambda target: True
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.sock.bind((host, port))
+        self.sock.listen(1)
+        self.host, self.port = self.sock.getsockname()[:2]
+
+        self.stream_sock   = None
+        self.stream_port   = None
+        self.stream_thread = None
+        self.stream_client = None
+        # Held while the ring is read or changed, notified when it changes
+        self.stream_ready  = Condition()
+        if stream_port is not None:
+            self.stream_sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.stream_sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            self.stream_sock.bind((host, stream_port))
+            self.stream_sock.listen(1)
+            self.stream_port = self.stream_sock.getsockname()[1]
+
+        self.running     = False
+        self.thread      = None
+        self.client      = None
+        self.commands    = 0        # Commands served
+        self.connections = 0        # Clients accepted
+        self.binary      = False    # Messages are binary frames (42)
+        self.motion_time = 0.0      # Simulated seconds of motion
+
+        self.params           = [0.0] * MAX_PARAMS
+        self.instruction_code = 0
+        self.stream_params    = [0.0] * MAX_PARAMS
+        self.stream_code      = 0
+        self.initialize()
+
+    def initialize(self):
+        '''
+        Initialize from SERVER.mod, plus the rest of the robot state
+        '''
+        self.tool          = [0,0,0, 1,0,0,0]
+        self.wobj          = [0,0,0, 1,0,0,0]
+        self.speed         = [100, 50, 0, 0]
+        self.zone          = [False, 0.3, 0.3, 0.03]
+        self.q_orientation = [0,0,0,0]
+        self.external_axis = [0, 0]
+        self.position      = [0,0,0, 1,0,0,0]
+        self.joints        = [0,0,0,0,0,0]
+        self.circ_point    = None
+        self.digital_out   = {}
+        self.group_out     = 0
+
+        self.buffer_pos     = 0
+        self.buffer_targets = [None] * MAX_BUFFER
+        self.buffer_speeds  = [None] * MAX_BUFFER
+        self.buffer_go      = [-1] * MAX_BUFFER
+        self.saved_targets  = [[None] * MAX_BUFFER for i in range(MAX_SAVED_BUFFERS)]
+        self.saved_speeds   = [[None] * MAX_BUFFER for i in range(MAX_SAVED_BUFFERS)]
+        self.saved_go       = [[-1] * MAX_BUFFER for i in range(MAX_SAVED_BUFFERS)]
+        self.saved_pos      = [0] * MAX_SAVED_BUFFERS
+
+        # STREAM task: the shared ring, and the settings for the next poses
+        self.stream_targets     = [None] * STREAM_RING
+        self.stream_speeds      = [None] * STREAM_RING
+        self.stream_extrude     = [False] * STREAM_RING
+        self.stream_added       = 0
+        self.stream_done        = 0
+        self.stream_end_at      = -1
+        self.stream_orientation = [1,0,0,0]
+        self.stream_speed       = [100, 50, 0, 0]
+        self.stream_extrude_on  = True
+
+    #
+    # Server
+    #
+    def start(self):
+        self.running = True
+        self.thread  = Thread(target = self.serve_forever, name = 'abb_emulator')
+        self.thread.daemon = True
+        self.thread.start()
+        if self.stream_sock is not None:
+            self.stream_thread = Thread(target = self.serve_stream,
+                                        name = 'abb_emulator_stream')
+            self.stream_thread.daemon = True
+            self.stream_thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.client is not None:
+            try:    self.client.shutdown(socket.SHUT_RDWR)
+            except OSError: pass
+        try:    socket.create_connection((self.host, self.port), 1).close()
+        except OSError: pass
+        if self.thread is not None: self.thread.join()
+        self.sock.close()
+        if self.stream_sock is not None:
+            if self.stream_client is not None:
+                try:    self.stream_client.shutdown(socket.SHUT_RDWR)
+                except OSError: pass
+            try:    socket.create_connection((self.host, self.stream_port), 1).close()
+            except OSError: pass
+            if self.stream_thread is not None: self.stream_thread.join()
+            self.stream_sock.close()
+
+    def serve_forever(self):
+        self.running = True
+        log.info('Emulator waiting for incoming connections on port %i', self.port)
+        while self.running:
+            client, address = self.sock.accept()
+            if not self.running:
+                client.close()
+                break
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.client       = client
+            self.connections += 1
+            self.binary       = False
+            log.info('Emulator connected to %s', str(address))
+            try:
+                self.serve_client(client)
+            except RapidError as e:
+                log.warn('Emulator error handler, restarting: %s', e)
+            except OSError as e:
+                log.info('Emulator lost connection to the client: %s', e)
+            client.close()
+            self.client = None
+
+    def serve_stream(self):
+        '''
+        The STREAM task's accept loop
+        '''
+        while self.running:
+            client, address = self.stream_sock.accept()
+            if not self.running:
+                client.close()
+                break
+            client.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            self.stream_client = client
+            log.info('Emulator stream connected to %s', str(address))
+            try:
+                self.serve_client(client, self.handle_stream)
+            except RapidError as e:
+                log.warn('Emulator stream error handler, restarting: %s', e)
+            except OSError as e:
+                log.info('Emulator stream lost connection to the client: %s', e)
+            client.close()
+            self.stream_client = None
+
+    def serve_client(self, client, handle=None):
+        '''
+        ReceiveMsg (or ReceiveFrame) and the ServerMain loop, until the
+        client closes
+        '''
+        if handle is None: handle = self.handle
+        pending = b''
+        while True:
+            data = client.recv(4096)
+            if not data: return
+            pending += data
+            while True:
+                # Only the motion socket switches to binary frames
+                if self.binary and handle == self.handle:
+                    end = frame_size(pending)
+                    if end is None or end > len(pending): break
+                    msg = pending[:end]
+                else:
+                    if b'#' not in pending: break
+                    end = pending.index(b'#') + 1
+                    msg = pending[:end].decode('ascii', 'replace')
+                pending = pending[end:]
+                reply   = handle(msg)
+                if reply is None: return                # Closed by 99
+                client.sendall(reply.encode('ascii'))
+
+    def handle(self, msg):
+        '''
+        Executes one message (text, or a binary frame as bytes), and
+        returns the reply to send, or None if the connection was closed
+        '''
+        self.commands += 1
+        if isinstance(msg, bytes): code, n_params = parse_frame(msg, self.params)
+        else:                      code, n_params = parse_msg(msg, self.params)
+        if code is not None: self.instruction_code = code
+        code = int(self.instruction_code)
+        params = self.params
+
+        if isinstance(self.latency, dict): delay = self.latency.get(code, 0)
+        else:                              delay = self.latency
+        if delay > 0: time.sleep(delay)
+
+        if code == 99:
+            if n_params == 0: return None
+            ok, add_string = SERVER_BAD_MSG, ''
+        else:
+            handler = getattr(self, 'op_%i' % code if code >= 0 else 'op_reset', None)
+            if handler is None:
+                log.warn('Emulator: Illegal instruction code %i', code)
+                ok, add_string = SERVER_BAD_MSG, ''
+            else:
+                ok, add_string = handler(params, n_params)
+        return (num_to_str(code, 0) + ' ' + num_to_str(ok, 0) + ' ' +
+                add_string + ' #')
+
+    def handle_stream(self, msg):
+        '''
+        As handle, for the STREAM task's instructions (stream_op_*)
+        '''
+        code, n_params = parse_msg(msg, self.stream_params)
+        if code is not None: self.stream_code = code
+        code    = int(self.stream_code)
+        handler = getattr(self, 'stream_op_%i' % code, None)
+        if handler is None:
+            log.warn('Emulator stream: Illegal instruction code %i', code)
+            ok, add_string = SERVER_BAD_MSG, ''
+        else:
+            ok, add_string = handler(self.stream_params, n_params)
+        return (num_to_str(code, 0) + ' ' + num_to_str(ok, 0) + ' ' +
+                add_string + ' #')
+
+    def wait_stream(self, ready):
+        '''
+        Waits (holding stream_ready) until ready() is True, like WaitUntil
+        '''
+        while not ready():
+            if not self.running: raise RapidError('Emulator stopped')
+            self.stream_ready.wait(0.1)
+
+    #
+    # Motion
+    #
+    def move(self, target, speed):
+        '''
+        Moves linearly to target at speed (mm/s)
+        '''
+        distance = math.sqrt(sum((a - b)**2 for a, b in
+                                 zip(target[:3], self.position[:3])))
+        self.wait_motion(distance / max(speed, 1e-6))
+        self.position = list(target[:7])
+
+    def wait_motion(self, duration):
+        self.motion_time += duration
+        if self.motion_scale > 0:
+            time.sleep(duration * self.motion_scale)
+
+    def buffer_index(self, index):
+        '''
+        Checks an index into bufferTargets (1-based, as in RAPID)
+        '''
+        index = int(round(index))
+        if index < 1 or index > MAX_BUFFER:
+            raise RapidError('Array index %i out of bounds' % index)
+        return index - 1
+
+    def saved_index(self, index):
+        index = int(round(index))
+        if index < 1 or index > MAX_SAVED_BUFFERS:
+            raise RapidError('Saved buffer index %i out of bounds' % index)
+        return index - 1
+
+    def buffer_append(self, target):
+        if self.buffer_pos < MAX_BUFFER:
+            self.buffer_targets[self.buffer_pos] = target
+            self.buffer_speeds[self.buffer_pos]  = list(self.speed)
+            self.buffer_go[self.buffer_pos]      = -1
+            self.buffer_pos += 1
+            return True
+        return False
+
+    def format_pose(self, pose):
+        return ' '.join([num_to_str(v, 2) for v in pose[:3]] +
+                        [num_to_str(v, 3) for v in pose[3:7]])
+
+    #
+    # Instructions, as in ServerMain. Each returns (ok, addString)
+    #
+    def op_reset(self, p, n):
+        if n != 1: return SERVER_BAD_MSG, ''
+        if p[0] in (0, 1):
+            # ResetRobotPosition
+            self.digital_out = {}
+            self.joints = [0,0,0,0,0,0]
+            self.external_axis = [0, 0]
+            self.wait_motion(1.0)
+        if p[0] in (1, 2): self.digital_out[1] = 1
+        else:              self.digital_out[1] = 0
+        return SERVER_OK, ''
+
+    def op_0(self, p, n):
+        return (SERVER_OK if n == 0 else SERVER_BAD_MSG), ''
+
+    def op_1(self, p, n):
+        if n != 8: return SERVER_BAD_MSG, ''
+        self.move(p[1:8], self.speed[0])
+        return SERVER_OK, ''
+
+    def op_2(self, p, n):
+        if n != 6: return SERVER_BAD_MSG, ''
+        self.joints = list(p[0:6])
+        self.wait_motion(1.0)
+        return SERVER_OK, ''
+
+    def op_3(self, p, n):
+        if n != 0: return SERVER_BAD_MSG, ''
+        return SERVER_OK, self.format_pose(self.position)
+
+    def op_4(self, p, n):
+        if n != 0: return SERVER_BAD_MSG, ''
+        return SERVER_OK, ' '.join(num_to_str(j, 2) for j in self.joints)
+
+    def op_5(self, p, n):
+        if n != 0: return SERVER_BAD_MSG, ''
+        return SERVER_OK, ' '.join(num_to_str(a, 6) for a in self.external_axis)
+
+    def op_6(self, p, n):
+        if n != 7: return SERVER_BAD_MSG, ''
+        self.tool = list(p[0:7])
+        return SERVER_OK, ''
+
+    def op_7(self, p, n):
+        if n != 7: return SERVER_BAD_MSG, ''
+        self.wobj = list(p[0:7])
+        return SERVER_OK, ''
+
+    def op_8(self, p, n):
+        if n == 4:
+            self.speed = list(p[0:4])
+        elif n == 2:
+            self.speed[0:2] = p[0:2]
+        else:
+            return SERVER_BAD_MSG, ''
+        return SERVER_OK, ''
+
+    def op_9(self, p, n):
+        if n != 4: return SERVER_BAD_MSG, ''
+        if p[0] == 1: self.zone = [True, 0.0, 0.0, 0.0]
+        else:         self.zone = [False] + list(p[1:4])
+        return SERVER_OK, ''
+
+    def op_10(self, p, n):
+        if n != 1: return SERVER_BAD_MSG, ''
+        self.joints[5] += p[0]
+        self.wait_motion(abs(p[0]) / max(self.speed[1], 1e-6))
+        return SERVER_OK, ''
+
+    def op_11(self, p, n):
+        if n != 0: return SERVER_BAD_MSG, ''
+        return SERVER_OK, ''
+
+    def op_29(self, p, n):
+        if n != 4: return SERVER_BAD_MSG, ''
+        self.q_orientation = list(p[0:4])
+        return SERVER_OK, ''
+
+    def op_30(self, p, n):
+        if n == 7 or n == 8:
+            if n == 8: self.external_axis[1] = p[7]
+            self.buffer_append(list(p[0:7]))
+            self.q_orientation = list(p[3:7])
+        elif n == 3:
+            self.buffer_append(list(p[0:3]) + self.q_orientation)
+        else:
+            return SERVER_BAD_MSG, ''
+        return SERVER_OK, ''
+
+    def op_31(self, p, n):
+        if n != 0: return SERVER_BAD_MSG, ''
+        self.buffer_pos = 0
+        return SERVER_OK, ''
+
+    def op_32(self, p, n):
+        if n != 0: return SERVER_BAD_MSG, ''
+        return SERVER_OK, num_to_str(self.buffer_pos, 2)
+
+    def op_33(self, p, n):
+        if n not in (0, 1, 3): return SERVER_BAD_MSG, ''
+        if self.buffer_pos < 1:
+            raise RapidError('Executing an empty buffer')
+        extrude    = n == 1 or (n == 3 and p[0] == 1)
+        join_start = n == 3 and p[1] == 1
+        join_end   = n == 3 and p[2] == 1
+        if extrude and not join_start:
+            self.move(self.buffer_targets[0], 100)
+            self.digital_out[2] = 1
+        for i in range(self.buffer_pos):
+            if self.buffer_go[i] >= 0: self.group_out = int(self.buffer_go[i])
+            self.move(self.buffer_targets[i], self.buffer_speeds[i][0])
+        if extrude and not join_end:
+            self.digital_out[2] = 0
+            self.wait_motion(5.0 / 100)         # Retract 5mm at v100
+        return SERVER_OK, ''
+
+    def op_34(self, p, n):
+        if n != 2: return SERVER_BAD_MSG, ''
+        self.external_axis = list(p[0:2])
+        self.wait_motion(1.0)
+        return SERVER_OK, ''
+
+    def op_35(self, p, n):
+        if n != 7: return SERVER_BAD_MSG, ''
+        self.circ_point = list(p[0:7])
+        return SERVER_OK, ''
+
+    def op_36(self, p, n):
+        if n != 7: return SERVER_BAD_MSG, ''
+        if self.circ_point is None:
+            raise RapidError('MoveC without a circPoint')
+        self.move(self.circ_point, self.speed[0])
+        self.move(p[0:7], self.speed[0])
+        return SERVER_OK, ''
+
+    def op_37(self, p, n):
+        if n != 0: return SERVER_BAD_MSG, ''
+        if self.buffer_targets[1] is None:
+            raise RapidError('Circular move needs two buffered targets')
+        self.move(self.buffer_targets[0], self.buffer_speeds[0][0])
+        self.move(self.buffer_targets[1], self.buffer_speeds[0][0])
+        return SERVER_OK, ''
+
+    def op_38(self, p, n):
+        if n < 3 or n % 3 != 0: return SERVER_BAD_MSG, ''
+        ok = SERVER_OK
+        for i in range(0, n, 3):
+            if not self.buffer_append(list(p[i:i+3]) + self.q_orientation):
+                ok = SERVER_BAD_MSG
+        return ok, num_to_str(self.buffer_pos, 0)
+
+    def op_39(self, p, n):
+        if n != 1: return SERVER_BAD_MSG, ''
+        ok = SERVER_BAD_MSG
+        if 0 <= p[0] <= self.buffer_pos:
+            self.buffer_pos = int(p[0])
+            ok = SERVER_OK
+        return ok, num_to_str(self.buffer_pos, 0)
+
+    def op_40(self, p, n):
+        # No nParams check, as in SERVER.mod
+        if self.reachable(list(p[0:7])): return SERVER_OK, ''
+        return SERVER_BAD_MSG, ''
+
+    def op_41(self, p, n):
+        if n != 2: return SERVER_BAD_MSG, ''
+        if not 1 <= p[0] <= p[1] + 1 or p[1] > self.buffer_pos: return SERVER_BAD_MSG, ''
+        index, found = int(p[0]), []
+        while index <= p[1] and len(found) < MAX_UNREACHABLE:
+            if not self.reachable(list(self.buffer_targets[index - 1])):
+                found.append(num_to_str(index, 0))
+            index += 1
+        return SERVER_OK, ' '.join([num_to_str(index, 0)] + found)
+
+    def op_42(self, p, n):
+        if n != 1 or p[0] not in (0, 1): return SERVER_BAD_MSG, ''
+        self.binary = p[0] == 1
+        return SERVER_OK, ''
+
+    def op_50(self, p, n):
+        if n != 1: return SERVER_BAD_MSG, ''
+        if not 1 <= p[0] <= MAX_SAVED_BUFFERS: return SERVER_BAD_MSG, ''
+        slot = self.saved_index(p[0])
+        for i in range(self.buffer_pos):
+            self.saved_targets[slot][i] = list(self.buffer_targets[i])
+            self.saved_speeds[slot][i]  = list(self.buffer_speeds[i])
+            self.saved_go[slot][i]      = self.buffer_go[i]
+        self.saved_pos[slot] = self.buffer_pos
+        return SERVER_OK, ''
+
+    def op_51(self, p, n):
+        if n != 1: return SERVER_BAD_MSG, ''
+        if not 1 <= p[0] <= MAX_SAVED_BUFFERS: return SERVER_BAD_MSG, ''
+        slot = self.saved_index(p[0])
+        self.buffer_pos = self.saved_pos[slot]
+        for i in range(self.buffer_pos):
+            self.buffer_targets[i] = list(self.saved_targets[slot][i])
+            self.buffer_speeds[i]  = list(self.saved_speeds[slot][i])
+            self.buffer_go[i]      = self.saved_go[slot][i]
+        return SERVER_OK, ''
+
+    def op_52(self, p, n):
+        if n != 1: return SERVER_BAD_MSG, ''
+        target = self.buffer_targets[self.buffer_index(p[0])]
+        if target is None:
+            target = [0,0,0, 0,0,0,0]       # Uninitialised robtarget
+        return SERVER_OK, self.format_pose(target)
+
+    def op_53(self, p, n):
+        if n != 3: return SERVER_BAD_MSG, ''
+        for i in range(self.buffer_pos):
+            target = self.buffer_targets[i]
+            self.buffer_targets[i] = [target[0] + p[0], target[1] + p[1],
+                                      target[2] + p[2]] + target[3:]
+        return SERVER_OK, ''
+
+    def op_54(self, p, n):
+        if n != 1: return SERVER_BAD_MSG, ''
+        for i in range(self.buffer_pos):
+            self.buffer_speeds[i] = list(self.buffer_speeds[i])
+            self.buffer_speeds[i][0] *= p[0]
+        return SERVER_OK, ''
+
+    def op_55(self, p, n):
+        if n != 8: return SERVER_BAD_MSG, ''
+        ok = SERVER_BAD_MSG
+        if 1 <= p[0] <= self.buffer_pos:
+            index = self.buffer_index(p[0])
+            self.buffer_targets[index] = list(p[1:8])
+            self.buffer_speeds[index]  = list(self.speed)
+            self.buffer_go[index]      = -1
+            ok = SERVER_OK
+        return ok, num_to_str(self.buffer_pos, 0)
+
+    def op_56(self, p, n):
+        if n < 4 or n % 4 != 0: return SERVER_BAD_MSG, ''
+        ok = SERVER_OK
+        for i in range(0, n, 4):
+            if 1 <= p[i] <= p[i+1] <= self.buffer_pos:
+                for j in range(int(p[i]) - 1, int(p[i+1])):
+                    self.buffer_speeds[j]    = list(self.buffer_speeds[j])
+                    self.buffer_speeds[j][0] = p[i+2]
+                    self.buffer_go[j]        = p[i+3]
+            else:
+                ok = SERVER_BAD_MSG
+        return ok, num_to_str(self.buffer_pos, 0)
+
+    def op_60(self, p, n):
+        if n != 0: return SERVER_BAD_MSG, ''
+        while True:
+            with self.stream_ready:
+                self.wait_stream(lambda: self.stream_done < self.stream_added or
+                                         self.stream_end_at == self.stream_done)
+                if self.stream_done >= self.stream_added: break
+                slot    = self.stream_done % STREAM_RING
+                target  = self.stream_targets[slot]
+                speed   = self.stream_speeds[slot]
+                extrude = self.stream_extrude[slot]
+                self.stream_done += 1
+                self.stream_ready.notify_all()
+            # The STREAM task keeps adding poses while this one is executed
+            self.digital_out[2] = 1 if extrude else 0
+            self.move(target, speed[0])
+        self.digital_out[2] = 0
+        self.stream_end_at  = -1
+        return SERVER_OK, ''
+
+    def op_96(self, p, n):
+        if n != 1: return SERVER_BAD_MSG, ''
+        self.group_out = int(p[0])
+        return SERVER_OK, ''
+
+    def op_97(self, p, n):
+        if n != 1: return SERVER_BAD_MSG, ''
+        self.digital_out[2] = 1 if p[0] == 1 else 0
+        return SERVER_OK, ''
+
+    def op_98(self, p, n):
+        if n != 0: return SERVER_BAD_MSG, ''
+        return SERVER_OK, 'EMULATOR*abb_emulator*SERVER.mod emulator'
+
+    #
+    # STREAM task instructions, as in STREAM.mod
+    #
+    def stream_op_70(self, p, n):
+        if n < 3 or n % 3 != 0: return SERVER_BAD_MSG, ''
+        with self.stream_ready:
+            self.wait_stream(lambda: self.stream_added - self.stream_done + n // 3
+                                     <= STREAM_RING)
+            for i in range(0, n, 3):
+                slot = self.stream_added % STREAM_RING
+                self.stream_targets[slot] = list(p[i:i+3]) + self.stream_orientation
+                self.stream_speeds[slot]  = list(self.stream_speed)
+                self.stream_extrude[slot] = self.stream_extrude_on
+                self.stream_added += 1
+            self.stream_ready.notify_all()
+            free = STREAM_RING - (self.stream_added - self.stream_done)
+        return SERVER_OK, num_to_str(free, 0)
+
+    def stream_op_71(self, p, n):
+        if n != 4: return SERVER_BAD_MSG, ''
+        self.stream_orientation = list(p[0:4])
+        return SERVER_OK, ''
+
+    def stream_op_72(self, p, n):
+        if n != 3: return SERVER_BAD_MSG, ''
+        self.stream_speed[0:2]  = p[0:2]
+        self.stream_extrude_on  = p[2] == 1
+        return SERVER_OK, ''
+
+    def stream_op_73(self, p, n):
+        if n != 0: return SERVER_BAD_MSG, ''
+        with self.stream_ready:
+            self.stream_end_at = self.stream_added
+            self.stream_ready.notify_all()
+        return SERVER_OK, ''
+
+    def stream_op_74(self, p, n):
+        if n != 0: return SERVER_BAD_MSG, ''
+        return SERVER_OK, (num_to_str(self.stream_added, 0) + ' ' +
+                           num_to_str(self.stream_done, 0))
+
+    def stream_op_75(self, p, n):
+        if n != 0: return SERVER_BAD_MSG, ''
+        with self.stream_ready:
+            self.stream_added = self.stream_done
+            if self.stream_end_at > self.stream_added:
+                self.stream_end_at = self.stream_added
+            self.stream_ready.notify_all()
+        return SERVER_OK, num_to_str(STREAM_RING, 0)
+
+
+if __name__ == '__main__':
+    logging.basicConfig(level = logging.INFO)
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    E = Emulator(port = port)
+    print("Emulating SERVER.mod on port %i, CTRL+C to stop" % E.port)
+    try:
+        E.serve_forever()
+    except KeyboardInterrupt:
+        pass
@@ -0,0 +1,294 @@
+'''
+David Pollard
+
+FARSCOPE CDT
+Bristol Robotics Laboratory
+
+abb_encoder.py
+ - Formats many poses at once with NumPy, for bulk uploads
+ - Gives exactly the strings abb.Robot.format_pose, format_pos and
+   format_orient give, one pose at a time (abb.TEXT's formats by default,
+   or any other specs, e.g. abb.BINARY's)
+ - check_poses validates a whole array up front
+
+Released under the MIT License
+
+Example:
+    poses = abb_encoder.check_poses(pose_list)           # (N, 7) array
+    msgs  = ["30 " + m for m in abb_encoder.encode_poses(poses)]
+
+'''
+
+import logging
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Formats used by abb.Robot for text messages (abb.TEXT)
+POSE_SPECS        = ["+08.1f"] * 3 + ["+08.5f"] * 4
+POSITION_SPECS    = ["08.1f"] * 3
+ORIENTATION_SPECS = ["08.5f"] * 4
+BULK_SPECS        = [".1f"] * 3
+
+# Orientation given to positions with none (see buffer_rows)
+ORIENTATION_FILL  = [1, 0, 0, 0]
+
+# Largest number of integer digits for compact (".Nf") fields, bigger
+# values are formatted by Python instead
+COMPACT_DIGITS = 8
+
+CHAR_0     = ord('0')
+CHAR_PLUS  = ord('+')
+CHAR_MINUS = ord('-')
+CHAR_POINT = ord('.')
+CHAR_SPACE = ord(' ')
+CHAR_NUL   = 0
+
+
+def parse_spec(spec):
+    '''
+    Splits a format spec such as "+08.1f" into (plus, width, decimals).
+    Width is None for compact specs such as ".1f".
+    Only the specs abb.py uses are supported: "[+][0W].Df".
+    '''
+    body = spec[:-1]
+    if not spec.endswith('f') or '.' not in body:
+        raise Exception("Unsupported format spec: %s" % spec)
+    plus = body.startswith('+')
+    if plus: body = body[1:]
+    width, decimals = body.split('.')
+    decimals = int(decimals)
+    if width == '':
+        return plus, None, decimals
+    if not width.startswith('0') or decimals < 1:
+        raise Exception("Unsupported format spec: %s" % spec)
+    return plus, int(width), decimals
+
+
+def format_column(values, spec):
+    '''
+    Formats a 1D array with format(value, spec), vectorised.
+    Returns (chars, exact): chars is a uint8 array (N, width), padded with
+    NUL bytes on the left for compact specs. Where exact is False (the
+    value is too close to a rounding tie to be sure of matching Python,
+    or too big for the field), chars is not valid.
+    '''
+    plus, width, decimals = parse_spec(spec)
+    if width is None:
+        int_slots = COMPACT_DIGITS
+    else:
+        # Sign (or a leading zero when unsigned), digits, point, decimals
+        int_slots = width - 2 - decimals
+
+    values   = np.asarray(values, dtype=float)
+    negative = np.signbit(values)
+    scaled   = np.abs(values) * 10.0**decimals
+    rounded  = np.rint(scaled)
+    # Python rounds the exact binary value; only trust np.rint away from ties
+    tie      = np.abs(scaled - np.floor(scaled) - 0.5)
+    exact    = (np.isfinite(scaled) & (scaled < 2.0**52) &
+                (tie > 1e-9 * np.maximum(1.0, scaled)))
+    exact   &= rounded < 10.0**(int_slots + decimals)
+    rounded  = np.where(exact, rounded, 0)
+
+    # Digits from the right, dividing by 10 each time (fast for uint32)
+    n = len(values)
+    chars  = np.empty((n, 1 + int_slots + 1 + decimals), dtype=np.uint8)
+    dtype  = np.uint32 if int_slots + decimals <= 9 else np.uint64
+    number = rounded.astype(dtype)
+    for digit in range(int_slots + decimals, 0, -1):
+        quotient = number // 10
+        chars[:, digit + (digit > int_slots)] = CHAR_0 + (number - quotient * 10)
+        number   = quotient
+    chars[:, 1 + int_slots] = CHAR_POINT
+
+    if width is not None:
+        # Zero padded: the sign always comes first. Without '+' a positive
+        # value could use the sign's place for one more digit; those are
+        # left to Python as too big for the field.
+        if plus: chars[:, 0] = np.where(negative, CHAR_MINUS, CHAR_PLUS)
+        else:    chars[:, 0] = np.where(negative, CHAR_MINUS, CHAR_0)
+    else:
+        # Compact: drop leading zeros, and put the sign before the first digit
+        int_part = np.floor(rounded / 10**decimals)
+        length   = 1 + np.searchsorted(10.0 ** np.arange(1, int_slots), int_part,
+                                       side='right')
+        first    = 1 + int_slots - length
+        column   = np.arange(chars.shape[1])[None, :]
+        chars[column < first[:, None]] = CHAR_NUL
+        sign     = np.where(negative, CHAR_MINUS, CHAR_PLUS if plus else CHAR_NUL)
+        chars[np.arange(n), first - 1] = sign
+    return chars, exact
+
+
+def encode(values, specs, end=' #'):
+    '''
+    Formats each row of values (N, M) as one string: format(value, spec) for
+    each column, separated by spaces, followed by 'end'. This is the same as
+    abb.Robot builds messages, e.g. with POSE_SPECS it gives format_pose.
+    '''
+    values = np.asarray(values, dtype=float)
+    if values.ndim != 2 or values.shape[1] != len(specs):
+        raise Exception("Expected an array of shape (N, %i)" % len(specs))
+    n = values.shape[0]
+    if n == 0: return []
+
+    columns = []
+    exact   = np.ones(n, dtype=bool)
+    for j, spec in enumerate(specs):
+        chars, column_exact = format_column(values[:, j], spec)
+        exact &= column_exact
+        columns.append(chars)
+        columns.append(np.full((n, 1), CHAR_SPACE if j + 1 < len(specs) else CHAR_NUL,
+                               dtype=np.uint8))
+    end_chars = np.frombuffer(end.encode('ascii') + b'\n', dtype=np.uint8)
+    columns.append(np.broadcast_to(end_chars, (n, len(end_chars))))
+    text = np.concatenate(columns, axis=1).tobytes().replace(b'\x00', b'')
+    rows = text.decode('ascii').split('\n')[:-1]
+
+    # Anything that couldn't be formatted exactly is done by Python instead
+    for i in np.flatnonzero(~exact):
+        rows[i] = ' '.join(format(v, spec) for v, spec in
+                           zip(values[i].tolist(), specs)) + end
+    return rows
+
+
+def orientation_mask(poses):
+    '''
+    For a list that mixes positions [XYZ] with full poses ([[XYZ], [Quats]]
+    or [X, Y, Z, Q1, Q2, Q3, Q4]), which items are full poses. None for
+    arrays, and for lists of only one kind.
+    '''
+    if isinstance(poses, np.ndarray): return None
+    try:
+        full = np.array([len(p) != 3 for p in poses], dtype=bool)
+    except TypeError:
+        return None
+    if full.all() or not full.any(): return None
+    return full
+
+
+def fill_orientations(poses, full, orientation=None):
+    '''
+    Rows [X, Y, Z, Q1, Q2, Q3, Q4] of a mixed list (see orientation_mask).
+    Each position takes the orientation of the full pose before it, as the
+    controller keeps the last orientation set. Positions before the first
+    full pose take 'orientation', and are malformed without one.
+    '''
+    rows, current = [], orientation
+    for pose, is_full in zip(poses, full):
+        if is_full:
+            row     = list(pose[0]) + list(pose[1]) if len(pose) == 2 else list(pose)
+            current = row[3:7]
+        elif current is None:
+            log.warn('Recieved positions before any orientation')
+            raise NameError('Malformed coordinate!')
+        else:
+            row = list(pose) + list(current)
+        rows.append(row)
+    return rows
+
+
+def check_poses(poses, unit_tolerance=1e-3, orientation=None):
+    '''
+    Converts poses to a float array, and checks them all before anything is
+    sent. Accepts a list of [[XYZ], [Quats]], or an array of shape (N, 7),
+    or positions only as (N, 3). A list may mix positions with full poses:
+    it is returned as (N, 7), see fill_orientations for the orientation
+    each position is given. Raises NameError (like check_coordinates)
+    for malformed or non-finite poses, or quaternions that aren't unit
+    length to within unit_tolerance.
+    '''
+    if isinstance(poses, np.ndarray):
+        array = poses.astype(float, copy=False)
+    else:
+        poses = list(poses)
+        if len(poses) == 0:
+            return np.zeros((0, 7))
+        full = orientation_mask(poses)
+        try:
+            if full is not None:
+                array = np.array(fill_orientations(poses, full, orientation), dtype=float)
+            elif len(poses[0]) == 2:
+                array = np.array([list(p[0]) + list(p[1]) for p in poses], dtype=float)
+            else:
+                array = np.array(poses, dtype=float)
+        except (TypeError, ValueError):
+            log.warn('Recieved malformed poses')
+            raise NameError('Malformed coordinate!')
+
+    if array.ndim != 2 or array.shape[1] not in (3, 7):
+        log.warn('Recieved poses of shape %s, expected (N, 3) or (N, 7)',
+                 str(array.shape))
+        raise NameError('Malformed coordinate!')
+    bad = ~np.isfinite(array).all(axis=1)
+    if array.shape[1] == 7:
+        norms = np.sqrt((array[:, 3:7]**2).sum(axis=1))
+        bad  |= ~(np.abs(norms - 1.0) <= unit_tolerance)
+    if bad.any():
+        rows = np.flatnonzero(bad)
+        log.warn('Recieved %i malformed poses, first at index %i: %s',
+                 len(rows), rows[0], str(array[rows[0]].tolist()))
+        raise NameError('Malformed coordinate!')
+    return array
+
+
+def encode_poses(poses, scale_linear=1.0, specs=POSE_SPECS):
+    '''
+    Same as abb.Robot.format_pose for every row of an (N, 7) array
+    '''
+    values = np.array(poses, dtype=float)
+    values[:, 0:3] *= scale_linear
+    return encode(values, specs)
+
+
+def encode_positions(positions, scale_linear=1.0, specs=POSITION_SPECS):
+    '''
+    Same as abb.Robot.format_pos for every row of an (N, 3) array
+    '''
+    return encode(np.asarray(positions, dtype=float) * scale_linear, specs)
+
+
+def encode_orientations(orientations, specs=ORIENTATION_SPECS):
+    '''
+    Same as abb.Robot.format_orient for every row of an (N, 4) array
+    '''
+    return encode(orientations, specs)
+
+
+def buffer_rows(poses, scale_linear=1.0, bulk_specs=BULK_SPECS,
+                orientation_specs=ORIENTATION_SPECS):
+    '''
+    Yields (orientation message or None, "x y z ") for each pose, as used
+    by abb.Robot.pack_buffer. The orientation message ("29 ...") is only
+    given where the orientation differs from the pose before. In a list
+    that mixes positions with full poses, positions never have one: they
+    keep the orientation already set, as buffer_add does.
+    '''
+    if not isinstance(poses, np.ndarray): poses = list(poses)
+    full = orientation_mask(poses)
+    if full is None:
+        array = check_poses(poses)
+    else:
+        # Positions before the first full pose use the controller's
+        # orientation; the one they are given here is never sent
+        array = check_poses(poses, orientation=ORIENTATION_FILL)
+    positions = encode(array[:, 0:3] * scale_linear, bulk_specs, end=' ')
+    if array.shape[1] == 3:
+        for position in positions:
+            yield None, position
+        return
+    orients = np.array(encode_orientations(array[:, 3:7], orientation_specs))
+    changed = np.ones(len(orients), dtype=bool)
+    changed[1:] = orients[1:] != orients[:-1]
+    if full is not None:
+        changed[np.argmax(full)] = True
+        changed &= full
+    for position, orient, change in zip(positions, orients.tolist(), changed.tolist()):
+        yield ("29 " + orient if change else None), position
+
+
+if __name__ == '__main__':
+    print("abb_encoder is a library, see the example at the top of the file")
@@ -0,0 +1,174 @@
+'''
+David Pollard
+
+FARSCOPE CDT
+Bristol Robotics Laboratory
+
+abb_frames.py
+ - Transforms whole toolpaths between frames (work objects and tools)
+   with NumPy: an (N, 7) array of [x, y, z, q1, q2, q3, q4] poses is moved
+   from one frame to another in one call
+ - Quaternions are ABB's [q1, q2, q3, q4] = [w, x, y, z]
+ - The work objects and tools of Robot_Config.robot_config are made into
+   Frames (rotation matrix and unit quaternion) once, at import
+   (WORKOBJECTS, TOOLS)
+
+Released under the MIT License
+
+Example:
+    # A path printed on the flat plate, printed on the 90 degree plate
+    # in the same place relative to the robot
+    poses = abb_frames.transform(poses, abb_frames.workobject(0),
+                                 abb_frames.workobject(2))
+    # or in the same place relative to the plate, 5 mm above it
+    R.set_workobject(abb_frames.as_pose(abb_frames.workobject(2, z_offset = 5)))
+
+'''
+
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+import abb_encoder
+from Robot_Config import robot_config
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# A frame's origin and unit quaternion in its parent frame, and the
+# quaternion as a rotation matrix
+Frame = namedtuple('Frame', ['position', 'quaternion', 'matrix'])
+
+
+def quat_multiply(a, b):
+    '''
+    Hamilton product a * b of (..., 4) quaternions, broadcast
+    '''
+    w1, x1, y1, z1 = np.moveaxis(np.asarray(a, dtype=float), -1, 0)
+    w2, x2, y2, z2 = np.moveaxis(np.asarray(b, dtype=float), -1, 0)
+    return np.stack((w1*w2 - x1*x2 - y1*y2 - z1*z2,
+                     w1*x2 + x1*w2 + y1*z2 - z1*y2,
+                     w1*y2 - x1*z2 + y1*w2 + z1*x2,
+                     w1*z2 + x1*y2 - y1*x2 + z1*w2), axis=-1)
+
+
+def quat_conjugate(q):
+    return np.asarray(q, dtype=float) * [1, -1, -1, -1]
+
+
+def quat_matrix(q):
+    '''
+    Rotation matrices (..., 3, 3) of unit quaternions (..., 4)
+    '''
+    w, x, y, z = np.moveaxis(np.asarray(q, dtype=float), -1, 0)
+    return np.stack((np.stack((1 - 2*(y*y + z*z), 2*(x*y - w*z), 2*(x*z + w*y)), axis=-1),
+                     np.stack((2*(x*y + w*z), 1 - 2*(x*x + z*z), 2*(y*z - w*x)), axis=-1),
+                     np.stack((2*(x*z - w*y), 2*(y*z + w*x), 1 - 2*(x*x + y*y)), axis=-1)),
+                    axis=-2)
+
+
+def frame(pose):
+    '''
+    Frame of a pose [[XYZ], [Quats]] (or a 7 element array). The
+    quaternion is normalised, as the controller does.
+    '''
+    pose = np.asarray(abb_encoder.check_poses([pose], unit_tolerance=np.inf)[0])
+    q    = pose[3:7] / np.sqrt((pose[3:7]**2).sum())
+    return Frame(pose[0:3], q, quat_matrix(q))
+
+
+def as_pose(f):
+    '''
+    [[XYZ], [Quats]] of a Frame, e.g. for set_workobject or set_tool
+    '''
+    return [f.position.tolist(), f.quaternion.tolist()]
+
+
+def compose(parent, child):
+    '''
+    Frame of child (given in parent) in parent's own parent frame
+    '''
+    return Frame(parent.position + parent.matrix @ child.position,
+                 quat_multiply(parent.quaternion, child.quaternion),
+                 parent.matrix @ child.matrix)
+
+
+def inverse(f):
+    '''
+    Frame of f's parent, given in f
+    '''
+    matrix = f.matrix.T
+    return Frame(-matrix @ f.position, quat_conjugate(f.quaternion), matrix)
+
+
+def relative(source, target):
+    '''
+    Frame of source given in target, both given in the same frame (None
+    for that frame itself)
+    '''
+    if target is None: return source if source is not None else IDENTITY
+    if source is None: return inverse(target)
+    return compose(inverse(target), source)
+
+
+def offset(f, z_offset):
+    '''
+    f moved z_offset mm along its own Z axis, e.g. a work object raised
+    above the bed it is on
+    '''
+    return Frame(f.position + f.matrix[:, 2] * z_offset, f.quaternion, f.matrix)
+
+
+def transform(poses, source, target=None):
+    '''
+    Returns poses (given in the frame source) given in the frame target,
+    both Frames in the same frame, or None for that frame itself (e.g. the
+    robot base for work objects). poses are as buffer_set takes them:
+    [[XYZ], [Quats]] or [XYZ] each, or an (N, 7) or (N, 3) array, and an
+    array of the same width is returned.
+    '''
+    array = abb_encoder.check_poses(poses)
+    f     = relative(source, target)
+    out   = np.empty_like(array)
+    out[:, 0:3] = array[:, 0:3] @ f.matrix.T + f.position
+    if array.shape[1] == 7:
+        out[:, 3:7] = quat_multiply(f.quaternion, array[:, 3:7])
+    return out
+
+
+def change_tool(poses, source, target):
+    '''
+    Returns poses of the tool Frame target that put the flange where poses
+    of the tool Frame source put it, e.g. to drive a different nozzle
+    along the same path. poses are (N, 7), as for transform.
+    '''
+    array  = abb_encoder.check_poses(poses)
+    flange = inverse(source)
+    # Pose * flange * target for every pose at once
+    step   = compose(flange, target)
+    q      = array[:, 3:7]
+    out    = np.empty_like(array)
+    out[:, 0:3] = array[:, 0:3] + (quat_matrix(q) @ step.position)
+    out[:, 3:7] = quat_multiply(q, step.quaternion)
+    return out
+
+
+IDENTITY    = Frame(np.zeros(3), np.array([1.0, 0, 0, 0]), np.eye(3))
+WORKOBJECTS = [frame(w) for w in robot_config.WObjData]
+TOOLS       = {'Tool': frame(robot_config.Tool), 'FauxTool': frame(robot_config.FauxTool)}
+
+
+def workobject(number, z_offset=0):
+    '''
+    Frame of work object 'number' of robot_config, moved z_offset mm along
+    its Z axis
+    '''
+    if not 0 <= number < len(WORKOBJECTS):
+        raise Exception("Unrecognised WObj Number")
+    if z_offset == 0: return WORKOBJECTS[number]
+    return offset(WORKOBJECTS[number], z_offset)
+
+
+if __name__ == '__main__':
+    print("abb_frames is a library, see the example at the top of the file")
@@ -0,0 +1,332 @@
+'''
+David Pollard
+
+FARSCOPE CDT
+Bristol Robotics Laboratory
+
+abb_gcode.py
+ - Prints G-code from a slicer, streamed through generators so memory
+   stays the same for any size of file:
+     parse:   lines -> Move for each point (G0/G1, and G2/G3 arcs split
+              into short lines), with the feed rate and extrusion
+     batches: Moves -> Batch of at most MAX_BUFFER poses, with extrusion
+              on or off, and the speed and GO value for the extruder of
+              each move
+     simplified: (optional) Batches -> Batches with nearly collinear
+              points removed (abb_path.simplify)
+     execute: Batches -> set_speed, set_go, buffer_set, buffer_set_speeds
+              and buffer_execute on abb.Robot or abb_testing.Robot
+ - Consecutive batches with the same extrusion are joined (see
+   abb.Robot.buffer_execute), so the robot only stops, and starts or
+   stops extruding, where the G-code does
+
+Released under the MIT License
+
+Example:
+    with open('part.gcode') as f:
+        abb_gcode.execute(R, abb_gcode.batches(abb_gcode.parse(f),
+                                               go_table = [(10, 40), (40, 160)]))
+or:
+    abb_gcode.print_file(R, 'part.gcode', go_table = [(10, 40), (40, 160)])
+
+'''
+
+import re
+import math
+import logging
+from collections import namedtuple
+
+import abb
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# A point of the toolpath: position (mm), feed rate (mm/min, None before
+# the first F), whether filament is extruded on the way to it, and whether
+# it is a G0 move
+Move = namedtuple('Move', ['x', 'y', 'z', 'feed', 'extrude', 'rapid'])
+
+# Poses sent in one buffer, with the speed ([v_tcp, v_ori, v_leax, v_reax])
+# and GO value (None for travel, or without a go_table) of the first move,
+# and whether they are joined to the batches before and after. Where the
+# moves differ, speeds and go_values hold the TCP speed (mm/s) and GO value
+# of the move to each pose (see abb.Robot.buffer_set_speeds), else None.
+Batch = namedtuple('Batch', ['poses', 'speed', 'go', 'extrude',
+                             'join_start', 'join_end', 'speeds', 'go_values'])
+
+WORD = re.compile(r'([A-Z])\s*([-+]?(?:[0-9]+\.?[0-9]*|\.[0-9]+))')
+
+
+def words(line):
+    '''
+    Returns {letter: value} for a line of G-code, without comments.
+    G and M are lists, as a line can hold several.
+    '''
+    line = line.split(';', 1)[0]
+    if '(' in line: line = re.sub(r'\([^)]*\)', '', line)
+    result = {'G': [], 'M': []}
+    for letter, value in WORD.findall(line.upper()):
+        if letter in 'GM': result[letter].append(float(value))
+        else:              result[letter] = float(value)
+    return result
+
+
+def parse(lines, arc_tolerance = 0.05):
+    '''
+    Yields a Move for each point the G-code moves through, reading lines
+    (e.g. an open file) one at a time.
+     - G0/G1 linear moves, G2/G3 arcs (with I and J, split into lines no
+       more than arc_tolerance mm from the arc)
+     - F, feed rate (modal), G20/G21 inches or millimeters, G90/G91
+       absolute or relative positions (and E, as Marlin does), M82/M83
+       absolute or relative E after them, G92 to set the position
+     - A move extrudes if E increases. Moves that don't change the
+       position (e.g. retractions) give no point.
+    '''
+    position   = [0.0, 0.0, 0.0]
+    e          = 0.0
+    feed       = None
+    scale      = 1.0
+    relative   = False
+    relative_e = False
+    motion     = None
+
+    for number, line in enumerate(lines, 1):
+        w = words(line)
+        for g in w['G']:
+            if   g in (0, 1, 2, 3): motion = int(g)
+            elif g == 20:           scale = 25.4
+            elif g == 21:           scale = 1.0
+            elif g == 90:           relative = relative_e = False
+            elif g == 91:           relative = relative_e = True
+            elif g == 92:
+                for i, axis in enumerate('XYZ'):
+                    if axis in w: position[i] = w[axis] * scale
+                if 'E' in w: e = w['E'] * scale
+        for m in w['M']:
+            if   m == 82: relative_e = False
+            elif m == 83: relative_e = True
+        # Only G0-G3 move (e.g. G28's axis words aren't a move)
+        if motion is None or any(g not in (0, 1, 2, 3) for g in w['G']): continue
+        if 'F' in w: feed = w['F'] * scale
+        if not any(axis in w for axis in 'XYZE'): continue
+
+        target = list(position)
+        for i, axis in enumerate('XYZ'):
+            if axis in w:
+                target[i] = w[axis] * scale + (position[i] if relative else 0.0)
+        extrude = False
+        if 'E' in w:
+            new_e   = w['E'] * scale + (e if relative_e else 0.0)
+            extrude = new_e > e
+            e       = new_e
+
+        if motion in (2, 3):
+            if 'R' in w:
+                raise Exception("Line %i: arcs with R aren't supported, use I and J" % number)
+            center = (position[0] + w.get('I', 0.0) * scale,
+                      position[1] + w.get('J', 0.0) * scale)
+            for point in arc_points(position, target, center, motion == 2, arc_tolerance):
+                yield Move(point[0], point[1], point[2], feed, extrude, False)
+        elif target != position:
+            yield Move(target[0], target[1], target[2], feed, extrude, motion == 0)
+        position = target
+
+
+def arc_points(start, end, center, clockwise, tolerance):
+    '''
+    Points along an arc in XY (a helix if Z changes) from start to end,
+    ending at end. A full circle if start and end are the same.
+    '''
+    radius = math.hypot(start[0] - center[0], start[1] - center[1])
+    a0 = math.atan2(start[1] - center[1], start[0] - center[0])
+    a1 = math.atan2(end[1] - center[1], end[0] - center[0])
+    sweep = a1 - a0
+    if clockwise:
+        if sweep >= 0: sweep -= 2 * math.pi
+    elif sweep <= 0:
+        sweep += 2 * math.pi
+    if radius > tolerance:
+        step = 2 * math.acos(1 - tolerance / radius)
+        n    = max(1, int(math.ceil(abs(sweep) / step)))
+    else:
+        n = 1
+    for i in range(1, n):
+        angle = a0 + sweep * i / n
+        yield (center[0] + radius * math.cos(angle),
+               center[1] + radius * math.sin(angle),
+               start[2] + (end[2] - start[2]) * i / n)
+    yield tuple(end)
+
+
+def check_go_table(go_table):
+    '''
+    go_table sorted by speed, without repeated pairs. Raises if it gives
+    more than one GO value for a speed.
+    '''
+    table  = sorted(set((float(s), float(g)) for s, g in go_table))
+    speeds = [s for s, g in table]
+    if len(set(speeds)) != len(speeds):
+        raise Exception("go_table has more than one GO value for a speed: %s" %
+                        str(go_table))
+    return table
+
+
+def go_value(speed, go_table):
+    '''
+    GO value for a TCP speed (mm/s), interpolated linearly between the
+    (speed, GO value) pairs of go_table, and held at its ends
+    '''
+    table = check_go_table(go_table)
+    if speed <= table[0][0]:  return int(round(table[0][1]))
+    if speed >= table[-1][0]: return int(round(table[-1][1]))
+    for (s0, g0), (s1, g1) in zip(table, table[1:]):
+        if s0 <= speed <= s1:
+            return int(round(g0 + (g1 - g0) * (speed - s0) / (s1 - s0)))
+
+
+def batches(moves,
+            orientation  = [0,0,1,0],
+            offset       = [0,0,0],
+            speed_scale  = 1.0,
+            travel_speed = None,
+            v_ori        = 50,
+            go_table     = None,
+            size         = abb.MAX_BUFFER):
+    '''
+    Groups Moves into Batches of at most 'size' poses, each extruding or
+    not. Each move keeps its own speed, so a batch only ends where the
+    extrusion changes, or it is full. Only one batch is held at a time
+    (plus the one being filled).
+     - orientation: quaternion of every pose
+     - offset: added to every position, e.g. to place the part in the
+       work object
+     - speed_scale: TCP speed (mm/s) is feed (mm/min) / 60 * speed_scale
+     - travel_speed: speed (mm/s) of G0 moves, by default their feed rate
+     - go_table: [(speed mm/s, GO value), ...] for the extruder (go_value)
+    Raises if a move has no feed rate (no F before it, and no travel_speed
+    for a G0 move), rather than sending a speed of 0.
+    Batches with the same extrusion as the one before are joined to it.
+    buffer_execute moves to the first pose of a batch that starts
+    extruding before switching extrusion on, so those batches start at
+    the last pose of the travel before them.
+    '''
+    if go_table: check_go_table(go_table)
+    previous = None
+    poses    = []
+    speeds   = []
+    extrude  = None
+    for move in moves:
+        if move.rapid and travel_speed is not None:
+            v_tcp = float(travel_speed)
+        elif move.feed is None:
+            raise Exception("No feed rate (F) for the move to X%g Y%g Z%g" %
+                            (move.x, move.y, move.z))
+        else:
+            v_tcp = move.feed / 60.0 * speed_scale
+        # As buffer_set_speeds sends them
+        v_tcp = round(v_tcp, 1)
+        if poses and (bool(move.extrude) != extrude or len(poses) >= size):
+            batch = make_batch(poses, speeds, extrude, v_ori, go_table)
+            if previous is not None:
+                yield join(previous, batch)
+                batch = batch._replace(join_start = previous.extrude == batch.extrude)
+            previous, poses, speeds = batch, [], []
+        extrude = bool(move.extrude)
+        if not poses and move.extrude and previous is not None and not previous.extrude:
+            # Moved to before extrusion starts, so at the speed of the first move
+            poses.append(previous.poses[-1])
+            speeds.append(v_tcp)
+        poses.append([[move.x + offset[0], move.y + offset[1], move.z + offset[2]],
+                      list(orientation)])
+        speeds.append(v_tcp)
+    if poses:
+        batch = make_batch(poses, speeds, extrude, v_ori, go_table)
+        if previous is not None:
+            yield join(previous, batch)
+            batch = batch._replace(join_start = previous.extrude == batch.extrude)
+        previous = batch
+    if previous is not None:
+        yield previous
+
+
+def make_batch(poses, speeds, extrude, v_ori, go_table):
+    if extrude and go_table: go_values = [go_value(v, go_table) for v in speeds]
+    else:                    go_values = None
+    speed = [speeds[0], v_ori, 50, 50]
+    go    = go_values[0] if go_values else None
+    # Every pose gets the speed set before the upload, as buffer_add does
+    if all(v == speeds[0] for v in speeds): speeds = go_values = None
+    return Batch(poses, speed, go, extrude, False, False, speeds, go_values)
+
+
+def join(batch, following):
+    return batch._replace(join_end = batch.extrude == following.extrude)
+
+
+def simplified(batches, tolerance):
+    '''
+    Removes the points of each Batch that are within tolerance (mm) of
+    the path through the others (see abb_path.simplify), e.g. the zone
+    size. The ends of each batch are kept, so joins are unchanged. Each
+    point kept keeps the speed of the move to it.
+    '''
+    import abb_path
+    points = removed = 0
+    worst  = 0.0
+    for batch in batches:
+        result   = abb_path.simplify(batch.poses, tolerance)
+        points  += len(batch.poses)
+        removed += result.removed
+        worst    = max(worst, result.max_deviation)
+        if batch.speeds is not None:
+            batch = batch._replace(speeds = [batch.speeds[i] for i in result.kept])
+        if batch.go_values is not None:
+            batch = batch._replace(go_values = [batch.go_values[i] for i in result.kept])
+        yield batch._replace(poses = result.poses)
+    log.info('Simplified G-code: removed %i of %i points, max deviation %.3f mm',
+             removed, points, worst)
+
+
+def execute(robot, batches):
+    '''
+    Sends Batches to robot (abb.Robot or abb_testing.Robot), in order.
+    set_speed and set_go are only sent when they change. Batches whose
+    moves differ in speed are given them with buffer_set_speeds.
+    Returns the number of poses executed, or raises if an upload fails.
+    '''
+    speed = go = None
+    count = 0
+    for batch in batches:
+        if batch.speed != speed:
+            robot.set_speed(batch.speed)
+            speed = batch.speed
+        if batch.go is not None and batch.go != go:
+            robot.set_go(batch.go)
+            go = batch.go
+        if (robot.buffer_set(batch.poses) is False or
+            (batch.speeds is not None and
+             not robot.buffer_set_speeds(batch.speeds, batch.go_values))):
+            if batch.join_start: robot.set_dio(0)
+            raise Exception("Failed to upload %i poses after %i" %
+                            (len(batch.poses), count))
+        robot.buffer_execute(batch.extrude, join_start = batch.join_start,
+                             join_end = batch.join_end)
+        count += len(batch.poses)
+    log.info('Executed %i poses of G-code', count)
+    return count
+
+
+def print_file(robot, filename, arc_tolerance = 0.05, tolerance = None, **kwargs):
+    '''
+    execute(robot, batches(parse(file))), with kwargs for batches.
+    With a tolerance (mm), batches are simplified first.
+    '''
+    with open(filename) as f:
+        stages = batches(parse(f, arc_tolerance), **kwargs)
+        if tolerance is not None: stages = simplified(stages, tolerance)
+        return execute(robot, stages)
+
+
+if __name__ == '__main__':
+    print("abb_gcode is a library, see the example at the top of the file")
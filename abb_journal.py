@@ -0,0 +1,268 @@
+'''
+David Pollard
+
+FARSCOPE CDT
+Bristol Robotics Laboratory
+
+abb_journal.py
+ - Journal: records every message abb.Robot sends on the motion socket,
+   and every reply, with monotonic timestamps (abb.Robot(journal=...))
+ - The file is append-only binary, written as the print runs through a
+   fixed size buffer, so memory stays the same for any length of print.
+   Each connection starts a new session in it.
+ - replay: sends a journal's messages to a server (by default a local
+   abb_emulator) in the same order, interleaved with waiting for replies
+   as they were, at the original pace or as fast as possible. Reports the
+   throughput, and every reply that differs from the one recorded.
+
+File format: MAGIC, then records of RECORD (kind, time in ns, length of
+the payload) followed by the payload:
+    SESSION   {"remote": [host, port], "time": wall clock time} as JSON
+    SENT      the bytes sent (text, or a binary frame), a reply is expected
+    NO_REPLY  the bytes sent, without waiting for a reply (e.g. "99 #")
+    RECEIVED  the reply, without its '#'
+    ERROR     no valid reply was received (e.g. a timeout), and why
+
+Released under the MIT License
+
+Example:
+    R = abb.Robot('192.168.125.1', journal = 'print.journal')
+    ...
+    R.close()
+    result = abb_journal.replay('print.journal')
+    print(result.rate, result.divergent)
+or, to close the journal however the print ends:
+    with abb_journal.Journal('print.journal') as J:
+        R = abb.Robot('192.168.125.1', journal = J)
+        ...
+and to replay it from the command line:
+    python abb_journal.py print.journal [--paced] [--host HOST --port PORT]
+
+'''
+
+import sys
+import json
+import time
+import socket
+import struct
+import logging
+import argparse
+from collections import deque, namedtuple
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+MAGIC  = b'ABBJOURNAL1\n'
+RECORD = struct.Struct('<BqH')
+SESSION, SENT, NO_REPLY, RECEIVED, ERROR = range(5)
+
+# Bytes buffered before they are written to the file
+BUFFER_SIZE = 1 << 16
+
+# A record read back: kind, time (s, monotonic) and payload
+Record = namedtuple('Record', ['kind', 'time', 'payload'])
+
+# A reply that differs from the one recorded: the message (numbered from
+# 1 in the order sent), its reply in the journal, and on replay (None if
+# there was none)
+Divergence = namedtuple('Divergence', ['index', 'message', 'expected', 'got'])
+
+# Result of replay: messages sent, replies compared and how many differed
+# (the first max_divergences are kept), seconds taken and messages per
+# second, against the seconds the recorded sessions took
+Replay = namedtuple('Replay', ['sessions', 'messages', 'replies', 'divergent', 'duration',
+                               'rate', 'recorded_duration', 'divergences'])
+
+
+class Journal:
+    def __init__(self, filename):
+        '''
+        Appends to filename, creating it if it doesn't exist
+        '''
+        self.filename = filename
+        self.file     = open(filename, 'ab', buffering = BUFFER_SIZE)
+        if self.file.tell() == 0: self.file.write(MAGIC)
+        self.records  = 0
+
+    def write(self, kind, payload):
+        self.file.write(RECORD.pack(kind, time.monotonic_ns(), len(payload)))
+        self.file.write(payload)
+        self.records += 1
+
+    def session(self, remote):
+        self.write(SESSION, json.dumps({'remote': list(remote),
+                                        'time'  : time.time()}).encode())
+
+    def sent(self, data, reply = True):
+        self.write(SENT if reply else NO_REPLY, data)
+
+    def received(self, reply):
+        self.write(RECEIVED, reply)
+
+    def error(self, error):
+        '''
+        Records that no valid reply was received, and writes the journal
+        to the file at once, as the session may be about to end
+        '''
+        self.write(ERROR, str(error).encode())
+        self.flush()
+
+    def flush(self):
+        self.file.flush()
+
+    def close(self):
+        if self.file.closed: return
+        self.file.close()
+        log.info('Journal %s closed after %i records', self.filename, self.records)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+
+def read(filename):
+    '''
+    Yields each Record of a journal in order, reading it a buffer at a time
+    '''
+    with open(filename, 'rb', buffering = BUFFER_SIZE) as f:
+        if f.read(len(MAGIC)) != MAGIC:
+            raise Exception("%s isn't a journal" % filename)
+        while True:
+            header = f.read(RECORD.size)
+            if len(header) < RECORD.size: return
+            kind, ns, length = RECORD.unpack(header)
+            payload = f.read(length)
+            if len(payload) < length:
+                log.warn('Journal %s ends part way through a record', filename)
+                return
+            yield Record(kind, ns * 1e-9, payload)
+
+
+class ReplyReader:
+    '''
+    Reads '#' terminated replies from a socket, as abb.Robot.recv_reply
+    '''
+    def __init__(self, sock, timeout):
+        self.sock    = sock
+        self.timeout = timeout
+        self.buffer  = b''
+
+    def next(self):
+        '''
+        Returns the next reply (without '#'), or None if none arrives in time
+        '''
+        deadline = time.monotonic() + self.timeout
+        while b'#' not in self.buffer:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0: return None
+            self.sock.settimeout(remaining)
+            try:
+                chunk = self.sock.recv(4096)
+            except socket.timeout:
+                return None
+            if not chunk: return None
+            self.buffer += chunk
+        reply, _, self.buffer = self.buffer.partition(b'#')
+        return reply.strip()
+
+
+def replay(filename, remote = None, paced = False, timeout = 5.0, max_divergences = 100):
+    '''
+    Sends the messages of a journal to remote (host, port), reconnecting
+    for each session, and compares each reply with the one recorded.
+    Replies are waited for where the journal received them, so pipelined
+    commands stay pipelined.
+     - remote: None starts an abb_emulator for the replay
+     - paced: sends each message at the time it was sent originally
+       (relative to the start of its session), otherwise at once
+     - timeout: seconds to wait for each reply
+    Returns a Replay.
+    '''
+    emulator = None
+    if remote is None:
+        import abb_emulator
+        emulator = abb_emulator.Emulator().start()
+        remote   = (emulator.host, emulator.port)
+
+    sock = reader = None
+    sessions = messages = replies = divergent = 0
+    recorded    = 0.0
+    divergences = []
+    pending     = deque()       # (index, message) of messages awaiting a reply
+    begin = session_start = time.monotonic()
+    recorded_start = last = None
+    try:
+        for record in read(filename):
+            if record.kind == SESSION:
+                if sock is not None: sock.close()
+                if recorded_start is not None: recorded += last - recorded_start
+                sock = socket.create_connection(remote, timeout)
+                sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+                reader = ReplyReader(sock, timeout)
+                pending.clear()
+                sessions += 1
+                recorded_start = last = record.time
+                session_start  = time.monotonic()
+                continue
+            if sock is None:
+                raise Exception("%s has records before its first session" % filename)
+            last = record.time
+
+            if record.kind in (SENT, NO_REPLY):
+                if paced:
+                    delay = (record.time - recorded_start) - (time.monotonic() - session_start)
+                    if delay > 0: time.sleep(delay)
+                sock.sendall(record.payload)
+                messages += 1
+                if record.kind == SENT: pending.append((messages, record.payload))
+            elif record.kind in (RECEIVED, ERROR):
+                if not pending: continue
+                index, message = pending.popleft()
+                got = reader.next()
+                expected = record.payload if record.kind == RECEIVED else None
+                replies += 1
+                if got != expected:
+                    divergent += 1
+                    if len(divergences) < max_divergences:
+                        divergences.append(Divergence(index, message, expected, got))
+        if recorded_start is not None: recorded += last - recorded_start
+    finally:
+        if sock is not None: sock.close()
+        if emulator is not None: emulator.stop()
+
+    duration = time.monotonic() - begin
+    result   = Replay(sessions, messages, replies, divergent, duration,
+                      messages / duration if duration > 0 else 0.0, recorded, divergences)
+    log.info('Replayed %i messages in %.3fs (%.0f/s, recorded in %.3fs), %i of %i replies differ',
+             messages, duration, result.rate, recorded, divergent, replies)
+    return result
+
+
+def main(argv = None):
+    parser = argparse.ArgumentParser(description = 'Replay an abb.Robot journal')
+    parser.add_argument('journal')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = None,
+                        help = 'server to replay against, by default a local abb_emulator')
+    parser.add_argument('--paced', action = 'store_true',
+                        help = 'send at the original pace, rather than as fast as possible')
+    parser.add_argument('--timeout', type = float, default = 5.0)
+    args = parser.parse_args(argv)
+
+    remote = (args.host, args.port) if args.port is not None else None
+    result = replay(args.journal, remote, args.paced, args.timeout)
+    output = result._asdict()
+    output['divergences'] = [{'index'   : d.index,
+                              'message' : d.message.decode('ascii', 'replace'),
+                              'expected': None if d.expected is None else d.expected.decode('ascii', 'replace'),
+                              'got'     : None if d.got is None else d.got.decode('ascii', 'replace')}
+                             for d in result.divergences]
+    json.dump(output, sys.stdout, indent = 2)
+    print()
+    return 1 if result.divergent else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,196 @@
+'''
+David Pollard
+
+FARSCOPE CDT
+Bristol Robotics Laboratory
+
+abb_logger.py
+ - Streams pose and joint records from the LOGGER task (LOGGER.mod)
+ - Runs in a background thread, so the motion socket isn't polled
+ - Records are kept in fixed size NumPy ring buffers
+
+Released under the MIT License
+
+Example:
+    L = abb_logger.Logger(('192.168.125.1', 5001))
+    L.start()
+    t, pose = L.latest_pose()
+    path = L.poses.window(500)          # Last 500 samples, oldest first
+
+'''
+
+import socket
+import time
+import logging
+from threading import Thread
+
+import numpy as np
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Record types sent by LOGGER.mod
+RECORD_POSE   = 0
+RECORD_JOINTS = 1
+
+
+class RingBuffer:
+    '''
+    Fixed size buffer of samples, each a row of 'width' floats.
+    One thread writes, any number read without locks: readers note the
+    write count before copying, and retry if a write that overwrites the
+    rows they copied had started by the time they finished.
+    '''
+    def __init__(self, maxlen, width):
+        self.maxlen  = int(maxlen)
+        self.data    = np.zeros((self.maxlen, width))
+        self.count   = 0        # Total samples written
+        self.started = 0        # Total samples written, or being written
+
+    def append(self, row):
+        self.started = self.count + 1
+        self.data[self.count % self.maxlen] = row
+        self.count = self.started
+
+    def __len__(self):
+        return min(self.count, self.maxlen)
+
+    def latest(self):
+        '''
+        Returns a copy of the newest sample, or None if there isn't one
+        '''
+        while True:
+            count = self.count
+            if count == 0: return None
+            row = self.data[(count - 1) % self.maxlen].copy()
+            if self.started <= count - 1 + self.maxlen:
+                return row
+
+    def window(self, n=None):
+        '''
+        Returns a copy of the newest n samples (all of them if n is None),
+        oldest first
+        '''
+        while True:
+            count = self.count
+            if n is None: size = min(count, self.maxlen)
+            else:         size = min(n, count, self.maxlen)
+            start = (count - size) % self.maxlen
+            if start + size <= self.maxlen:
+                rows = self.data[start:start + size].copy()
+            else:
+                rows = np.concatenate((self.data[start:],
+                                       self.data[:start + size - self.maxlen]))
+            if self.started <= count - size + self.maxlen:
+                return rows
+
+    def since(self, t, column=0):
+        '''
+        Returns the samples whose 'column' (by default the time the PC
+        received them) is at least t, oldest first
+        '''
+        rows = self.window()
+        return rows[np.searchsorted(rows[:, column], t):]
+
+
+class Logger:
+    def __init__(self,
+                 remote = ('192.168.125.1', 5001),
+                 maxlen = 10000):
+        '''
+        Stores the newest 'maxlen' records of each type:
+         - poses:  [PC time, controller time, x, y, z, q1, q2, q3, q4]
+         - joints: [PC time, controller time, j1, j2, j3, j4, j5, j6]
+        PC time is time.monotonic() when the record arrived.
+        '''
+        self.remote  = remote
+        self.poses   = RingBuffer(maxlen, 9)
+        self.joints  = RingBuffer(maxlen, 8)
+        self.running = False
+        self.thread  = None
+        self.reconnect_delay = 0.5
+
+    def start(self):
+        if self.running: return self
+        self.running = True
+        self.thread  = Thread(target = self.run, name = 'abb_logger')
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.running = False
+        if self.thread is not None:
+            self.thread.join()
+        self.thread = None
+
+    def latest_pose(self):
+        '''
+        Returns (controller time, [[x,y,z], [q1,q2,q3,q4]]) of the newest pose
+        '''
+        row = self.poses.latest()
+        if row is None: return None
+        return float(row[1]), [row[2:5].tolist(), row[5:9].tolist()]
+
+    def latest_joints(self):
+        '''
+        Returns (controller time, [j1, ..., j6]) of the newest joint record
+        '''
+        row = self.joints.latest()
+        if row is None: return None
+        return float(row[1]), row[2:8].tolist()
+
+    def run(self):
+        '''
+        Thread loop: (re)connects to the logger and reads records until
+        stop() is called
+        '''
+        while self.running:
+            try:
+                sock = socket.create_connection(self.remote, timeout=2.5)
+            except OSError as e:
+                log.warn('Could not connect to logger at %s: %s',
+                         str(self.remote), e)
+                time.sleep(self.reconnect_delay)
+                continue
+            log.info('Connected to robot logger at %s', str(self.remote))
+            try:
+                self.read(sock)
+            except OSError as e:
+                log.warn('Lost connection to logger: %s', e)
+            finally:
+                sock.close()
+
+    def read(self, sock):
+        sock.settimeout(0.5)
+        pending = b''
+        while self.running:
+            try:
+                chunk = sock.recv(4096)
+            except socket.timeout:
+                continue
+            if not chunk:
+                raise ConnectionError('Logger closed the connection')
+            received = time.monotonic()
+            records  = (pending + chunk).split(b'#')
+            # The last piece is an incomplete record (or empty)
+            pending  = records.pop()
+            for record in records:
+                self.parse(record, received)
+
+    def parse(self, record, received):
+        try:
+            values = [float(s) for s in record.split()]
+        except ValueError:
+            log.warn('Malformed logger record: %s', record)
+            return
+        if len(values) == 9 and values[0] == RECORD_POSE:
+            self.poses.append([received] + values[1:])
+        elif len(values) == 8 and values[0] == RECORD_JOINTS:
+            self.joints.append([received] + values[1:])
+        elif values:
+            log.warn('Malformed logger record: %s', record)
+
+
+if __name__ == '__main__':
+    print("abb_logger is a library, see the example at the top of the file")
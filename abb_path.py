@@ -0,0 +1,238 @@
+'''
+David Pollard
+
+FARSCOPE CDT
+Bristol Robotics Laboratory
+
+abb_path.py
+ - Operations on whole toolpaths with NumPy, before they are uploaded
+ - simplify: removes points while keeping the path within a tolerance
+   (Douglas-Peucker, every segment of the path split at once)
+ - plan: a TCP speed and an extruder GO value for the move to each pose
+ - move_times: how long each move takes, with acceleration and blending
+
+Released under the MIT License
+
+Example:
+    result = abb_path.simplify(pose_list, tolerance = 1.0)
+    R.buffer_set(result.poses)
+    print(result.removed, result.max_deviation)
+
+'''
+
+import logging
+from collections import namedtuple
+
+import numpy as np
+
+import abb_encoder
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# The simplified poses (the same type as given), the indices of the poses
+# kept, how many were removed, and the furthest (mm) any removed point is
+# from the simplified path
+Simplified = namedtuple('Simplified', ['poses', 'kept', 'removed', 'max_deviation'])
+
+# TCP speed (mm/s) of the move to each pose, and the GO value set as it
+# starts (None without a speed matrix)
+Plan = namedtuple('Plan', ['speeds', 'go'])
+
+# Smallest TCP speed (mm/s) plan gives a move, as the controller can't
+# move at 0 (and buffer_set_speeds sends speeds to 0.1 mm/s)
+MIN_SPEED = 1.0
+
+
+def segment_distances(points, starts, ends):
+    '''
+    Distance from each point to the segment from starts to ends (row by row)
+    '''
+    direction = ends - starts
+    length2   = (direction**2).sum(axis=1)
+    t = ((points - starts) * direction).sum(axis=1) / np.where(length2 > 0, length2, 1)
+    t = np.clip(t, 0, 1)
+    return np.sqrt(((points - starts - t[:, None] * direction)**2).sum(axis=1))
+
+
+def deviations(positions, keep):
+    '''
+    Distance of each point from the segment between the kept points either
+    side of it (0 for kept points), and each point's segment number
+    '''
+    kept_index = np.flatnonzero(keep)
+    segment    = np.searchsorted(kept_index, np.arange(len(positions)), side='right') - 1
+    segment    = np.minimum(segment, len(kept_index) - 2)
+    starts     = positions[kept_index[segment]]
+    ends       = positions[kept_index[segment + 1]]
+    distance   = segment_distances(positions, starts, ends)
+    distance[keep] = 0
+    return distance, segment
+
+
+def simplify(poses, tolerance):
+    '''
+    Removes points from a path so that no removed point is more than
+    'tolerance' (mm) from the path through the points kept. The first and
+    last points are always kept, and so is every point where the
+    orientation changes (and the point before it), so only positions are
+    simplified.
+    poses are as buffer_set takes them: [[XYZ], [Quats]] or [XYZ] each, or
+    an (N, 7) or (N, 3) array. Returns a Simplified.
+    '''
+    if not isinstance(poses, np.ndarray): poses = list(poses)
+    array = abb_encoder.check_poses(poses)
+    n     = len(array)
+    keep  = np.zeros(n, dtype=bool)
+    if n <= 2:
+        keep[:] = True
+    else:
+        keep[[0, -1]] = True
+        if array.shape[1] == 7:
+            changed = (array[1:, 3:7] != array[:-1, 3:7]).any(axis=1)
+            keep[1:]  |= changed
+            keep[:-1] |= changed
+        positions = array[:, 0:3]
+        # Each round splits every segment that is out of tolerance at its
+        # furthest point
+        while True:
+            distance, segment = deviations(positions, keep)
+            worst = np.full(keep.sum() - 1, -1.0)
+            np.maximum.at(worst, segment, distance)
+            split = np.flatnonzero(worst > tolerance)
+            if len(split) == 0: break
+            order    = np.lexsort((-distance, segment))
+            first    = np.searchsorted(segment[order], split)
+            keep[order[first]] = True
+
+    kept = np.flatnonzero(keep)
+    max_deviation = 0.0
+    if n > 2: max_deviation = float(deviations(array[:, 0:3], keep)[0].max())
+    if isinstance(poses, np.ndarray): simplified = poses[kept]
+    else:                             simplified = [poses[i] for i in kept]
+    log.debug('Simplified %i points to %i, max deviation %.3f mm',
+              n, len(kept), max_deviation)
+    return Simplified(simplified, kept, n - len(kept), max_deviation)
+
+
+def corner_speeds(positions, zone, accel):
+    '''
+    Largest speed (mm/s) through the corner at each pose: the blend is an
+    arc tangent to both moves, 'zone' mm from the corner (at most half of
+    each move, as the controller does), taken at acceleration 'accel'
+    (mm/s^2). Straight through, at either end, at fine points (zone 0)
+    and either side of a move of no length, there is no limit (inf).
+    '''
+    n      = len(positions)
+    limit  = np.full(n, np.inf)
+    if n < 3: return limit
+    moves  = np.diff(positions, axis=0)
+    length = np.sqrt((moves**2).sum(axis=1))
+    unit   = moves / np.where(length > 0, length, 1)[:, None]
+    cosine = np.clip((unit[:-1] * unit[1:]).sum(axis=1), -1, 1)
+    turn   = np.arccos(cosine)
+    reach  = np.minimum(zone, np.minimum(length[:-1], length[1:]) / 2)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        radius = np.where((turn > 1e-9) & (reach > 0), reach / np.tan(turn / 2), np.inf)
+    limit[1:-1] = np.sqrt(accel * radius)
+    return limit
+
+
+def plan(poses, speed, speed_matrix=None, zone=None, accel=None):
+    '''
+    Returns a Plan for a path (poses as buffer_set takes them):
+     - speed: TCP speed (mm/s) wanted, one value or one for each pose
+     - zone, accel: with both, each move is given the fastest speed it
+       reaches between the corners at its ends (corner_speeds), speeding
+       up and slowing down at accel, so only short moves either side of
+       a tight corner are slowed
+     - speed_matrix: [[speed, GO value], ...]. Speeds are kept within its
+       range, and GO values are interpolated from it.
+    Speeds are at least MIN_SPEED.
+    '''
+    array  = abb_encoder.check_poses(poses)
+    n      = len(array)
+    speeds = np.broadcast_to(np.asarray(speed, dtype=float), (n,)).copy()
+    if zone is not None and accel is not None and n > 1:
+        positions  = array[:, 0:3]
+        length     = np.zeros(n)
+        length[1:] = np.sqrt((np.diff(positions, axis=0)**2).sum(axis=1))
+        # No faster through each pose than its corner, or the moves either side
+        through     = np.minimum(corner_speeds(positions, zone, accel), speeds)
+        through[:-1] = np.minimum(through[:-1], speeds[1:])
+        speeds[1:]  = speed_limits(length, speeds, through, accel)[1]
+    speeds = np.maximum(speeds, MIN_SPEED)
+    go = None
+    if speed_matrix is not None and len(speed_matrix) > 0:
+        matrix = np.asarray(sorted(speed_matrix), dtype=float)
+        speeds = np.clip(speeds, matrix[0, 0], matrix[-1, 0])
+        go     = np.rint(np.interp(speeds, matrix[:, 0], matrix[:, 1])).astype(int)
+    return Plan(speeds, go)
+
+
+def speed_limits(length, speeds, through, accel):
+    '''
+    For a path with moves of 'length' (mm, 0 for the first position) at
+    speeds (mm/s), and no faster than 'through' (mm/s) through each
+    position, returns:
+     - the squared speed through each position, also no more than can be
+       reached from the positions before and after at acceleration accel
+       (mm/s^2), found for the whole path at once from the cumulative
+       reach (v^2 = u^2 + 2as) forwards and backwards
+     - the peak speed of the move to each position after the first,
+       speeding up from the one before and slowing down to it
+    '''
+    # Squared speeds: through each position, no more than from the
+    # position before (or after) plus the reach of the move between
+    reach    = 2 * accel * length
+    total    = np.cumsum(reach)
+    limit    = through**2
+    forward  = total + np.minimum.accumulate(limit - total)
+    reverse  = (limit + total)[::-1]
+    backward = np.minimum.accumulate(reverse)[::-1] - total
+    limit    = np.maximum(np.minimum(limit, np.minimum(forward, backward)), 0)
+    peak     = np.minimum(speeds[1:], np.sqrt((reach[1:] + limit[:-1] + limit[1:]) / 2))
+    return limit, peak
+
+
+def move_times(positions, speeds, zones, stops, accel):
+    '''
+    Time (s) of the move to each position from the one before (0 for the
+    first), moving at speeds (mm/s) with acceleration accel (mm/s^2):
+     - through each position no faster than its corner allows (see
+       corner_speeds, with the zone (mm) of the move to it) or either
+       move's speed, and not at all where stops is True, or at the ends
+     - speeding up and slowing down by accel over each move (see
+       speed_limits)
+    Fine points (zone 0) stop, as the controller does.
+    Orientation is ignored, so moves that only turn the tool take no time.
+    '''
+    positions = np.asarray(positions, dtype=float)
+    n         = len(positions)
+    if n < 2: return np.zeros(n)
+    speeds    = np.maximum(np.broadcast_to(np.asarray(speeds, dtype=float), (n,)), 1e-6)
+    length    = np.zeros(n)
+    length[1:] = np.sqrt((np.diff(positions, axis=0)**2).sum(axis=1))
+    if accel is None or not np.isfinite(accel):
+        times = length / speeds
+        times[0] = 0
+        return times
+
+    zones   = np.broadcast_to(np.asarray(zones, dtype=float), (n,))
+    through = np.minimum(corner_speeds(positions, zones[1:-1], accel), speeds)
+    through[:-1] = np.minimum(through[:-1], speeds[1:])
+    through[np.asarray(stops, dtype=bool) | (zones <= 0)] = 0
+    through[[0, -1]] = 0
+    limit, peak = speed_limits(length, speeds, through, accel)
+
+    entry, exit = np.sqrt(limit[:-1]), np.sqrt(limit[1:])
+    ramps = (2 * peak - entry - exit) / accel
+    cruise = length[1:] - (2 * peak**2 - entry**2 - exit**2) / (2 * accel)
+    times = np.zeros(n)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        times[1:] = np.where(peak > 0, ramps + np.maximum(cruise, 0) / peak, 0)
+    return times
+
+
+if __name__ == '__main__':
+    print("abb_path is a library, see the example at the top of the file")
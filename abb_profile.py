@@ -0,0 +1,307 @@
+'''
+David Pollard
+
+FARSCOPE CDT
+Bristol Robotics Laboratory
+
+abb_profile.py
+ - Finds where a print's time goes: records a span for every command an
+   abb.Robot (or abb_testing.Robot) is given, and for every layer
+ - Commands are grouped (CATEGORIES): uploads, motion, I/O, external
+   axis, settings and queries
+ - Exports a Chrome trace, for chrome://tracing or ui.perfetto.dev, and
+   summarises each layer: time moving, uploading, switching I/O... and
+   the rest, when the robot is idle
+ - abb_testing.Robot has no clock of its own, so its spans are in
+   simulated time (SimulatedClock), as print_time estimates it
+
+Released under the MIT License
+
+Example:
+    with abb_profile.Profiler(R) as P:
+        for z, layer in layers:
+            with P.layer(z):
+                R.buffer_set(layer)
+                R.buffer_execute(True)
+    P.save('print.json')
+    print(P.report())
+or, for G-code (a new layer whenever a buffer starts at another height):
+    with abb_profile.Profiler(R, layer_step = 0.01) as P:
+        abb_gcode.print_file(R, 'part.gcode')
+
+'''
+
+import json
+import time
+import logging
+from collections import namedtuple
+from contextlib import contextmanager
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Robot functions recorded, by what their time is spent on. Time spent in
+# 'composite' functions' own code (not in the commands they call) is 'other'.
+CATEGORIES = (('upload',    ('buffer_set', 'buffer_add', 'buffer_set_speeds',
+                             'buffer_set_orientation', 'buffer_save', 'buffer_load',
+                             'buffer_offset', 'buffer_modify_speed', 'clear_buffer')),
+              ('motion',    ('buffer_execute', 'buffer_execute_circ', 'set_cartesian',
+                             'set_joints', 'move_circular', 'rotate_z', 'check_j6',
+                             'reset_position', 'stream_execute')),
+              ('io',        ('set_go', 'set_dio')),
+              ('axis',      ('set_external_axis',)),
+              ('settings',  ('set_speed', 'set_zone', 'set_tool', 'set_workobject')),
+              ('query',     ('get_cartesian', 'get_joints', 'get_external_axis',
+                             'get_robotinfo', 'buffer_len', 'buffer_read_value',
+                             'check_position', 'buffer_check')),
+              ('composite', ('execute_path', 'buffer_set_planned')))
+COMMANDS = dict((name, category) for category, names in CATEGORIES for name in names)
+
+# Commands whose first argument is a path, used to find layers by height
+PATH_COMMANDS = {'buffer_set', 'buffer_set_planned', 'execute_path'}
+
+# A command, or a layer (category 'layer'). Times are in seconds from the
+# start of profiling; 'own' is the time not spent in commands it called.
+# depth is 0 for commands called directly, 1 for commands they call...
+Span = namedtuple('Span', ['name', 'category', 'start', 'end', 'own', 'depth', 'layer'])
+
+# Time (s) of one layer: in total, in each category of command (own time,
+# see Span), 'gaps' outside any command (e.g. the PC preparing the next
+# path), and 'idle', all but motion
+LayerSummary = namedtuple('LayerSummary', ['name', 'start', 'total', 'motion', 'upload',
+                                           'io', 'axis', 'settings', 'query', 'other',
+                                           'gaps', 'idle'])
+
+
+class SimulatedClock:
+    '''
+    Seconds an abb_testing.Robot has taken so far, as its print_time
+    estimates them: commandCost for every message, and the time of the
+    moves recorded (abb_path.move_times). Moves are timed a command at a
+    time, stopping at the end of each, as the robot waits for the
+    messages of the next command.
+    '''
+    def __init__(self, robot):
+        self.robot    = robot
+        self.seen     = 0       # Points of the toolpath timed
+        self.messages = 0       # Messages sent with those points
+        self.motion   = 0.0
+
+    def __call__(self):
+        import numpy as np
+        import abb_path
+        robot = self.robot
+        path  = robot.toolpath
+        count = len(path)
+        if count > self.seen:
+            begin = max(self.seen - 1, 0)
+            self.messages += int(path.messages[self.seen:count].sum())
+            times = abb_path.move_times(path.positions[begin:count], path.speed[begin:count],
+                                        path.zone[begin:count], np.zeros(count - begin, dtype=bool),
+                                        robot.acceleration)
+            self.motion += float(times.sum())
+            self.seen    = count
+        return robot.commandCost * (self.messages + robot.sent) + self.motion
+
+
+class Profiler:
+    def __init__(self, robot, layer_step = None, clock = None):
+        '''
+         - robot: abb.Robot or abb_testing.Robot. Its functions are wrapped
+           while attached (attach, or a 'with' block), so code that calls
+           them, e.g. abb_gcode, is profiled unchanged.
+         - layer_step: without layer() or new_layer(), a new layer starts
+           whenever a path (buffer_set, execute_path) starts more than
+           layer_step mm from the layer's height. None doesn't.
+         - clock: returns the time in seconds. By default time.perf_counter,
+           or a SimulatedClock for abb_testing.Robot.
+        Commands are timed as the calls return, so profile abb.Robot outside
+        of pipelined(): in it, a buffer_execute returns at once, and its
+        motion is counted in whichever command waits for it.
+        '''
+        if clock is None:
+            if hasattr(robot, 'toolpath'): clock = SimulatedClock(robot)
+            else:                          clock = time.perf_counter
+        self.robot      = robot
+        self.layer_step = layer_step
+        self.clock      = clock
+        self.origin     = clock()
+        self.spans      = []        # Commands, in the order they ended
+        self.layers     = []        # Layers, in order
+        self.stack      = []        # [name, category, start, time in children]
+        self.current    = None      # [name, start] of the layer being recorded
+        self.height     = None      # Height of the layer found by layer_step
+        self.wrapped    = []
+
+    def now(self):
+        return self.clock() - self.origin
+
+    #
+    # Wrapping the robot
+    #
+    def attach(self):
+        '''
+        Records every command (see CATEGORIES) the robot is given
+        '''
+        for name, category in COMMANDS.items():
+            function = getattr(self.robot, name, None)
+            if function is None or name in self.wrapped: continue
+            setattr(self.robot, name, self.wrap(name, category, function))
+            self.wrapped.append(name)
+        return self
+
+    def detach(self):
+        '''
+        Stops recording, and ends the layer being recorded
+        '''
+        for name in self.wrapped:
+            delattr(self.robot, name)
+        self.wrapped = []
+        self.end_layer()
+
+    def __enter__(self):
+        return self.attach()
+
+    def __exit__(self, type, value, traceback):
+        self.detach()
+
+    def wrap(self, name, category, function):
+        def profiled(*args, **kwargs):
+            if self.layer_step is not None and name in PATH_COMMANDS and args:
+                self.find_layer(args[0])
+            self.stack.append([name, category, self.now(), 0.0])
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.end_span()
+        profiled.__name__ = name
+        profiled.__doc__  = function.__doc__
+        return profiled
+
+    def end_span(self):
+        name, category, start, children = self.stack.pop()
+        end      = self.now()
+        duration = end - start
+        if self.stack: self.stack[-1][3] += duration
+        if self.current is None: self.new_layer(None, start)
+        self.spans.append(Span(name, category, start, end, duration - children,
+                               len(self.stack), len(self.layers)))
+
+    #
+    # Layers
+    #
+    def new_layer(self, name, start = None):
+        '''
+        Ends the layer being recorded, and starts a new one called name
+        '''
+        if start is None: start = self.now()
+        self.end_layer(start)
+        self.current = [name, start]
+
+    def end_layer(self, end = None):
+        if self.current is None: return
+        if end is None: end = self.now()
+        name, start  = self.current
+        self.current = None
+        self.layers.append(Span(name, 'layer', start, end, end - start, 0, len(self.layers)))
+
+    @contextmanager
+    def layer(self, name):
+        '''
+        Records the commands in the block as the layer called name
+        '''
+        self.new_layer(name)
+        try:
+            yield self
+        finally:
+            self.end_layer()
+
+    def find_layer(self, poses):
+        '''
+        Starts a new layer if poses start at another height (layer_step)
+        '''
+        try:
+            first = poses[0]
+            z = float(first[0][2]) if len(first) == 2 else float(first[2])
+        except (IndexError, TypeError, ValueError):
+            return
+        if self.height is None or abs(z - self.height) > self.layer_step:
+            self.height = z
+            self.new_layer(round(round(z / self.layer_step) * self.layer_step, 6))
+
+    #
+    # Results
+    #
+    def all_layers(self):
+        layers = list(self.layers)
+        if self.current is not None:
+            name, start = self.current
+            end = self.now()
+            layers.append(Span(name, 'layer', start, end, end - start, 0, len(layers)))
+        return layers
+
+    def summary(self):
+        '''
+        Returns a LayerSummary for each layer, in order
+        '''
+        layers = self.all_layers()
+        totals = [dict((field, 0.0) for field in LayerSummary._fields[3:]) for layer in layers]
+        for span in self.spans:
+            if span.layer >= len(layers): continue
+            category = span.category if span.category != 'composite' else 'other'
+            totals[span.layer][category] += span.own
+        result = []
+        for layer, total in zip(layers, totals):
+            # Own times add up to the time in commands, even for commands
+            # (e.g. execute_path) that span several layers
+            total['gaps'] = max(layer.end - layer.start - sum(total.values()), 0.0)
+            total['idle'] = layer.end - layer.start - total['motion']
+            result.append(LayerSummary(layer.name, layer.start, layer.end - layer.start,
+                                       **total))
+        return result
+
+    def report(self):
+        '''
+        The summary as a table (seconds)
+        '''
+        fields = LayerSummary._fields[2:]
+        lines  = ['%-10s' % 'layer' + ''.join('%10s' % field for field in fields)]
+        rows   = self.summary()
+        for row in rows:
+            lines.append('%-10s' % str(row.name)[:10] +
+                         ''.join('%10.3f' % getattr(row, field) for field in fields))
+        if len(rows) > 1:
+            lines.append('%-10s' % 'total' + ''.join('%10.3f' % sum(getattr(row, field) for row in rows)
+                                                     for field in fields))
+        return '\n'.join(lines)
+
+    def trace(self):
+        '''
+        Returns the spans as a Chrome trace (Trace Event Format): layers on
+        one track, commands (nested as they were called) on another
+        '''
+        events = [{'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 0,
+                   'args': {'name': 'layers'}},
+                  {'name': 'thread_name', 'ph': 'M', 'pid': 1, 'tid': 1,
+                   'args': {'name': 'commands'}}]
+        for span in self.all_layers():
+            events.append({'name': str(span.name), 'cat': 'layer', 'ph': 'X', 'pid': 1, 'tid': 0,
+                           'ts': span.start * 1e6, 'dur': (span.end - span.start) * 1e6})
+        for span in sorted(self.spans, key = lambda span: (span.start, span.depth)):
+            events.append({'name': span.name, 'cat': span.category, 'ph': 'X', 'pid': 1, 'tid': 1,
+                           'ts': span.start * 1e6, 'dur': (span.end - span.start) * 1e6,
+                           'args': {'layer': span.layer, 'own_ms': span.own * 1e3}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms'}
+
+    def save(self, filename):
+        '''
+        Writes the Chrome trace to filename (JSON)
+        '''
+        with open(filename, 'w') as f:
+            json.dump(self.trace(), f)
+        log.info('Saved %i spans and %i layers to %s', len(self.spans),
+                 len(self.all_layers()), filename)
+
+
+if __name__ == '__main__':
+    print("abb_profile is a library, see the example at the top of the file")
@@ -0,0 +1,201 @@
+'''
+David Pollard
+
+FARSCOPE CDT
+Bristol Robotics Laboratory
+
+abb_stream.py
+ - Sends poses to the STREAM task (STREAM.mod), which keeps them in a ring
+   that SERVER executes with instruction 60 (abb.Robot.stream_execute)
+ - The next path is uploaded while the current one is printed, so the
+   robot doesn't stop between layers
+ - push blocks while the ring is full (the STREAM task only replies once
+   it has room), so the PC never runs more than the ring ahead
+
+Released under the MIT License
+
+Example:
+    with R.streaming() as S:
+        for layer in layers:
+            S.push(layer, extrude = True)
+    # Returns once the robot has executed every pose
+'''
+
+import socket
+import time
+import logging
+from collections import deque
+
+import abb
+
+log = logging.getLogger(__name__)
+log.addHandler(logging.NullHandler())
+
+# Size of the ring in STREAM.mod and SERVER.mod
+STREAM_RING = 1024
+
+# Only replies once there is room in the ring, so not subject to timeout
+BLOCKING_CODES = {'70'}
+
+
+class Streamer:
+    def __init__(self,
+                 remote       = ('192.168.125.1', 5002),
+                 window       = 8,
+                 scale_linear = 1.0):
+        '''
+         - window: messages in flight before waiting for a reply. Each
+           "70" message holds as many positions as fit in abb.MAX_MSG_LEN
+           characters: 3 or 4 with typical coordinates.
+         - scale_linear: as set by abb.Robot.set_units
+        '''
+        self.remote       = remote
+        self.window       = max(1, int(window))
+        self.scale_linear = scale_linear
+        self.timeout      = 5.0
+        self.sock         = None
+        self.recv_buffer  = b''
+        self.in_flight    = deque()
+        self.orient_msg   = None        # Last orientation sent ("29 ...")
+        self.settings     = None        # Last (speed, extrude) sent
+        self.free         = STREAM_RING # Free places, from the last reply
+        self.added        = 0           # Poses pushed since connecting
+
+    def connect(self):
+        log.info('Attempting to connect to robot stream at %s', str(self.remote))
+        self.sock = socket.create_connection(self.remote, timeout=2.5)
+        self.sock.settimeout(None)
+        self.sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        self.recv_buffer = b''
+        self.in_flight.clear()
+        self.orient_msg  = None
+        self.settings    = None
+        log.info('Connected to robot stream at %s', str(self.remote))
+        return self
+
+    #
+    # Formatting is shared with abb.Robot. STREAM.mod only reads text.
+    #
+    protocol      = abb.TEXT
+    format_orient = abb.Robot.format_orient
+    buffer_rows   = abb.Robot.buffer_rows
+    pack_rows     = abb.Robot.pack_rows
+
+    def push(self, pose_list, speed=None, extrude=True):
+        '''
+        Adds every pose in pose_list to the ring, after the poses already
+        pushed. Poses are [[XYZ], [Quats]], or positions [XYZ] which use
+        the last orientation pushed. pose_list may also be an (N, 7) or
+        (N, 3) NumPy array.
+         - speed: [v_tcp (mm/s), v_ori (deg/s)], by default the last speed
+           pushed ([100, 50] to begin with)
+         - extrude: DO10_2 is set for each move to these poses
+        Blocks while the ring is full. Returns the number of poses pushed.
+        '''
+        if speed is None and self.settings is not None:
+            speed = self.settings[0]
+        elif speed is None:
+            speed = (100, 50)
+        settings = (tuple(speed[0:2]), bool(extrude))
+        if settings != self.settings:
+            self.send("72 " + format(speed[0], "+08.1f") + " " +
+                      format(speed[1], "+08.2f") + " " +
+                      str(int(settings[1])) + " #")
+            self.settings = settings
+
+        rows = self.buffer_rows(pose_list)
+        for msg in self.pack_rows(rows, self.orient_msg, code="70 "):
+            if msg.startswith("29 "):
+                self.orient_msg = msg
+                msg = "71 " + msg[3:]
+            self.send(msg)
+        self.added += len(rows)
+        return len(rows)
+
+    def end(self):
+        '''
+        Marks the end of the stream: stream_execute returns once the robot
+        has reached the last pose pushed
+        '''
+        self.send("73 #")
+        self.flush()
+
+    def status(self):
+        '''
+        Returns (poses added, poses executed) since the STREAM task started
+        '''
+        data = self.send("74 #", wait=True).split()
+        return int(float(data[2])), int(float(data[3]))
+
+    def clear(self):
+        '''
+        Drops every pose pushed that the robot hasn't started moving to.
+        If end() was called, the stream now ends at the pose being moved to.
+        '''
+        self.send("75 #", wait=True)
+
+    def send(self, message, wait=False):
+        '''
+        Sends a message, keeping at most 'window' in flight. Returns the
+        reply if wait is True.
+        '''
+        while len(self.in_flight) >= self.window:
+            self.resolve_next()
+        log.debug('stream sending: %s', message)
+        self.sock.sendall(str.encode(message))
+        self.in_flight.append(message.split(' ', 1)[0])
+        if wait:
+            reply = None
+            while self.in_flight: reply = self.resolve_next()
+            return reply
+
+    def resolve_next(self):
+        '''
+        Waits for the reply to the oldest message in flight, and checks it
+        '''
+        code = self.in_flight.popleft()
+        if code in BLOCKING_CODES: timeout = None
+        else:                      timeout = self.timeout
+        if timeout is not None:
+            deadline = time.monotonic() + timeout
+        while abb.REPLY_END not in self.recv_buffer:
+            if timeout is not None:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise socket.timeout('No reply to %s within %.2fs' % (code, timeout))
+                self.sock.settimeout(remaining)
+            else:
+                self.sock.settimeout(None)
+            try:
+                chunk = self.sock.recv(4096)
+            except socket.timeout:
+                continue
+            if not chunk:
+                raise ConnectionError('Robot closed the stream socket')
+            self.recv_buffer += chunk
+        reply, _, self.recv_buffer = self.recv_buffer.partition(abb.REPLY_END)
+        reply = reply.strip()
+        log.debug('stream recieved: %s', reply)
+        fields = reply.split()
+        if abb.reply_code(reply) != int(code) or fields[1:2] != [b'1']:
+            raise NameError('Stream command %s failed: %s' % (code, reply))
+        if code in ('70', '75'):
+            self.free = int(float(fields[2]))
+        return reply
+
+    def flush(self):
+        while self.in_flight:
+            self.resolve_next()
+
+    def close(self):
+        if self.sock is None: return
+        try:
+            self.flush()
+        finally:
+            self.sock.close()
+            self.sock = None
+            log.info('Disconnected from robot stream.')
+
+
+if __name__ == '__main__':
+    print("abb_stream is a library, see the example at the top of the file")
@@ -7,6 +7,7 @@ Bristol Robotics Laboratory
 abb_testing.py
  - Simulates toolpath generated on ABB robot
  - Does not have full functionality.
+ - Each Robot records its own Toolpath, in NumPy arrays
  
 Released under the MIT License
 
@@ -15,35 +16,262 @@ Released under the MIT License
 
 import matplotlib.pyplot as plt
 from mpl_toolkits.mplot3d import Axes3D
+from mpl_toolkits.mplot3d.art3d import Line3DCollection
 import numpy as np
 import warnings
-import copy
+from collections import namedtuple
+
+import abb
+import abb_encoder
+import abb_path
+from abb import path_chunks, ZONES
 
 warnings.filterwarnings("ignore",".*GUI is implemented.*")
 
+# Estimated print time (s): moving, and waiting for messages (of which
+# uploading buffers), in total and for each Layer
+PrintTime = namedtuple('PrintTime', ['total', 'motion', 'idle', 'upload', 'layers'])
+Layer     = namedtuple('Layer', ['z', 'moves', 'total', 'motion', 'idle', 'upload'])
+
+
+class Toolpath:
+    '''
+    Path recorded by a simulated robot, in arrays that grow as it is
+    recorded, so a million moves take tens of MB:
+     - positions (N, 3) and orientations (N, 4) of each point moved to.
+       Orientations are kept once each (orientation_table) and indexed
+       for each point.
+     - extrude (N,): whether the move to each point extrudes
+     - go (N,): GO value during the move to each point (0 for travel)
+     - speed (N,), zone (N,): TCP speed (mm/s) and zone (mm) of the move
+     - messages (N,): messages sent to the robot before the move, and
+       upload_messages (N,) how many of those uploaded a buffer
+     - starts (S,): index of the first point of each segment. A segment
+       starts, at the current position, whenever extrusion is switched
+       on or off.
+    Single points are collected in a list and copied into the arrays
+    PENDING at a time, as writing array elements one by one is slow.
+    '''
+    PENDING = 4096
+    # Values recorded for each point, in the order add and extend take them
+    COLUMNS = (('extrudes', bool),
+               ('gos',      np.int16),
+               ('speeds',   np.float32),
+               ('zones',    np.float32),
+               ('sends',    np.uint16),
+               ('uploads',  np.uint16))
+
+    def __init__(self, capacity = 1024):
+        self.count     = 0
+        self.pending   = []
+        self.xyz       = np.empty((capacity, 3))
+        self.orient    = np.empty(capacity, dtype=np.int32)
+        for name, dtype in self.COLUMNS:
+            setattr(self, name, np.empty(capacity, dtype=dtype))
+        self.orientation_index = {}
+        self.orientation_table = np.zeros((0, 4))
+        # The path begins with a travel segment, at index 0
+        self.segment_starts = np.zeros(64, dtype=np.intp)
+        self.n_starts  = 1
+
+    def arrays(self):
+        return ['xyz', 'orient'] + [name for name, dtype in self.COLUMNS]
+
+    def reserve(self, extra):
+        needed = self.count + extra
+        if needed > len(self.xyz):
+            size = max(needed, len(self.xyz) * 3 // 2)
+            for name in self.arrays():
+                setattr(self, name, grow(getattr(self, name), size))
+
+    def orientation(self, q):
+        '''
+        Index of orientation q in orientation_table, adding it if new
+        '''
+        q = tuple(q)
+        index = self.orientation_index.get(q)
+        if index is None:
+            q = tuple(float(v) for v in q)
+            index = self.orientation_index[q] = len(self.orientation_index)
+            self.orientation_table = np.vstack((self.orientation_table, q))
+        return index
+
+    def add(self, pose, values):
+        '''
+        Adds one point, pose as [[XYZ], [Quats]], with a value for each of
+        COLUMNS
+        '''
+        x, y, z = pose[0]
+        self.pending.append((x, y, z, self.orientation(pose[1])) + tuple(values))
+        if len(self.pending) >= self.PENDING: self.flush()
+
+    def flush(self):
+        if not self.pending: return
+        rows = np.array(self.pending, dtype=float)
+        n, i = len(rows), self.count
+        self.reserve(n)
+        self.xyz[i:i + n]    = rows[:, 0:3]
+        self.orient[i:i + n] = rows[:, 3]
+        for k, (name, dtype) in enumerate(self.COLUMNS):
+            getattr(self, name)[i:i + n] = rows[:, 4 + k]
+        self.count += n
+        self.pending = []
+
+    def extend(self, poses, values):
+        '''
+        Adds an (N, 7) array of points, with one value or N values for each
+        of COLUMNS
+        '''
+        self.flush()
+        unique, inverse = np.unique(poses[:, 3:7], axis=0, return_inverse=True)
+        indices = np.array([self.orientation(q) for q in unique], dtype=np.int32)
+        n, i = len(poses), self.count
+        self.reserve(n)
+        self.xyz[i:i + n]    = poses[:, 0:3]
+        self.orient[i:i + n] = indices[inverse.reshape(-1)]
+        for (name, dtype), value in zip(self.COLUMNS, values):
+            getattr(self, name)[i:i + n] = value
+        self.count += n
+
+    def start_segment(self, pose, values):
+        '''
+        Starts a new segment at pose
+        '''
+        if self.n_starts == len(self.segment_starts):
+            self.segment_starts = grow(self.segment_starts, 2 * self.n_starts)
+        self.segment_starts[self.n_starts] = len(self)
+        self.n_starts += 1
+        self.add(pose, values)
+
+    def __len__(self):
+        return self.count + len(self.pending)
+
+    def column(self, name):
+        self.flush()
+        return getattr(self, name)[:self.count]
+
+    @property
+    def positions(self):       return self.column('xyz')
+    @property
+    def orientations(self):    return self.orientation_table[self.column('orient')]
+    @property
+    def extrude(self):         return self.column('extrudes')
+    @property
+    def go(self):              return self.column('gos')
+    @property
+    def speed(self):           return self.column('speeds')
+    @property
+    def zone(self):            return self.column('zones')
+    @property
+    def messages(self):        return self.column('sends')
+    @property
+    def upload_messages(self): return self.column('uploads')
+    @property
+    def starts(self):          return self.segment_starts[:self.n_starts]
+
+    def poses(self, points = slice(None)):
+        '''
+        (N, 7) array of the poses at points (a slice or indices)
+        '''
+        return np.hstack((self.positions[points],
+                          self.orientation_table[self.column('orient')[points]]))
+
+    def segments(self):
+        '''
+        Yields (slice of the points, extruding) for each segment
+        '''
+        self.flush()
+        starts = self.starts
+        ends   = np.append(starts[1:], self.count)
+        for k, (start, end) in enumerate(zip(starts, ends)):
+            if k == 0: extruding = False
+            else:      extruding = bool(self.extrudes[start])
+            yield slice(start, end), extruding
+
+    @property
+    def nbytes(self):
+        self.flush()
+        return (sum(getattr(self, name).nbytes for name in self.arrays()) +
+                self.segment_starts.nbytes + self.orientation_table.nbytes)
+
+
+def estimate_time(toolpath, acceleration, command_cost, layer_step = 0.01):
+    '''
+    Returns a PrintTime for a Toolpath:
+     - moves at the speed and zone recorded for each point, with
+       acceleration (mm/s^2, see abb_path.move_times)
+     - stops before every point that messages were sent before, as
+       abb.Robot waits for each reply, and waits command_cost (s) for
+       each message
+     - layers are the heights (z, to layer_step mm) moves end at
+    '''
+    positions = toolpath.positions
+    messages  = toolpath.messages.astype(float)
+    stops     = np.zeros(len(positions), dtype=bool)
+    stops[:-1] = messages[1:] > 0
+    motion = abb_path.move_times(positions, toolpath.speed, toolpath.zone,
+                                 stops, acceleration)
+    idle   = messages * command_cost
+    upload = toolpath.upload_messages * command_cost
+    heights, layer = np.unique(np.round(positions[:, 2] / layer_step), return_inverse=True)
+    layer  = layer.reshape(-1)
+    count  = len(heights)
+    sums   = [np.bincount(layer, weights, count) for weights in (motion, idle, upload)]
+    moves  = np.bincount(layer, minlength=count)
+    layers = [Layer(float(z * layer_step), int(m), float(a + b), float(a), float(b), float(c))
+              for z, m, a, b, c in zip(heights, moves, *sums)]
+    return PrintTime(float(motion.sum() + idle.sum()), float(motion.sum()),
+                     float(idle.sum()), float(upload.sum()), layers)
+
+
+def grow(array, size):
+    grown = np.empty((size,) + array.shape[1:], dtype=array.dtype)
+    grown[:len(array)] = array
+    return grown
+
+
+def as_pose(row):
+    return [row[0:3].tolist(), row[3:7].tolist()]
+
 
 class Robot:
-    currPosition = [[0,0,0],[1,0,0,0]]
-    currWObj = [[0,0,0],[1,0,0,0]]
-    currTool = [[0,0,0],[1,0,0,0]]
-    bufferPose = []
-    currDIO = False
-    travelList = [[]]
-    speedVsFeedIdx = []
-    currGO = -1
-    GO_List = [currGO]
-    savedBuffers = []
-    
     OK_MSG = "b'-1' b'1'"
     
     plotTravelMotions = True
     # Animate printing - put negative for instant output
     animatePrinting =  0.05         
+    # Points drawn at most by show_motions, and steps it animates in
+    maxPlotPoints = 200000
+    animationSteps = 100
+    # Used by print_time: TCP acceleration (mm/s^2), and the time (s) the
+    # robot waits for each message: the round trip for SERVER to receive,
+    # parse and reply, a few ms over Ethernet. Set it to the round trip
+    # measured on your controller (e.g. with abb_profile on the robot).
+    acceleration = 1000
+    commandCost = 0.004
     
     def __init__(self, ip):
+        self.currPosition = [[0,0,0],[1,0,0,0]]
+        self.currWObj = [[0,0,0],[1,0,0,0]]
+        self.currTool = [[0,0,0],[1,0,0,0]]
+        self.qOrientation = [1,0,0,0]
+        self.speed = [100,50,50,50]
+        self.bufferPose = np.zeros((0, 7))
+        self.bufferSpeeds = np.zeros(0)
+        self.bufferGO = np.zeros(0, dtype=int)
+        self.currDIO = False
+        self.speedVsFeedIdx = []
+        self.currGO = -1
+        self.zone = ZONES['z1']
+        self.savedBuffers = {}
+        self.toolpath = Toolpath()
+        # Messages sent since the last point recorded, and uploads of those
+        self.sent = 0
+        self.uploaded = 0
         print("Imaginary robot created")
 
     def reset_position(self, setEnable = 0):
+        self.message()
         if setEnable == -1:
             print("Extrusion disabled")
         elif setEnable == 0:
@@ -59,160 +287,360 @@ class Robot:
     def close(self):
         pass
 
+    def message(self, count = 1, upload = False):
+        '''
+        Counts messages that abb.Robot would send, for print_time
+        '''
+        self.sent += count
+        if upload: self.uploaded += count
+
+    # Buffer uploads are counted as abb.Robot packs them (set protocol to
+    # abb.BINARY to count binary frames)
+    scale_linear  = 1.0
+    protocol      = abb.TEXT
+    format_orient = abb.Robot.format_orient
+    buffer_rows   = abb.Robot.buffer_rows
+    pack_rows     = abb.Robot.pack_rows
+
     def set_cartesian(self, pose, fineMotion = False):
-        self.currPosition = pose
-        self.travelList[-1].append(pose)
+        self.message()
+        self.record(pose)
         
     def set_joints(self, joints):
-        pass
+        self.message()
 
     def get_cartesian(self):
-        return Robot.currPosition
+        self.message()
+        return self.currPosition
         
     def get_joints(self):
+        self.message()
         return None
         
     def get_external_axis(self):
+        self.message()
         return None
         
-    def set_tool(self, ToolObj = [[0,0,0],[1,0,0,0]]):
-        pass         
+    # Settings the robot already has aren't sent, as abb.Robot.send_setting
+    def setting(self, changed, force):
+        if changed or force: self.message()
+
+    def set_tool(self, ToolObj = [[0,0,0],[1,0,0,0]], force = False):
+        self.setting(ToolObj != self.currTool, force)
+        self.currTool = ToolObj
         
-    def set_workobject(self, WObj = [[0,0,0],[1,0,0,0]]):
-        pass 
+    def set_workobject(self, WObj = [[0,0,0],[1,0,0,0]], force = False):
+        self.setting(WObj != self.currWObj, force)
+        self.currWObj = WObj
         
-    def set_speed(self, speed=[100,50,50,50]):
-        pass
+    def set_speed(self, speed=[100,50,50,50], force = False):
+        if len(speed) != 4: return False
+        self.setting(list(speed) != self.speed, force)
+        self.speed = list(speed)
         
     def rotate_z(self, value):
-        pass
+        self.message()
         
     def check_j6(self):
-        pass
+        self.message()
         
-    def set_zone(self, zone_key = 'z1'):
-        pass
+    def set_zone(self, zone_key = 'z1', point_motion = False, manual_zone = [], force = False):
+        if point_motion:              zone = [0,0,0]
+        elif len(manual_zone) == 3:   zone = manual_zone
+        elif zone_key in ZONES:       zone = ZONES[zone_key]
+        else: return False
+        self.setting(zone != self.zone, force)
+        self.zone = zone
+
+    def simplify_path(self, pose_list, tolerance = None):
+        if tolerance is None: tolerance = self.zone[0]
+        return abb_path.simplify(pose_list, tolerance)
         
     def check_position(self, pose):
+        self.message()
         return True
 
+    def buffer_check(self):
+        self.message()
+        return []
+
         
     def buffer_set(self, poseList):
-        if len(poseList[0]) == 2:           # sending full poses
-            self.bufferPose = poseList
-        elif len(poseList[0]) == 3:        # only sending positions
-            self.bufferPose = [[poseList[i], self.qOrientation] for i in range(0, len(poseList))]
-        else:
-            raise Exception("Improper pose length")
+        poses = abb_encoder.check_poses(poseList, orientation = self.qOrientation)
+        # Clearing the buffer, then the packed poses
+        self.message(1 + sum(1 for msg in self.pack_rows(self.buffer_rows(poses))),
+                     upload = True)
+        if poses.shape[1] == 3:            # only sending positions
+            poses = np.hstack((poses, np.tile(np.asarray(self.qOrientation, dtype=float),
+                                              (len(poses), 1))))
+        self.bufferPose   = poses.copy()
+        # As the controller, each pose has the current speed and no GO value
+        self.bufferSpeeds = np.full(len(poses), float(self.speed[0]))
+        self.bufferGO     = np.full(len(poses), -1)
+        return True
 
     def buffer_set_orientation(self, value):
+        self.message(upload = True)
         self.qOrientation = value
+
+    def travel_go(self):
+        return self.currGO if self.currDIO else 0
+
+    def values(self, speed = None, go = None):
+        '''
+        Values recorded with the next point (Toolpath.COLUMNS), which takes
+        the messages sent before it
+        '''
+        if speed is None: speed = self.speed[0]
+        if go is None:    go = self.travel_go()
+        values = (self.currDIO, go, speed, self.zone[0],
+                  min(self.sent, 65535), min(self.uploaded, 65535))
+        self.sent = self.uploaded = 0
+        return values
+
+    def record(self, pose, speed = None):
+        self.toolpath.add(pose, self.values(speed))
+        self.currPosition = pose
         
-    def buffer_execute(self, extrudeOn = False):
-        if extrudeOn:
-            self.set_cartesian(self.bufferPose[0])
-            self.set_dio(1)
-        for pose in self.bufferPose:
-            self.travelList[-1].append(pose)
-            self.currPosition = pose
-        if extrudeOn:
-            self.set_dio(0)
+    def buffer_execute(self, extrudeOn = False, join_start = False, join_end = False):
+        self.message()
+        poses = self.bufferPose
+        if len(poses) == 0: return
+        first = 0
+        if extrudeOn and not join_start:
+            self.record(as_pose(poses[0]), self.bufferSpeeds[0])
+            self.switch_dio(1)
+            first = 1
+        planned = self.bufferGO[first:]
+        go = self.travel_go()
+        if self.currDIO: go = np.where(planned >= 0, planned, go)
+        if (planned >= 0).any(): self.currGO = int(planned[planned >= 0][-1])
+        n = len(poses) - first
+        if n > 0:
+            # Messages were all sent before the first move
+            sends, uploads = np.zeros(n, dtype=np.uint16), np.zeros(n, dtype=np.uint16)
+            extrude, _, _, zone, sends[0], uploads[0] = self.values()
+            self.toolpath.extend(poses[first:], (extrude, go, self.bufferSpeeds[first:],
+                                                 zone, sends, uploads))
+        self.currPosition = as_pose(self.bufferPose[-1])
+        if extrudeOn and not join_end:
+            self.switch_dio(0)
+
+    def execute_path(self, poses, extrude = False, chunk = 512):
+        chunks  = path_chunks(poses, chunk)
+        current = next(chunks, None)
+        joined  = False
+        while current is not None:
+            following = next(chunks, None)
+            self.buffer_set(current)
+            self.buffer_execute(extrude, join_start = joined,
+                                join_end = following is not None)
+            current, joined = following, True
+        return True
 
     def buffer_execute_circ(self):
         if len(self.bufferPose)!=2:
             raise Exception('Invalid Circle')
-        for pose in self.bufferPose:
-            self.travelList[-1].append(pose)
-            self.currPosition = pose
+        self.message()
+        for row, speed in zip(self.bufferPose, self.bufferSpeeds):
+            self.record(as_pose(row), speed)
 
     def buffer_save(self, value):
-        if value > len(self.savedBuffers):
-            self.savedBuffers.append(copy.deepcopy(self.bufferPose))
-        else:
-            self.savedBuffers[value-1] = copy.deepcopy(self.bufferPose)
+        self.message()
+        self.savedBuffers[value] = (self.bufferPose.copy(), self.bufferSpeeds.copy(),
+                                    self.bufferGO.copy())
         return self.OK_MSG
             
     def buffer_load(self, value):
-        self.bufferPose = copy.deepcopy(self.savedBuffers[value-1])
+        self.message()
+        poses, speeds, go = self.savedBuffers[value]
+        self.bufferPose, self.bufferSpeeds, self.bufferGO = poses.copy(), speeds.copy(), go.copy()
         return self.OK_MSG
         
         
     def buffer_read_value(self, value):
-        return(self.bufferPose[value-1])
+        self.message()
+        if value == -1: return as_pose(self.bufferPose[-1])
+        return as_pose(self.bufferPose[value-1])
 
     def buffer_offset(self, xyz):
-        for i,[pos,q] in enumerate(self.bufferPose):
-            pos = [pos[0]+xyz[0], pos[1]+xyz[1], pos[2]+xyz[2]]
-            self.bufferPose[i][0] = pos
+        self.message()
+        self.bufferPose[:, 0:3] += np.asarray(xyz, dtype=float)
             
-    def buffer_modify_speed(self, value):
-        pass
+    def buffer_modify_speed(self, value = 1):
+        self.message()
+        self.bufferSpeeds = self.bufferSpeeds * value
         
         
         
     def set_external_axis(self, axis_values=[0,0]):
         if len(axis_values) != 2:
             raise Exception("Unsuitable external axis setting")
+        self.message()
         
     def move_circular(self, poseCentre, poseEnd):
-        self.currPosition = poseEnd
         # NB: Could create a circular path for better representation?
-        self.travelList[-1].append(poseCentre)
-        self.travelList[-1].append(poseEnd)
-        self.currPosition = poseEnd
+        self.message()
+        self.record(poseCentre)
+        self.message()
+        self.record(poseEnd)
         
-    def set_dio(self, value, id=0):
+    def set_dio(self, value, id=0, force = False):
+        self.setting(bool(value) is not self.currDIO, force)
+        self.switch_dio(value)
+
+    def switch_dio(self, value):
         if bool(value) is not self.currDIO:
             self.currDIO = bool(value)
-            self.travelList.append([self.currDIO])
-            self.travelList[-1].append(self.currPosition)
-            
-        if value == 0:
-            self.GO_List.append(0) # Travel speed at index 0
-        else:
-            self.GO_List.append(self.currGO) # Other speed set before extrusion commanded
+            self.toolpath.start_segment(self.currPosition, self.values())
         
-    def set_go(self, value):
+    def set_go(self, value, force = False):
+        self.setting(value != self.currGO, force)
         self.currGO = value   
         
 
+    @property
+    def travelList(self):
+        '''
+        The toolpath as nested lists, [[extruding, pose, pose, ...], ...]
+        with the first segment (before any set_dio) as [pose, ...]
+        '''
+        path = self.toolpath
+        travel = []
+        for k, (points, extruding) in enumerate(path.segments()):
+            line = [as_pose(row) for row in path.poses(points)]
+            travel.append(line if k == 0 else [extruding] + line)
+        return travel
+
+    @property
+    def GO_List(self):
+        '''
+        GO value at the start of each segment (0 for travel)
+        '''
+        path = self.toolpath
+        if len(path) == 0: return [self.currGO]
+        return path.go[path.starts].tolist()
+
     def update_speed_matrix(self, matrix):
         '''
-        Warning... This isn't implemented on abb.py
+        [[TCP speed (mm/s), GO value], ...], used by buffer_set_planned
         '''
         self.speedVsFeedIdx = matrix
+
+    # Runs of speeds and GO values are packed as abb.Robot packs them
+    buffer_set_speeds = abb.Robot.buffer_set_speeds
+
+    def send_speeds(self, msg):
+        self.message(upload = True)
+        params = abb.message_params(msg)
+        for i in range(0, len(params), 4):
+            first, last, v_tcp, go = params[i:i + 4]
+            self.bufferSpeeds[int(first) - 1:int(last)] = v_tcp
+            self.bufferGO[int(first) - 1:int(last)]     = go
+
+    def buffer_set_planned(self, pose_list, speed, accel = None):
+        poses = abb_encoder.check_poses(pose_list, orientation = self.qOrientation)
+        self.buffer_set(poses)
+        plan = abb_path.plan(poses, speed, self.speedVsFeedIdx or None,
+                             self.zone[0], accel)
+        return self.buffer_set_speeds(plan.speeds, plan.go)
+
+    def print_time(self, acceleration = None, command_cost = None):
+        '''
+        Estimates how long the recorded toolpath takes to print (see
+        estimate_time), by default with acceleration and commandCost
+        '''
+        if acceleration is None: acceleration = self.acceleration
+        if command_cost is None: command_cost = self.commandCost
+        return estimate_time(self.toolpath, acceleration, command_cost)
         
 
         
     '''
     Final display function...
     '''
-    def show_motions(self, animate = True):
-        self.animatePrinting = animate
+    def show_motions(self, animate = True, max_points = None, filename = None):
+        '''
+         - animate: True to draw the path a step at a time (every
+           animatePrinting seconds), False to draw it at once, or the
+           seconds between steps
+         - max_points: points drawn at most, the path is decimated to fit
+           (by default maxPlotPoints, or every point when saving)
+         - filename: saves the figure to an image instead of showing it,
+           then closes it, so rendering many doesn't keep them all open
+        Extrusion and travel are each a single Line3DCollection, and
+        animation grows them rather than adding new lines. Returns the figure.
+        '''
+        if animate is True: interval = self.animatePrinting
+        else:               interval = float(animate)
+        if filename is not None: interval = 0
+        if max_points is None and filename is None: max_points = self.maxPlotPoints
+
         fig = plt.figure()
         ax = fig.add_subplot(111, projection = '3d')
 
-            
-        # Plot extrusion lines
-        for line in self.travelList:
-            if len(line) > 0:
-                xVec = [pos[0][0] for pos in line[1:]]
-                yVec = [pos[0][1] for pos in line[1:]]
-                zVec = [pos[0][2] for pos in line[1:]]
-
-                if line[0]:
-                    ax.plot(xVec, yVec, zVec, 'b')
-                elif self.plotTravelMotions:
-                    ax.plot(xVec, yVec, zVec, 'c')
-
-                    
-                if self.animatePrinting > 0:
-                    fig.show()
-                    plt.pause(self.animatePrinting)
-            
+        segments, extruding = line_segments(self.toolpath, max_points)
+        if not self.plotTravelMotions:
+            segments, extruding = segments[extruding], extruding[extruding]
+        extrusion = Line3DCollection(segments[extruding], colors = 'b', linewidths = 1)
+        travel    = Line3DCollection(segments[~extruding], colors = 'c', linewidths = 0.5)
+        if extruding.any():    ax.add_collection3d(extrusion)
+        if not extruding.all(): ax.add_collection3d(travel)
+        if len(segments):
+            low  = segments.reshape(-1, 3).min(axis=0)
+            high = segments.reshape(-1, 3).max(axis=0)
+            ax.set_xlim(low[0], high[0])
+            ax.set_ylim(low[1], high[1])
+            ax.set_zlim(low[2], high[2])
 
+        if interval > 0 and len(segments):
+            # Each step shows the lines up to 'end', in the order they were moved
+            fig.show()
+            for end in np.linspace(0, len(segments), self.animationSteps + 1)[1:].astype(int):
+                extrusion.set_segments(segments[:end][extruding[:end]])
+                travel.set_segments(segments[:end][~extruding[:end]])
+                plt.pause(interval)
 
-        fig.show()
+        if filename is not None:
+            fig.savefig(filename)
+            plt.close(fig)
+        else:
+            fig.show()
+        return fig
+
+
+def line_segments(toolpath, max_points = None):
+    '''
+    The lines of a Toolpath, as an (M, 2, 3) array of start and end
+    positions in the order they were moved, and whether each extrudes.
+    With max_points, only every n-th point is kept, so about max_points
+    are drawn, along with the ends of every segment if there are few
+    enough (otherwise lines take the extrusion of the point they end at).
+    '''
+    positions = toolpath.positions
+    starts    = toolpath.starts
+    n         = len(positions)
+    if n < 2: return np.zeros((0, 2, 3)), np.zeros(0, dtype=bool)
+    points = np.arange(n)
+    split  = True
+    if max_points is not None and n > max_points:
+        keep = np.zeros(n, dtype=bool)
+        keep[::int(np.ceil(n / max_points))] = True
+        keep[-1] = True
+        split = 2 * len(starts) <= max_points
+        if split:
+            keep[starts] = True
+            keep[starts[1:] - 1] = True
+        points = np.flatnonzero(keep)
+    # Lines between consecutive points of the same segment
+    same = np.ones(len(points) - 1, dtype=bool)
+    if split:
+        segment = np.searchsorted(starts, points, side = 'right') - 1
+        same    = segment[1:] == segment[:-1]
+    begin   = points[:-1][same]
+    end     = points[1:][same]
+    lines   = np.stack((positions[begin], positions[end]), axis = 1)
+    return lines, toolpath.extrude[end]
 
 
 if __name__=='__main__':
@@ -0,0 +1,26 @@
+'''
+Fixtures shared by the tests: an abb_emulator to connect to, so no robot
+or RobotStudio is needed
+'''
+
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import pytest
+
+import abb
+import abb_emulator
+
+
+@pytest.fixture
+def emulator():
+    E = abb_emulator.Emulator(stream_port = 0).start()
+    yield E
+    E.stop()
+
+
+@pytest.fixture
+def robot(emulator):
+    R = abb.Robot(emulator.host, emulator.port, port_stream = emulator.stream_port)
+    yield R
+    R.close()
@@ -0,0 +1,168 @@
+'''
+Tests for abb.Robot against abb_emulator:
+    python -m pytest test_abb.py
+'''
+
+import time
+
+import pytest
+
+import abb
+
+
+def test_replies_split_and_joined(robot):
+    # Several replies in one packet, and one reply over several packets
+    replies = [b'03 1 1.00 2.00 3.00 1.000 0.000 0.000 0.000 ', b'32 1 4.00 ']
+    robot.recv_buffer = replies[0] + b'#' + replies[1][:3]
+    assert robot.recv_reply(3, 1.0) == replies[0].strip()
+    robot.recv_buffer += replies[1][3:] + b'#'
+    assert robot.recv_reply(32, 1.0) == replies[1].strip()
+
+
+def test_pipelined_replies(robot):
+    with robot.pipelined(window = 4):
+        pending = [robot.buffer_add([[i, 0, 100], [0, 0, 1, 0]]) for i in range(10)]
+    assert all(p.done and p.error is None for p in pending)
+    assert robot.buffer_len(remote = True) == 10
+
+
+def test_late_reply_with_another_code(emulator, robot):
+    emulator.latency = {3: 0.3}
+    robot.timeout    = 0.1
+    with pytest.raises(Exception):
+        robot.get_cartesian()
+    robot.timeout = 5.0
+    robot.clear_buffer()
+    assert robot.buffer_len(remote = True) == 0
+    assert not robot.stale_replies
+
+
+def test_late_reply_with_the_same_code(emulator, robot):
+    emulator.latency = {32: 0.3}
+    robot.timeout    = 0.1
+    with pytest.raises(Exception):
+        robot.buffer_len(remote = True)
+    robot.timeout = 5.0
+    start = time.monotonic()
+    assert robot.buffer_len(remote = True) == 0
+    # Its own reply, not the one to the command that timed out
+    assert time.monotonic() - start > 0.45
+    assert not robot.stale_replies
+    assert robot.recv_buffer == b''
+
+
+def line(n, y = 0):
+    return [[[x, y, 100], [0, 0, 1, 0]] for x in range(n)]
+
+
+def test_buffer_set_sends_only_changes(emulator, robot):
+    path = line(40)
+    robot.buffer_set(path)
+    commands = emulator.commands
+    assert robot.buffer_set(path)
+    assert emulator.commands == commands
+    path[7] = [[7, 5, 100], [0, 0, 1, 0]]
+    assert robot.buffer_set(path)
+    assert emulator.commands == commands + 1
+    assert emulator.buffer_targets[7] == [7, 5, 100, 0, 0, 1, 0]
+    # Read from the mirror, which agrees with the controller
+    assert robot.buffer_read_value(8) == [[7, 5, 100], [0, 0, 1, 0]]
+    assert robot.buffer_len() == robot.buffer_len(remote = True) == 40
+
+
+def test_mirror_forgets_failed_commands(emulator, robot):
+    robot.buffer_set(line(5))
+    emulator.latency = {30: 0.3}
+    robot.timeout    = 0.1
+    with pytest.raises(Exception):
+        robot.buffer_add([[9, 9, 9], [0, 0, 1, 0]])
+    assert not robot.mirror.known()
+    robot.timeout = 5.0
+    assert robot.buffer_len() == 6
+
+
+def test_settings_sent_once(emulator, robot):
+    commands = emulator.commands
+    robot.set_speed([50, 50, 50, 50])
+    robot.set_speed([50, 50, 50, 50])
+    robot.set_zone('z1')
+    robot.set_go(10)
+    robot.set_go(10)
+    assert emulator.commands == commands + 2
+    robot.set_go(10, force = True)
+    assert emulator.commands == commands + 3
+    assert emulator.speed[0] == 50 and emulator.group_out == 10
+
+
+def test_settings_resent_after_reset(emulator, robot):
+    robot.set_tool([[1, 2, 3], [1, 0, 0, 0]])
+    robot.reset_position(2)
+    commands = emulator.commands
+    robot.set_tool([[1, 2, 3], [1, 0, 0, 0]])
+    assert emulator.commands == commands + 1
+
+
+def test_encode_frame():
+    import abb_emulator
+    frame  = abb.encode_frame("38 1.25 -2 300.5 #")
+    params = [0.0] * abb.MAX_PARAMS
+    assert abb_emulator.frame_size(frame) == len(frame)
+    assert abb_emulator.parse_frame(frame, params) == (38, 3)
+    assert params[:3] == [1.25, -2, 300.5]
+
+
+def test_binary_frames(emulator):
+    path = [[[x + 0.0123, 0, 100], [0, 0, 1, 0]] for x in range(100)]
+    text = abb.Robot(emulator.host, emulator.port)
+    commands = emulator.commands
+    text.buffer_set(path)
+    text_commands = emulator.commands - commands
+    text.close()
+
+    R = abb.Robot(emulator.host, emulator.port, binary = True)
+    assert R.protocol.binary and emulator.binary
+    commands = emulator.commands
+    assert R.buffer_set(path)
+    # Fewer messages, and positions no longer rounded to 0.1 mm
+    assert emulator.commands - commands < text_commands
+    assert emulator.buffer_targets[5][0] == pytest.approx(5.0123, abs = 1e-4)
+    assert R.buffer_len(remote = True) == 100
+    R.close()
+
+
+def test_buffer_cache(emulator):
+    R = abb.Robot(emulator.host, emulator.port, buffer_cache = [1])
+    first, other = line(40), [[[0, y, 100], [0, 0, 1, 0]] for y in range(40)]
+    # The same path elsewhere is loaded and moved
+    moved = [[[x + 10, 3, 100], [0, 0, 1, 0]] for x in range(40)]
+    for path, hits, misses in [(first, 0, 1), (moved, 1, 1), (other, 1, 2), (first, 1, 3)]:
+        commands = emulator.commands
+        assert R.buffer_set(path)
+        assert (R.buffer_cache.hits, R.buffer_cache.misses) == (hits, misses)
+        assert emulator.buffer_targets[39][0:3] == path[39][0]
+        assert emulator.buffer_pos == 40
+        if path is moved: assert emulator.commands - commands <= 2
+    R.close()
+
+
+def test_buffer_cache_least_recently_used():
+    cache  = abb.BufferCache([1, 2])
+    mirror = abb.BufferMirror()
+    speed  = (10, 50, 50, 50)
+    keys   = [cache.key([(x, y * x, 0, 1, 0, 0, 0) for x in range(5)], speed)
+              for y in range(3)]
+    # Keys are the same wherever the path is
+    assert keys[0] == cache.key([(x + 5, 7, 1, 1, 0, 0, 0) for x in range(5)], speed)
+    for key in keys[0:2]:
+        slot = cache.slot_for(key, mirror)
+        mirror.saved[slot] = None
+        cache.add(key, slot, (0, 0, 0))
+    assert cache.lookup(keys[0], mirror) == (1, (0, 0, 0))
+    # keys[1] is now the least recently used, so its slot is reused
+    assert cache.slot_for(keys[2], mirror) == 2
+    assert cache.lookup(keys[1], mirror) is None
+    # Only slots the mirror still knows are trusted
+    del mirror.saved[1]
+    assert cache.lookup(keys[0], mirror) is None
+    with pytest.raises(Exception):
+        abb.BufferCache([0])
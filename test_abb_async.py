@@ -0,0 +1,54 @@
+'''
+Tests for abb_async.Robot against abb_emulator:
+    python -m pytest test_abb_async.py
+'''
+
+import asyncio
+
+import abb_async
+
+
+def run(emulator, test):
+    '''
+    Runs test(R) on an abb_async.Robot connected to the emulator
+    '''
+    async def main():
+        async with abb_async.Robot(emulator.host, emulator.port) as R:
+            return await test(R)
+    return asyncio.run(main())
+
+
+def test_buffer_set_generator(emulator):
+    poses = [[[i, 0, 100], [0, 0, 1, 0]] for i in range(30)]
+    async def test(R):
+        assert await R.buffer_set(pose for pose in poses)
+        return await R.buffer_len()
+    assert run(emulator, test) == 30
+    assert emulator.buffer_targets[29][0] == 29
+
+
+def test_buffer_set_empty(emulator):
+    async def test(R):
+        assert await R.buffer_set([])
+        return await R.buffer_len()
+    assert run(emulator, test) == 0
+
+
+def test_tasks_keep_their_replies(emulator):
+    emulator.latency = 0.002
+    async def test(R):
+        queries = [R.get_cartesian() for i in range(8)] + [R.buffer_len() for i in range(8)]
+        return await asyncio.gather(*queries)
+    replies = run(emulator, test)
+    assert all(len(pose) == 2 for pose in replies[:8])
+    assert replies[8:] == [0] * 8
+
+
+def test_send_all_in_order(emulator):
+    async def test(R):
+        await R.send("31 #")
+        adds = ["30 %i 0 100 0 0 1 0 #" % i for i in range(5)]
+        await asyncio.gather(R.send_all(adds), R.send_all(adds))
+        return await R.buffer_len()
+    assert run(emulator, test) == 10
+    assert [emulator.buffer_targets[i][0] for i in range(10)] == list(range(5)) * 2
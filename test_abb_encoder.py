@@ -0,0 +1,65 @@
+'''
+Tests for abb_encoder (needs NumPy, no robot):
+    python -m pytest test_abb_encoder.py
+'''
+
+import numpy as np
+import pytest
+
+import abb_encoder
+
+
+# Ties, near ties, negative zero, and values too big for the field
+VALUES = [0.0, -0.0, 0.05, 0.15, 0.25, -0.25, 1.45, 2.675, -2.675, 999.95,
+          -999.95, 12345.6, -0.04, 0.96, 1e-7, 99999.99, 123456789.0, -1e12]
+
+
+@pytest.mark.parametrize('spec', ["+08.1f", "08.1f", "+08.5f", "08.5f", ".1f", ".3f"])
+def test_format_matches_python(spec):
+    rng    = np.random.default_rng(0)
+    values = VALUES + (rng.standard_normal(500) * 10.0**rng.integers(-3, 6, 500)).tolist()
+    rows   = abb_encoder.encode(np.array(values)[:, None], [spec], end='')
+    assert rows == [format(v, spec) for v in values]
+
+
+def test_encode_poses_matches_format_pose():
+    pose = [1.25, -30.0, 400.04, 0.70711, 0.0, -0.70711, 0.0]
+    assert abb_encoder.encode_poses([pose]) == [
+        ' '.join(format(v, spec) for v, spec in zip(pose, abb_encoder.POSE_SPECS)) + ' #']
+
+
+def test_check_poses_shapes():
+    assert abb_encoder.check_poses([]).shape == (0, 7)
+    assert abb_encoder.check_poses([[[1, 2, 3], [1, 0, 0, 0]]]).shape == (1, 7)
+    assert abb_encoder.check_poses(np.zeros((4, 3))).shape == (4, 3)
+
+
+@pytest.mark.parametrize('poses', [
+    [[[1, 2, 3], [1, 0, 0, 1]]],                # Not unit length
+    [[[1, 2, float('nan')], [1, 0, 0, 0]]],
+    np.zeros((2, 5)),
+    [[1, 2]],
+])
+def test_check_poses_malformed(poses):
+    with pytest.raises(NameError):
+        abb_encoder.check_poses(poses)
+
+
+def test_mixed_poses_keep_orientation():
+    poses = [[[0, 0, 0], [0, 0, 1, 0]], [1, 0, 0], [2, 0, 0],
+             [[3, 0, 0], [0, 0, 1, 0]], [[4, 0, 0], [1, 0, 0, 0]], [5, 0, 0]]
+    assert abb_encoder.orientation_mask(poses).tolist() == [True, False, False, True, True, False]
+    array = abb_encoder.check_poses(poses)
+    assert array[:, 3:7].tolist() == [[0, 0, 1, 0]] * 4 + [[1, 0, 0, 0]] * 2
+    orients = [orient for orient, position in abb_encoder.buffer_rows(poses)]
+    assert orients == ["29 00.00000 00.00000 01.00000 00.00000 #", None, None, None,
+                       "29 01.00000 00.00000 00.00000 00.00000 #", None]
+
+
+def test_positions_before_any_orientation():
+    with pytest.raises(NameError):
+        abb_encoder.check_poses([[0, 0, 0], [[1, 0, 0], [1, 0, 0, 0]]])
+    # Sent to the buffer, they keep the controller's orientation instead
+    rows = list(abb_encoder.buffer_rows([[0, 0, 0], [[1, 0, 0], [0, 0, 1, 0]]]))
+    assert rows == [(None, "0.0 0.0 0.0 "),
+                    ("29 00.00000 00.00000 01.00000 00.00000 #", "1.0 0.0 0.0 ")]
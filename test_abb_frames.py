@@ -0,0 +1,31 @@
+'''
+Tests for abb_frames and robot_config's work objects (needs NumPy):
+    python -m pytest test_abb_frames.py
+'''
+
+import numpy as np
+import pytest
+
+import abb_frames
+from Robot_Config import robot_config
+
+
+def test_get_wobj_offset_along_its_z():
+    # The 90 degree plate's Z axis is the robot's Y
+    position, quaternion = robot_config.get_wobj(10, 2)
+    assert position == pytest.approx([564.949, -63.7138, 475.236])
+    assert robot_config.get_wobj(10, 2) == abb_frames.as_pose(abb_frames.workobject(2, 10))
+    assert robot_config.get_wobj(0, 1) == robot_config.WObjData[1]
+    assert robot_config.get_wobj(0, 1) is not robot_config.WObjData[1]
+
+
+def test_transform_round_trip():
+    rng   = np.random.default_rng(2)
+    poses = np.hstack((rng.uniform(-100, 100, (50, 3)), np.tile([1.0, 0, 0, 0], (50, 1))))
+    beds  = abb_frames.workobject(0), abb_frames.workobject(3, 5)
+    there = abb_frames.transform(poses, *beds)
+    back  = abb_frames.transform(there, beds[1], beds[0])
+    assert back == pytest.approx(poses)
+    # The same point relative to the robot either way
+    assert (abb_frames.transform(there, beds[1]) ==
+            pytest.approx(abb_frames.transform(poses, beds[0])))
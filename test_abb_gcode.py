@@ -0,0 +1,85 @@
+'''
+Tests for abb_gcode, run on abb_testing.Robot (no robot needed):
+    python -m pytest test_abb_gcode.py
+'''
+
+import os
+os.environ.setdefault('MPLBACKEND', 'Agg')
+
+import pytest
+
+import abb_gcode
+import abb_testing
+
+
+def extruded_segments(gcode):
+    '''
+    (from, to) XY of every move the simulated robot extrudes on
+    '''
+    R = abb_testing.Robot('sim')
+    abb_gcode.execute(R, abb_gcode.batches(abb_gcode.parse(gcode.splitlines())))
+    positions = R.toolpath.positions[:, 0:2].round(3).tolist()
+    extrude   = R.toolpath.extrude.tolist()
+    return [(tuple(positions[i - 1]), tuple(positions[i]))
+            for i in range(1, len(positions))
+            if extrude[i] and positions[i - 1] != positions[i]]
+
+
+def test_first_extruded_segment():
+    segments = extruded_segments('G0 X10 Y10 Z0.2 F6000\n'
+                                 'G1 X20 Y10 E1 F1200\n'
+                                 'G1 X20 Y20 E2\n')
+    assert segments == [((10.0, 10.0), (20.0, 10.0)), ((20.0, 10.0), (20.0, 20.0))]
+
+
+def test_first_extruded_arc_segment():
+    segments = extruded_segments('G0 X30 Y30 Z0.2 F6000\n'
+                                 'G2 X40 Y30 I5 J0 E1 F1200\n')
+    assert segments[0][0] == (30.0, 30.0)
+    assert segments[-1][1] == (40.0, 30.0)
+
+
+def test_g90_resets_relative_e():
+    moves = list(abb_gcode.parse(['G91', 'G1 X1 E1 F600', 'G90',
+                                  'G1 X5 E0.5', 'G1 X6 E2']))
+    # Absolute again after G90: E0.5 retracts, E2 extrudes
+    assert [move.extrude for move in moves] == [True, False, True]
+
+
+def test_go_table_repeated_speed():
+    assert abb_gcode.go_value(10, [(10, 40), (10, 40), (20, 80)]) == 40
+    with pytest.raises(Exception):
+        abb_gcode.go_value(15, [(10, 40), (10, 60), (20, 80)])
+
+
+def test_feed_changes_share_a_batch():
+    gcode = ['G0 X0 Y0 Z0.2 F6000', 'G1 X10 E1 F1200', 'G1 X20 E2 F600',
+             'G1 X30 E3 F1200', 'G1 X40 E4 F1800']
+    result = list(abb_gcode.batches(abb_gcode.parse(gcode),
+                                    go_table = [(10, 40), (30, 120)]))
+    assert [batch.extrude for batch in result] == [False, True]
+    printed = result[1]
+    # Starts at the travel's last pose, at the speed of the first move
+    assert printed.speeds == [20.0, 20.0, 10.0, 20.0, 30.0]
+    assert printed.go_values == [80, 80, 40, 80, 120]
+    assert printed.speed[0] == 20.0 and printed.go == 80
+
+    R = abb_testing.Robot('sim')
+    abb_gcode.execute(R, iter(result))
+    speeds = R.toolpath.speed[R.toolpath.extrude].tolist()
+    assert speeds[-3:] == [10.0, 20.0, 30.0]
+
+
+def test_one_speed_sends_no_speeds():
+    gcode = ['G0 X0 Y0 Z0.2 F6000', 'G1 X10 E1 F1200', 'G1 X20 E2']
+    result = list(abb_gcode.batches(abb_gcode.parse(gcode)))
+    assert result[1].speeds is None and result[1].speed[0] == 20.0
+
+
+def test_move_without_feed_rate():
+    moves = abb_gcode.parse(['G1 X10 Y10 Z0.2', 'G1 X20 E1 F1200'])
+    with pytest.raises(Exception, match = 'feed rate'):
+        list(abb_gcode.batches(moves))
+    # Travel without F is fine at travel_speed
+    moves = abb_gcode.parse(['G0 X10 Y10 Z0.2', 'G1 X20 E1 F1200'])
+    assert len(list(abb_gcode.batches(moves, travel_speed = 100))) == 2
@@ -0,0 +1,61 @@
+'''
+Tests for abb_journal, recording abb.Robot against abb_emulator:
+    python -m pytest test_abb_journal.py
+'''
+
+import pytest
+
+import abb
+import abb_journal
+
+
+def record(emulator, filename):
+    R = abb.Robot(emulator.host, emulator.port, journal = filename)
+    R.buffer_set([[[x, 0, 100], [0, 0, 1, 0]] for x in range(20)])
+    with R.pipelined():
+        for x in range(5): R.set_go(x)
+    R.get_cartesian()
+    R.close()
+
+
+def test_record_and_replay(emulator, tmp_path):
+    filename = str(tmp_path / 'print.journal')
+    record(emulator, filename)
+    records = list(abb_journal.read(filename))
+    kinds   = [r.kind for r in records]
+    assert kinds[0] == abb_journal.SESSION and kinds[-1] == abb_journal.NO_REPLY
+    assert kinds.count(abb_journal.SENT) == kinds.count(abb_journal.RECEIVED)
+    assert [r.time for r in records] == sorted(r.time for r in records)
+
+    result = abb_journal.replay(filename)
+    assert result.sessions == 1 and result.divergent == 0
+    assert result.messages == kinds.count(abb_journal.SENT) + kinds.count(abb_journal.NO_REPLY)
+    assert result.replies == kinds.count(abb_journal.RECEIVED)
+
+
+def test_replay_reports_divergence(emulator, tmp_path):
+    filename = str(tmp_path / 'print.journal')
+    record(emulator, filename)
+    # Replayed against a robot that is somewhere else
+    emulator.position = [1, 2, 3, 1, 0, 0, 0]
+    result = abb_journal.replay(filename, (emulator.host, emulator.port))
+    assert result.divergent == 1
+    assert result.divergences[0].message == b'03 #'
+
+
+def test_journal_kept_on_error(emulator, tmp_path):
+    filename = str(tmp_path / 'print.journal')
+    with pytest.raises(RuntimeError):
+        with abb_journal.Journal(filename) as J:
+            R = abb.Robot(emulator.host, emulator.port, journal = J)
+            R.set_go(1)
+            raise RuntimeError('print failed')
+    assert abb_journal.Journal(filename).file.tell() > len(abb_journal.MAGIC)
+    assert [r.kind for r in abb_journal.read(filename)][-1] == abb_journal.RECEIVED
+
+
+def test_not_a_journal(tmp_path):
+    filename = tmp_path / 'part.gcode'
+    filename.write_bytes(b'G1 X1\n')
+    with pytest.raises(Exception, match = "isn't a journal"):
+        list(abb_journal.read(str(filename)))
@@ -0,0 +1,89 @@
+'''
+Tests for abb_path (needs NumPy, no robot):
+    python -m pytest test_abb_path.py
+'''
+
+import numpy as np
+import pytest
+
+import abb_path
+
+
+def test_simplify_straight_line():
+    poses  = [[[x, 2 * x, 0], [1, 0, 0, 0]] for x in range(10)]
+    result = abb_path.simplify(poses, 0.1)
+    assert result.poses == [poses[0], poses[-1]]
+    assert result.kept.tolist() == [0, 9] and result.removed == 8
+    assert result.max_deviation == pytest.approx(0, abs = 1e-9)
+
+
+def test_simplify_within_tolerance():
+    rng    = np.random.default_rng(1)
+    points = np.cumsum(rng.standard_normal((500, 3)), axis=0)
+    result = abb_path.simplify(points, 0.5)
+    assert isinstance(result.poses, np.ndarray)
+    assert result.removed > 0 and result.max_deviation <= 0.5
+    # Every point removed is within tolerance of the segment it was on
+    distance, segment = abb_path.deviations(points, np.isin(np.arange(500), result.kept))
+    assert distance.max() == pytest.approx(result.max_deviation)
+
+
+def test_simplify_keeps_orientation_changes():
+    poses = ([[[x, 0, 0], [1, 0, 0, 0]] for x in range(5)] +
+             [[[x, 0, 0], [0, 0, 1, 0]] for x in range(5, 10)])
+    assert abb_path.simplify(poses, 1.0).kept.tolist() == [0, 4, 5, 9]
+
+
+def test_simplify_short_paths():
+    assert abb_path.simplify([], 1.0).removed == 0
+    assert abb_path.simplify([[0, 0, 0], [1, 1, 1]], 1.0).kept.tolist() == [0, 1]
+
+
+def test_corner_speeds():
+    square = np.array([[0, 0, 0], [10, 0, 0], [10, 10, 0], [20, 10, 0], [30, 10, 0]], dtype=float)
+    limit  = abb_path.corner_speeds(square, 2.0, 1000)
+    # A right angle blends on a radius of the zone
+    assert limit[1] == pytest.approx(np.sqrt(1000 * 2.0))
+    assert np.isinf(limit[[0, 3, 4]]).all()
+    assert np.isinf(abb_path.corner_speeds(square, 0.0, 1000)).all()
+
+
+def test_plan_fine_points_keep_speed():
+    poses = [[x, (x // 2) % 2, 0] for x in range(10)]
+    plan  = abb_path.plan(poses, 40, zone = 0, accel = 1000)
+    assert plan.speeds.tolist() == [40] * 10 and plan.go is None
+
+
+def test_plan_slows_corners_only():
+    poses = [[0, 0, 0], [100, 0, 0], [100, 100, 0], [200, 100, 0]]
+    plan  = abb_path.plan(poses, 100, zone = 0.5, accel = 500)
+    # Long moves still reach full speed between corners
+    assert plan.speeds.tolist() == [100] * 4
+    tight = [[0, 0, 0], [1, 0, 0], [1, 1, 0], [2, 1, 0]]
+    assert (abb_path.plan(tight, 100, zone = 0.5, accel = 500).speeds[1:] < 100).all()
+
+
+def test_plan_duplicates_and_minimum_speed():
+    poses = [[0, 0, 0], [0, 0, 0], [5, 0, 0], [5, 0, 0], [5, 5, 0]]
+    plan  = abb_path.plan(poses, [0, 0, 20, 0.1, 20], zone = 1, accel = 1000)
+    assert np.isfinite(plan.speeds).all()
+    assert plan.speeds.min() == abb_path.MIN_SPEED
+
+
+def test_plan_speed_matrix():
+    plan = abb_path.plan([[0, 0, 0], [1, 0, 0], [2, 0, 0]], [5, 20, 100],
+                         speed_matrix = [[10, 40], [30, 120]])
+    assert plan.speeds.tolist() == [10, 20, 30]
+    assert plan.go.tolist() == [40, 80, 120]
+
+
+def test_move_times():
+    line = [[0, 0, 0], [10, 0, 0], [30, 0, 0]]
+    assert abb_path.move_times(line, 10, 1, [False] * 3, None).tolist() == [0, 1, 2]
+    # From rest and back to rest: a triangle at 100 mm/s^2 over 10 mm
+    times = abb_path.move_times(line[:2], 1000, 1, [False] * 2, 100)
+    assert times[1] == pytest.approx(2 * np.sqrt(10 / 100))
+    # Stopping between the moves takes longer than blending through
+    blended = abb_path.move_times(line, 20, 1, [False] * 3, 100).sum()
+    stopped = abb_path.move_times(line, 20, 1, [False, True, False], 100).sum()
+    assert stopped > blended
@@ -0,0 +1,45 @@
+'''
+Tests for abb_stream, through abb.Robot.streaming, against abb_emulator:
+    python -m pytest test_abb_stream.py
+'''
+
+import pytest
+
+import abb_stream
+
+
+def layer(z, n = 10):
+    return [[[x, 0, z], [0, 0, 1, 0]] for x in range(n)]
+
+
+def test_stream_ends_at_last_pose(emulator, robot):
+    with robot.streaming() as S:
+        S.push(layer(1), speed = [20, 50])
+        S.push([[x, 5, 2] for x in range(10)], extrude = False)
+    assert robot.get_cartesian() == [[9, 5, 2], [0, 0, 1, 0]]
+    assert robot.stream.status() == (20, 20)
+    assert emulator.digital_out[2] == 0
+    # Positions keep the orientation and speed pushed before them
+    assert emulator.stream_speeds[19][0] == 20
+    assert emulator.stream_extrude[9] and not emulator.stream_extrude[10]
+
+
+def test_stream_longer_than_ring(emulator, robot):
+    emulator.motion_scale = 1e-4
+    poses = [[x % 100, x // 100, 1] for x in range(abb_stream.STREAM_RING * 2 + 10)]
+    with robot.streaming(window = 4) as S:
+        S.push([[[0, 0, 1], [1, 0, 0, 0]]])
+        assert S.push(poses) == len(poses)
+    assert robot.stream.status() == (len(poses) + 1, len(poses) + 1)
+    assert robot.get_cartesian()[0] == poses[-1]
+
+
+def test_stream_cleared_on_error(emulator, robot):
+    with pytest.raises(RuntimeError):
+        with robot.streaming() as S:
+            S.push(layer(1))
+            raise RuntimeError('stop')
+    added, done = robot.stream.status()
+    assert added == done
+    # The motion socket is free again
+    assert robot.buffer_len(remote = True) == 0